@@ -0,0 +1,414 @@
+################################################################################
+# Regression checks for the rules of the game and the AI
+# Plays short seeded games headless and checks the bitboard engine, the
+# penalties, the move searches and the vectorized environments against naive
+# versions that scan the board box by box, the way the original code did.
+#
+# Example: python -m pytest -q test_tetris.py
+################################################################################
+
+import collections, copy, random
+
+import pytest
+
+import tetris_brogan_edit as tetris
+
+'''
+return: an empty board as the original code kept it, one list per column with
+        BLANK or the color of every box
+'''
+def blankGrid():
+    return [[tetris.BLANK] * tetris.BOARDHEIGHT for x in range(tetris.BOARDWIDTH)]
+
+'''
+The boxes of a shape on the board, read from its template in PIECES.
+return: list of (x, y), boxes above the board included
+'''
+def templateBoxes(shape, rotation, x, y):
+    template = tetris.PIECES[tetris.PIECESLIST[shape]][rotation]
+    return [(x + templateX, y + templateY)
+            for templateY in range(tetris.TEMPLATEHEIGHT) for templateX in range(tetris.TEMPLATEWIDTH)
+            if template[templateY][templateX] != tetris.BLANK]
+
+'''
+The original isValidPosition: boxes above the board never collide. The
+original let those boxes stick out past the walls (and then locked them in the
+column on the other side), the bitboard keeps every box between the walls.
+'''
+def naiveFits(grid, shape, rotation, x, y):
+    for boxX, boxY in templateBoxes(shape, rotation, x, y):
+        if not 0 <= boxX < tetris.BOARDWIDTH:
+            return False
+        if boxY < 0:
+            continue
+        if boxY >= tetris.BOARDHEIGHT or grid[boxX][boxY] != tetris.BLANK:
+            return False
+    return True
+
+def naiveLock(grid, shape, rotation, x, y, color):
+    for boxX, boxY in templateBoxes(shape, rotation, x, y):
+        if boxY >= 0:
+            grid[boxX][boxY] = color
+
+'''
+The original removeCompleteLines: full rows go, the rows above them move down.
+return: the number of lines cleared
+'''
+def naiveClear(grid):
+    kept = [y for y in range(tetris.BOARDHEIGHT)
+            if any(grid[x][y] == tetris.BLANK for x in range(tetris.BOARDWIDTH))]
+    lines = tetris.BOARDHEIGHT - len(kept)
+    for x in range(tetris.BOARDWIDTH):
+        grid[x][:] = [tetris.BLANK] * lines + [grid[x][y] for y in kept]
+    return lines
+
+def isFilled(grid, x, y):
+    return grid[x][y] != tetris.BLANK
+
+def naiveHeights(grid):
+    heights = []
+    for x in range(tetris.BOARDWIDTH):
+        top = next((y for y in range(tetris.BOARDHEIGHT) if isFilled(grid, x, y)), tetris.BOARDHEIGHT)
+        heights.append(tetris.BOARDHEIGHT - top)
+    return heights
+
+'''
+The original calcHolePenalty walked up from every empty box looking for a box
+above it.
+return: the number of holes in column x
+'''
+def naiveColumnHoles(grid, x):
+    return sum(1 for y in range(tetris.BOARDHEIGHT)
+               if not isFilled(grid, x, y) and any(isFilled(grid, x, above) for above in range(y)))
+
+def naiveHoles(grid):
+    return sum(naiveColumnHoles(grid, x) for x in range(tetris.BOARDWIDTH))
+
+'''
+The original calcRealHeightPenalty: every box costs (BOARDHEIGHT - y) times the
+multiplier of its row.
+'''
+def naiveHeightPenalty(grid):
+    return sum((tetris.BOARDHEIGHT - y) * tetris.HEIGHTMULTIPLIERS[y]
+               for x in range(tetris.BOARDWIDTH) for y in range(tetris.BOARDHEIGHT) if isFilled(grid, x, y))
+
+def naivePenalty(grid):
+    return naiveHeightPenalty(grid) + naiveHoles(grid) * tetris.HOLEPENALTY
+
+'''
+Every feature of BOARDFEATURES counted box by box, followed by the boxes of
+every row.
+'''
+def naiveFeatures(grid):
+    width, height = tetris.BOARDWIDTH, tetris.BOARDHEIGHT
+    heights = naiveHeights(grid)
+    covered = 0
+    for x in range(width):
+        for y in range(height - heights[x], height):
+            if not isFilled(grid, x, y):
+                covered += sum(1 for above in range(height - heights[x], y) if isFilled(grid, x, above))
+    rowTransitions = 0
+    for y in range(height):
+        line = [True] + [isFilled(grid, x, y) for x in range(width)] + [True]
+        rowTransitions += sum(line[i] != line[i + 1] for i in range(width + 1))
+    columnTransitions = 0
+    for x in range(width):
+        column = [isFilled(grid, x, y) for y in range(height)] + [True]
+        columnTransitions += sum(column[i] != column[i + 1] for i in range(height))
+    wells = 0
+    for x in range(width):
+        neighbors = [heights[n] for n in (x - 1, x + 1) if 0 <= n < width]
+        wells += max(0, min(neighbors) - heights[x])
+    features = {'aggregateHeight': sum(heights),
+                'maxHeight': max(heights),
+                'holes': naiveHoles(grid),
+                'completedLines': sum(all(isFilled(grid, x, y) for x in range(width)) for y in range(height)),
+                'bumpiness': sum(abs(heights[x] - heights[x + 1]) for x in range(width - 1)),
+                'coveredCells': covered,
+                'rowTransitions': rowTransitions,
+                'columnTransitions': columnTransitions,
+                'wellDepths': wells}
+    rowFill = [sum(isFilled(grid, x, y) for x in range(width)) for y in range(height)]
+    return [features[name] for name in tetris.BOARDFEATURES] + rowFill
+
+'''
+Checks every plane and statistic the board keeps against a scan of the grid.
+'''
+def assertBoardMatches(board, grid):
+    assert board.colors == grid
+    for y in range(tetris.BOARDHEIGHT):
+        assert board.rows[y] == sum(1 << x for x in range(tetris.BOARDWIDTH) if isFilled(grid, x, y))
+        assert board.rowFill[y] == sum(isFilled(grid, x, y) for x in range(tetris.BOARDWIDTH))
+    for x in range(tetris.BOARDWIDTH):
+        assert board.columnMasks[x] == sum(1 << y for y in range(tetris.BOARDHEIGHT) if isFilled(grid, x, y))
+    assert board.heights == naiveHeights(grid)
+    assert board.holes == [naiveColumnHoles(grid, x) for x in range(tetris.BOARDWIDTH)]
+
+'''
+Plays seeded games on a Board and on a grid side by side, half of the pieces
+dropped where the AI would put them and half dropped anywhere, so the boards
+get tall and full of holes.
+games: number of games
+pieces: most pieces of each game
+return: iterator of (board, grid, piece, lines, naiveLines) after every piece
+        locked, piece is the one that was locked
+'''
+def playedBoards(games=4, pieces=120):
+    rng = random.Random(2016)
+    for game in range(games):
+        board = tetris.getBlankBoard()
+        grid = blankGrid()
+        for n in range(pieces):
+            shape = rng.randrange(len(tetris.PIECESLIST))
+            placements = list(tetris.generatePlacements(board, shape))
+            if not placements:
+                break
+            if rng.random() < 0.5:
+                column, rotation = tetris.findBestMove(board, tetris.makePiece(shape, 0))
+                x = column - tetris.PIECEGEOMETRY[shape][rotation]['minX']
+                placement = (shape, rotation, x, tetris.getLandingY(board, shape, rotation, x))
+            else:
+                placement = rng.choice(placements)
+            shape, rotation, x, y = placement
+            piece = tetris.Piece(shape, rotation, x, y, tetris.PIECECOLORS[shape])
+            tetris.addToBoard(board, piece)
+            naiveLock(grid, shape, rotation, x, y, piece.color)
+            yield board, grid, piece, tetris.removeCompleteLines(board), naiveClear(grid)
+
+'''
+The bitboard keeps the rows, column masks, row fill counts, heights, holes and
+colors of the original list of columns through locks and line clears, and
+isValidPosition agrees with the original around every locked piece.
+'''
+def testBoardMatchesNaiveScan():
+    cleared = 0
+    for board, grid, piece, lines, naiveLines in playedBoards():
+        assert lines == naiveLines
+        cleared += lines
+        assertBoardMatches(board, grid)
+        for adjX in (-2, -1, 0, 1, 2):
+            for adjY in (-3, -1, 0, 1):
+                for rotation in range(tetris.PIECEROTATIONS[piece.shape]):
+                    moved = tetris.Piece(piece.shape, rotation, piece.x, piece.y, piece.color)
+                    assert tetris.isValidPosition(board, moved, adjX, adjY) == \
+                        naiveFits(grid, piece.shape, rotation, piece.x + adjX, piece.y + adjY)
+    assert cleared > 0
+
+'''
+The penalties, the feature vector, evaluatePlacement, calcPenaltyBatched and
+the moves of findBestMove and findBestMoveWithHold give what the original
+scanning penalties give.
+'''
+def testPenaltiesMatchNaiveScan():
+    rng = random.Random(7)
+    for count, (board, grid, piece, lines, naiveLines) in enumerate(playedBoards()):
+        assert tetris.calcRealHeightPenalty(board) == naiveHeightPenalty(grid)
+        assert tetris.calcHolePenalty(board) == naiveHoles(grid) * tetris.HOLEPENALTY
+        assert tetris.calcPenalty(board) == naivePenalty(grid)
+        features = tetris.extractFeatures(board)
+        assert features == naiveFeatures(grid)
+        assert tetris.weightedSum(features, tetris.PENALTYWEIGHTS) == naivePenalty(grid)
+        if count % 5:
+            continue
+        analysis = tetris.analyzeBoard(board)
+        penalties = {}
+        for shape in range(len(tetris.PIECESLIST)):
+            for placement in tetris.generatePlacements(board, shape):
+                locked = copy.deepcopy(grid)
+                naiveLock(locked, *placement, color=0)
+                penalties[placement] = naivePenalty(locked)
+                assert tetris.evaluatePlacement(analysis, *placement) == penalties[placement]
+            placements = [placement for placement in penalties if placement[0] == shape]
+            if placements and tetris.loadNumpy() is not None:
+                batched = tetris.calcPenaltyBatched(tetris.placementsToArray(board, placements))
+                assert batched.tolist() == [penalties[placement] for placement in placements]
+
+        '''
+        return: the naive penalty of dropping a shape in a column and rotation
+        '''
+        def moveCost(shape, column, rotation):
+            x = column - tetris.PIECEGEOMETRY[shape][rotation]['minX']
+            return penalties[(shape, rotation, x, tetris.getLandingY(board, shape, rotation, x))]
+
+        shape, other = rng.randrange(len(tetris.PIECESLIST)), rng.randrange(len(tetris.PIECESLIST))
+        best = [cost for placement, cost in penalties.items() if placement[0] == shape]
+        if not best:
+            continue
+        column, rotation = tetris.findBestMove(board, tetris.makePiece(shape, 0))
+        assert moveCost(shape, column, rotation) == min(best)
+        both = best + [cost for placement, cost in penalties.items() if placement[0] == other]
+        column, rotation, useHold = tetris.findBestMoveWithHold(board, tetris.makePiece(shape, 0), None,
+                                                                tetris.makePiece(other, 0))
+        assert moveCost(other if useHold else shape, column, rotation) == min(both)
+
+'''
+generateReachablePlacements finds exactly the resting places a search over
+GameState.step reaches, and the inputs of every placement play it.
+'''
+def testReachablePlacementsMatchStepSearch():
+    rng = random.Random(5)
+    for seed in range(8):
+        game = tetris.GameState(seed)
+        for n in range(rng.randint(5, 60)):
+            placements = list(tetris.generatePlacements(game.board, game.fallingPiece.shape))
+            shape, rotation, x, y = rng.choice(placements)
+            trial = game.copy()
+            trial.place(rotation, x + tetris.PIECEGEOMETRY[shape][rotation]['minX'])
+            if trial.gameOver:
+                break
+            game = trial
+        stats = {}
+        reachable = list(tetris.generateReachablePlacements(game.board, game.fallingPiece, stats))
+        found = set((shape, rotation, x, y) for shape, rotation, x, y, inputs in reachable)
+        assert len(found) == len(reachable)
+
+        start = game.fallingPiece
+        seen = {(start.rotation, start.x, start.y)}
+        paths = collections.deque([()])
+        resting = set()
+        while paths:
+            path = paths.popleft()
+            moved = game.copy()
+            for action in path:
+                moved.step(action)
+            piece = moved.fallingPiece
+            if not tetris.isValidPosition(moved.board, piece, adjY=1) and \
+                    piece.y + tetris.PIECEGEOMETRY[piece.shape][piece.rotation]['minY'] >= 0:
+                resting.add((piece.shape, piece.rotation, piece.x, piece.y))
+            for action in (tetris.MOVELEFT, tetris.MOVERIGHT, tetris.ROTATE, tetris.ROTATEBACK,
+                           tetris.SOFTDROP, tetris.HARDDROP):
+                after = moved.copy()
+                after.step(action)
+                state = (after.fallingPiece.rotation, after.fallingPiece.x, after.fallingPiece.y)
+                if state not in seen:
+                    seen.add(state)
+                    paths.append(path + (action,))
+        assert found == resting
+        assert stats['states'] == len(seen)
+
+        for shape, rotation, x, y, inputs in reachable:
+            moved = game.copy()
+            for action in inputs:
+                moved.step(action)
+            piece = moved.fallingPiece
+            assert (piece.rotation, piece.x, piece.y) == (rotation, x, y)
+            played = game.copy()
+            played.playInputs(inputs)
+            assert played.piecesPlaced == game.piecesPlaced + 1
+
+'''
+Holding a piece that was moved (here hard dropped to the bottom) and swapping
+it back in later brings it back at the spawn position, it doesn't end the game
+because of where it was when it was held.
+'''
+def testHoldSwapSpawnsTheHeldPiece():
+    game = tetris.GameState(0)
+    game.step(tetris.HARDDROP)
+    game.step(tetris.HOLD)
+    for i in range(6):
+        column, rotation = tetris.findBestMove(game.board, game.fallingPiece)
+        game.place(rotation, column)
+    assert not game.gameOver
+    game.step(tetris.HOLD)
+    assert not game.gameOver
+    assert game.fallingPiece.x == tetris.SPAWNX
+    assert game.fallingPiece.y == tetris.SPAWNY
+    assert tetris.isValidPosition(game.board, game.fallingPiece)
+
+'''
+Hands a GameState the pieces a VecEnv game draws, so both play the same game.
+'''
+class FeedRandomizer(object):
+    def __init__(self, pieces):
+        self.pieces = collections.deque(pieces)
+
+    def next(self):
+        return self.pieces.popleft()
+
+'''
+Every VecEnv game plays like a GameState given the same pieces and moves: the
+same lines, boards, heights, queue and game overs. The greedy actions are the
+moves of findBestMove.
+'''
+def testVecEnvMatchesGameState():
+    numpy = pytest.importorskip('numpy')
+    import tetris_vecenv
+
+    '''
+    return: a GameState that starts with the pieces the game of the
+            environment has now
+    '''
+    def scalarGame(env, n):
+        pieces = [(int(env.shapes[n, slot]), int(env.rotations[n, slot])) for slot in range(tetris_vecenv.PREVIEWS + 1)]
+        return tetris.GameState(randomizer=FeedRandomizer(pieces))
+
+    env = tetris_vecenv.VecEnv(8, 3)
+    rng = numpy.random.default_rng(1)
+    games = [scalarGame(env, n) for n in range(env.numEnvs)]
+    endings = 0
+    for step in range(400):
+        greedy = tetris_vecenv.greedyActions(env)
+        for n, game in enumerate(games):
+            column, rotation = tetris.findBestMove(game.board, game.fallingPiece)
+            assert greedy[n] == rotation * tetris.BOARDWIDTH + column
+        if step % 2:
+            actions = greedy
+        else:
+            actions = numpy.array([rng.choice(numpy.flatnonzero(mask)) for mask in env.actionMask()])
+        observations, lines, done = env.step(actions)
+        for n, game in enumerate(games):
+            # the piece the environment drew for the end of the queue, the
+            # game ended before it was needed when it is done
+            game.randomizer.pieces.append((int(env.shapes[n, -1]), int(env.rotations[n, -1])))
+            rotation, column = divmod(int(actions[n]), tetris.BOARDWIDTH)
+            assert game.place(rotation, column) == lines[n]
+            assert game.gameOver == done[n]
+            if done[n]:
+                endings += 1
+                games[n] = scalarGame(env, n)
+                continue
+            for y in range(tetris.BOARDHEIGHT):
+                assert game.board.rows[y] == sum(int(env.boards[n, x, y]) << x for x in range(tetris.BOARDWIDTH))
+            assert game.board.heights == env.heights[n].tolist()
+            queue = [game.fallingPiece] + game.queue
+            assert [piece.shape for piece in queue] == env.shapes[n].tolist()
+            assert [piece.rotation for piece in queue] == env.rotations[n].tolist()
+    assert endings > 0
+
+'''
+A piece that tops out loses its boxes above the board, in a VecEnv like in
+the engine: an O resting on top of a full column next to the only gap of the
+top row doesn't fill the gap and clears nothing.
+'''
+def testVecEnvTopOutOnlyLocksBoxesOnTheBoard():
+    numpy = pytest.importorskip('numpy')
+    import tetris_vecenv
+
+    grid = blankGrid()
+    for x in range(tetris.BOARDWIDTH):
+        for y in range(tetris.BOARDHEIGHT):
+            # the top row is full but for column 0, every row below has a gap
+            if (x, y) != (0, 0) and (y == 0 or x != 2 + y % (tetris.BOARDWIDTH - 2)):
+                grid[x][y] = 0
+    board = tetris.getBlankBoard()
+    for x in range(tetris.BOARDWIDTH):
+        for y in range(tetris.BOARDHEIGHT):
+            if isFilled(grid, x, y):
+                board.rows[y] |= 1 << x
+                board.columnMasks[x] |= 1 << y
+                board.rowFill[y] += 1
+                board.colors[x][y] = 0
+        board.updateColumn(x)
+    shape = tetris.PIECEIDS['O']
+    x = -tetris.PIECEGEOMETRY[shape][0]['minX']
+    y = tetris.getLandingY(board, shape, 0, x)
+    tetris.addShapeToBoard(board, shape, 0, x, y, 0)
+
+    env = tetris_vecenv.VecEnv(1, 0)
+    env.boards[0] = numpy.array([[isFilled(grid, x, y) for y in range(tetris.BOARDHEIGHT)]
+                                 for x in range(tetris.BOARDWIDTH)], dtype=numpy.uint8)
+    env.heights[0] = naiveHeights(grid)
+    env.shapes[0, 0] = shape
+    observations, lines, done = env.step([0])
+    assert done[0]
+    assert lines[0] == tetris.removeCompleteLines(board) == 0
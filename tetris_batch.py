@@ -0,0 +1,224 @@
+################################################################################
+# Batch runner for the Tetris AI
+# Plays many AI games without drawing them, spread over a pool of processes.
+# Every game gets its own seed, so any game of a run can be played again by
+# passing the same seed to GameState (or playAIGame).
+#
+# Example: python tetris_batch.py --games 200 --seed 1000 --workers 8
+################################################################################
+
+import argparse, multiprocessing, os, time
+
+# Seconds the imports of the game took in this process. A spawned worker imports
+# everything again, a forked one inherits the imports of the parent.
+IMPORTSTART = time.perf_counter()
+import tetris_brogan_edit as tetris
+import tetris_replay, tetris_telemetry, tetris_tuner
+IMPORTSECONDS = time.perf_counter() - IMPORTSTART
+
+# The move finders a batch can be played with, by name so tasks stay picklable
+MOVEFINDERS = {'python': tetris.findBestMove,
+               'numpy': tetris.findBestMoveBatched}
+
+# Evaluation cache of this worker process, shared by all the games it plays
+CACHE = None
+# Seconds from the start of the pool until this worker was ready to play
+STARTUP = 0.0
+# Piece sequences of the games by seed, when they were drawn ahead of time
+SEQUENCES = None
+
+'''
+Runs in every worker process once it is ready to play, to time its cold start.
+The piece sequences come along once per worker instead of with every game.
+launched: time.time() when the pool was started
+sequences: the piece sequences by seed, None to draw the pieces while playing
+'''
+def initWorker(launched, sequences=None):
+    global STARTUP, SEQUENCES
+    STARTUP = time.time() - launched
+    SEQUENCES = sequences
+
+'''
+Plays one seeded game in a worker process.
+task: (seed, options) with options the settings of runBatch as a dictionary
+return: dictionary with the seed, the pieces placed, the lines cleared,
+        whether the game was lost, the seconds it took, the worker pid and the
+        counters of the worker's evaluation cache
+'''
+def playSeed(task):
+    global CACHE
+    seed, options = task
+    if options['weights']:
+        tetris_tuner.loadWeights(options['weights'])
+    if options['cacheEntries'] and CACHE is None:
+        CACHE = tetris.EvaluationCache(options['cacheEntries'])
+    replay = tetris_replay.Replay(seed) if options['record'] else None
+    telemetry = None
+    if options['telemetry']:
+        telemetry = tetris_telemetry.TelemetrySink(os.path.join(options['telemetry'], 'game%d.ttl' % seed))
+    if SEQUENCES is not None:
+        randomizer = tetris.SequenceRandomizer(SEQUENCES[seed])
+    else:
+        randomizer = tetris.RANDOMIZERS[options['randomizer']](seed)
+    start = time.perf_counter()
+    game = tetris.playAIGame(seed, options['maxPieces'], MOVEFINDERS[options['evaluator']], options['depth'],
+                             options['beamWidth'], CACHE, options['hold'], replay, telemetry, randomizer)
+    seconds = time.perf_counter() - start
+    if telemetry is not None:
+        telemetry.close()
+    if replay is not None:
+        tetris_replay.saveReplay(replay, os.path.join(options['record'], 'game%d.trp' % seed))
+    return {'seed': seed,
+            'pieces': game.piecesPlaced,
+            'lines': game.score,
+            'gameOver': game.gameOver,
+            'seconds': seconds,
+            'pid': os.getpid(),
+            'startup': STARTUP,
+            'imports': IMPORTSECONDS,
+            'cache': CACHE.stats() if CACHE is not None else None}
+
+'''
+Plays the games of a batch in a process pool.
+seeds: the seeds of the games, one game per seed
+workers: number of processes
+maxPieces: cap on the length of each game, None for no cap
+evaluator: name of the move finder in MOVEFINDERS
+depth: number of pieces the AI looks ahead, 1 for the greedy AI
+beamWidth: number of boards kept at each step of the lookahead
+cacheEntries: size of the evaluation cache of each worker, 0 for no cache
+hold: True to let the AI hold pieces
+record: directory every game is recorded to as game<seed>.trp, None to record nothing
+telemetry: directory the telemetry of every game is written to as game<seed>.ttl,
+           None for no telemetry
+weights: JSON file of penalty weights written by tetris_tuner.py, None for the built-in weights
+startMethod: how the workers are started, 'fork', 'spawn' or 'forkserver', None for the default
+randomizer: name of the randomizer in tetris.RANDOMIZERS the pieces come from
+sequences: True to draw the piece sequence of every game before the batch
+           starts and share them with the workers, needs maxPieces
+return: list of the playSeed results, in the order the games finished
+'''
+def runBatch(seeds, workers, maxPieces=None, evaluator='python', depth=1, beamWidth=tetris.AIBEAMWIDTH,
+             cacheEntries=0, hold=False, record=None, telemetry=None, weights=None, startMethod=None,
+             randomizer='bag', sequences=False):
+    global SEQUENCES
+    for directory in (record, telemetry):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+    options = {'record': record,
+               'telemetry': telemetry,
+               'randomizer': randomizer,
+               'weights': weights,
+               'maxPieces': maxPieces,
+               'evaluator': evaluator,
+               'depth': depth,
+               'beamWidth': beamWidth,
+               'cacheEntries': cacheEntries,
+               'hold': hold}
+    tasks = [(seed, options) for seed in seeds]
+    shared = None
+    if sequences:
+        # every game draws its first four pieces, one more for every piece
+        # placed and one when it holds for the first time
+        shared = {seed: tetris.generateSequence(tetris.RANDOMIZERS[randomizer](seed), maxPieces + 5) for seed in seeds}
+    if workers == 1:
+        SEQUENCES = shared
+        return [playSeed(task) for task in tasks]
+    pool = multiprocessing.get_context(startMethod).Pool(workers, initWorker, (time.time(), shared))
+    try:
+        return list(pool.imap_unordered(playSeed, tasks, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+'''
+Adds up the results of a batch.
+results: list of the playSeed results
+return: dictionary with the totals, the game length distribution and the
+        pieces per second and cold start of every worker
+'''
+def summarize(results):
+    lengths = [result['pieces'] for result in results]
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(result['pid'], {'games': 0, 'pieces': 0, 'seconds': 0.0,
+                                                    'startup': result['startup'], 'imports': result['imports']})
+        worker['games'] += 1
+        worker['pieces'] += result['pieces']
+        worker['seconds'] += result['seconds']
+        # the cache counters only grow, so the last game of a worker has its totals
+        worker['cache'] = result['cache']
+    for worker in workers.values():
+        worker['piecesPerSecond'] = worker['pieces'] / worker['seconds'] if worker['seconds'] else 0.0
+    return {'games': len(results),
+            'lines': sum(result['lines'] for result in results),
+            'pieces': sum(lengths),
+            'lost': sum(1 for result in results if result['gameOver']),
+            'length': {'min': min(lengths),
+                       'p25': tetris.percentile(lengths, 0.25),
+                       'median': tetris.percentile(lengths, 0.5),
+                       'p75': tetris.percentile(lengths, 0.75),
+                       'max': max(lengths),
+                       'mean': sum(lengths) / float(len(lengths))},
+            'workers': workers}
+
+'''
+Prints the summary of a batch.
+summary: the result of summarize
+seconds: wall clock time of the whole batch
+'''
+def printSummary(summary, seconds):
+    print('Games played:   %d (%d lost)' % (summary['games'], summary['lost']))
+    print('Lines cleared:  %d' % summary['lines'])
+    print('Pieces placed:  %d' % summary['pieces'])
+    length = summary['length']
+    print('Game length:    min %d  p25 %d  median %d  p75 %d  max %d  mean %.1f' %
+          (length['min'], length['p25'], length['median'], length['p75'], length['max'], length['mean']))
+    print('Wall time:      %.2fs (%.0f pieces/s overall)' % (seconds, summary['pieces'] / seconds if seconds else 0.0))
+    for pid in sorted(summary['workers']):
+        worker = summary['workers'][pid]
+        cache = ''
+        if worker['cache'] is not None:
+            cache = '  cache %d hits %d misses %d evictions' % (worker['cache']['hits'], worker['cache']['misses'], worker['cache']['evictions'])
+        print('Worker %-8d %4d games %8d pieces %9.0f pieces/s  ready after %.0f ms (imports %.0f ms)%s' %
+              (pid, worker['games'], worker['pieces'], worker['piecesPerSecond'], worker['startup'] * 1000.0,
+               worker['imports'] * 1000.0, cache))
+
+def main():
+    parser = argparse.ArgumentParser(description='Play seeded Tetris AI games in a process pool.')
+    parser.add_argument('--games', type=int, default=100, help='number of games to play')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, the others follow')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('--max-pieces', type=int, default=None, help='stop each game after this many pieces')
+    parser.add_argument('--evaluator', choices=sorted(MOVEFINDERS), default='python',
+                        help='evaluate the candidates one at a time or all at once with numpy')
+    parser.add_argument('--depth', type=int, default=1, help='pieces of the preview queue to look ahead through')
+    parser.add_argument('--beam', type=int, default=tetris.AIBEAMWIDTH, help='boards kept at each step of the lookahead')
+    parser.add_argument('--cache-entries', type=int, default=0,
+                        help='boards each worker remembers the penalty of during the lookahead, 0 for none')
+    parser.add_argument('--hold', action='store_true', help='let the AI hold pieces')
+    parser.add_argument('--record', metavar='DIR', help='record every game to DIR, see tetris_replay.py')
+    parser.add_argument('--start-method', choices=multiprocessing.get_all_start_methods(), default=None,
+                        help='how the worker processes are started, the platform default when not given')
+    parser.add_argument('--randomizer', choices=sorted(tetris.RANDOMIZERS), default='bag',
+                        help='the 7-bag of the game, or every shape drawn on its own')
+    parser.add_argument('--sequences', action='store_true',
+                        help='draw the pieces of every game before the batch starts, needs --max-pieces')
+    parser.add_argument('--weights', metavar='PATH', help='play with the penalty weights of this tetris_tuner.py file')
+    parser.add_argument('--telemetry', metavar='DIR', help='write the telemetry of every game to DIR, see tetris_telemetry.py')
+    args = parser.parse_args()
+    if args.sequences and args.max_pieces is None:
+        parser.error('--sequences needs --max-pieces')
+    if args.record and args.randomizer != 'bag':
+        parser.error('replays only work with the bag randomizer')
+    if args.record and (args.seed < 0 or args.seed + args.games > tetris_replay.REPLAYSEEDS):
+        parser.error('replays can only record seeds from 0 to %d' % (tetris_replay.REPLAYSEEDS - 1))
+
+    start = time.perf_counter()
+    results = runBatch(range(args.seed, args.seed + args.games), args.workers, args.max_pieces, args.evaluator,
+                       args.depth, args.beam, args.cache_entries, args.hold, args.record, args.telemetry, args.weights, args.start_method,
+                       args.randomizer, args.sequences)
+    printSummary(summarize(results), time.perf_counter() - start)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+################################################################################
+# Benchmark suite for the Tetris engine and AI
+# Times the engine primitives on a fixed corpus of seeded board positions
+# (boards from AI games, and tall, hole-ridden boards from random play), and
+# the pieces per second of a whole headless AI game. The results are written as
+# JSON and can be compared against the JSON of an earlier run, to catch engine
+# changes that make things slower.
+#
+# Example: python tetris_bench.py --output bench_baseline.json
+#          python tetris_bench.py --baseline bench_baseline.json
+################################################################################
+
+import argparse, json, platform, random, sys, time
+
+import tetris_brogan_edit as tetris
+
+# Kinds of board positions in the corpus, built in this order for every seed
+CORPUSKINDS = ('ai', 'random', 'tall')
+
+'''
+Plays a game with a move finder until it has placed a number of pieces, or
+until the next move would lose the game.
+seed: seed of the game
+pieces: number of pieces to place
+chooseMove: function of the game returning (column, rotation)
+return: the GameState, still going
+'''
+def playUntil(seed, pieces, chooseMove):
+    game = tetris.GameState(seed)
+    while game.piecesPlaced < pieces:
+        column, rotation = chooseMove(game)
+        trial = game.copy()
+        trial.place(rotation, column)
+        if trial.gameOver:
+            break
+        game = trial
+    return game
+
+'''
+Builds the corpus of board positions the primitives are timed on. The same
+seed always gives the same corpus:
+    ai      the AI played between 10 and 200 pieces, low and clean boards
+    random  random placements, ragged boards full of holes
+    tall    random placements until the stack is at least 14 rows high
+seed: seed of the corpus
+size: number of positions of every kind
+return: list of (kind, board, piece) with piece the falling piece
+'''
+def buildCorpus(seed, size):
+    rng = random.Random(seed)
+    def randomMove(game):
+        placements = list(tetris.generatePlacements(game.board, game.fallingPiece.shape))
+        if not placements:
+            return game.fallingPiece.x, game.fallingPiece.rotation
+        shape, rotation, x, y = rng.choice(placements)
+        return x + tetris.PIECEGEOMETRY[shape][rotation]['minX'], rotation
+    def aiMove(game):
+        return tetris.findBestMove(game.board, game.fallingPiece)
+    corpus = []
+    for i in range(size):
+        gameSeed = rng.randrange(2 ** 32)
+        game = playUntil(gameSeed, rng.randint(10, 200), aiMove)
+        corpus.append(('ai', game.board, game.fallingPiece))
+        game = playUntil(gameSeed, rng.randint(10, 60), randomMove)
+        corpus.append(('random', game.board, game.fallingPiece))
+        game = tetris.GameState(gameSeed)
+        while max(game.board.heights) < 14:
+            trial = game.copy()
+            column, rotation = randomMove(trial)
+            trial.place(rotation, column)
+            if trial.gameOver:
+                break
+            game = trial
+        corpus.append(('tall', game.board, game.fallingPiece))
+    return corpus
+
+'''
+Every placement of the falling piece of every position, as pieces.
+corpus: the corpus
+return: list of (board, piece)
+'''
+def placedPieces(corpus):
+    items = []
+    for kind, board, piece in corpus:
+        for shape, rotation, x, y in tetris.generatePlacements(board, piece.shape):
+            placed = piece.copy()
+            placed.rotation, placed.x, placed.y = rotation, x, y
+            items.append((board, placed))
+    return items
+
+# The setup of every benchmark builds the work items from the corpus (not timed,
+# done again before every repeat since some primitives change the board), the
+# run goes through them (timed). The number of items is the number of operations.
+
+def setupValidPosition(corpus):
+    items = []
+    for board, piece in placedPieces(corpus):
+        items.append((board, piece, 0))
+        items.append((board, piece, 1)) # one row lower collides, the case the drop loop ends on
+    return items
+
+def runValidPosition(items):
+    isValidPosition = tetris.isValidPosition
+    for board, piece, adjY in items:
+        isValidPosition(board, piece, adjY=adjY)
+
+def setupAddToBoard(corpus):
+    return [(board.copy(), piece) for board, piece in placedPieces(corpus)]
+
+def runAddToBoard(items):
+    addToBoard = tetris.addToBoard
+    for board, piece in items:
+        addToBoard(board, piece)
+
+def setupRemoveCompleteLines(corpus):
+    items = setupAddToBoard(corpus)
+    runAddToBoard(items)
+    return [board for board, piece in items]
+
+def runRemoveCompleteLines(items):
+    removeCompleteLines = tetris.removeCompleteLines
+    for board in items:
+        removeCompleteLines(board)
+
+def setupBoards(corpus):
+    return [board for kind, board, piece in corpus]
+
+def runRealHeightPenalty(items):
+    calcRealHeightPenalty = tetris.calcRealHeightPenalty
+    for board in items:
+        calcRealHeightPenalty(board)
+
+def runHolePenalty(items):
+    calcHolePenalty = tetris.calcHolePenalty
+    for board in items:
+        calcHolePenalty(board)
+
+def runPenalty(items):
+    calcPenalty = tetris.calcPenalty
+    for board in items:
+        calcPenalty(board)
+
+def runExtractFeatures(items):
+    extractFeatures = tetris.extractFeatures
+    for board in items:
+        extractFeatures(board)
+
+def setupNewLocation(corpus):
+    items = []
+    for kind, board, piece in corpus:
+        for rotation in range(tetris.PIECEROTATIONS[piece.shape]):
+            for column in range(tetris.BOARDWIDTH):
+                items.append((column, piece.copy(), rotation, board))
+    return items
+
+def runNewLocation(items):
+    findNewLocationForPiece = tetris.findNewLocationForPiece
+    for column, piece, rotation, board in items:
+        findNewLocationForPiece(column, piece, rotation, board)
+
+def setupBestMove(corpus):
+    return [(board, piece) for kind, board, piece in corpus]
+
+def runBestMove(items):
+    findBestMove = tetris.findBestMove
+    for board, piece in items:
+        findBestMove(board, piece)
+
+def runPlacements(items):
+    generatePlacements = tetris.generatePlacements
+    for board, piece in items:
+        for placement in generatePlacements(board, piece.shape):
+            pass
+
+def runReachablePlacements(items):
+    generateReachablePlacements = tetris.generateReachablePlacements
+    for board, piece in items:
+        for placement in generateReachablePlacements(board, piece):
+            pass
+
+def runBestMoveReachable(items):
+    findBestMoveReachable = tetris.findBestMoveReachable
+    for board, piece in items:
+        findBestMoveReachable(board, piece)
+
+# (name, setup, run) of every benchmark, in the order they are printed
+BENCHMARKS = [
+    ('isValidPosition', setupValidPosition, runValidPosition),
+    ('addToBoard', setupAddToBoard, runAddToBoard),
+    ('removeCompleteLines', setupRemoveCompleteLines, runRemoveCompleteLines),
+    ('calcRealHeightPenalty', setupBoards, runRealHeightPenalty),
+    ('calcHolePenalty', setupBoards, runHolePenalty),
+    ('calcPenalty', setupBoards, runPenalty),
+    ('extractFeatures', setupBoards, runExtractFeatures),
+    ('findNewLocationForPiece', setupNewLocation, runNewLocation),
+    ('findBestMove', setupBestMove, runBestMove),
+    ('generatePlacements', setupBestMove, runPlacements),
+    ('generateReachablePlacements', setupBestMove, runReachablePlacements),
+    ('findBestMoveReachable', setupBestMove, runBestMoveReachable),
+]
+
+'''
+Times one benchmark, keeping the fastest of the repeats since the slower ones
+only measure what else the computer was doing.
+corpus: the corpus
+setup: builds the work items from the corpus
+run: goes through the work items
+repeats: number of times the benchmark is timed
+return: dictionary with the operations per repeat and the microseconds per operation
+'''
+def timeBenchmark(corpus, setup, run, repeats):
+    best = None
+    for i in range(repeats):
+        items = setup(corpus)
+        start = time.perf_counter()
+        run(items)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return {'ops': len(items), 'usPerOp': best * 1e6 / len(items) if items else 0.0}
+
+'''
+Counts what the reachability search finds on the corpus compared to the
+straight drops, per position.
+corpus: the corpus
+return: dictionary with the mean drop placements, reachable placements, reachable
+        placements that aren't drops (slides and tucks), drops that can't be
+        reached, and states searched
+'''
+def countReachability(corpus):
+    totals = {'drops': 0, 'reachable': 0, 'tucks': 0, 'unreachable': 0, 'states': 0}
+    for kind, board, piece in corpus:
+        drops = set(tetris.generatePlacements(board, piece.shape))
+        stats = {}
+        reachable = set(placement[:4] for placement in tetris.generateReachablePlacements(board, piece, stats))
+        totals['drops'] += len(drops)
+        totals['reachable'] += len(reachable)
+        totals['tucks'] += len(reachable - drops)
+        totals['unreachable'] += len(drops - reachable)
+        totals['states'] += stats['states']
+    return {name: total / float(len(corpus)) for name, total in totals.items()}
+
+'''
+Times whole headless AI games with the greedy AI.
+seed: seed of the first game, the others follow
+games: number of games
+maxPieces: cap on the length of each game
+return: dictionary with the pieces placed, the seconds and the pieces per second
+'''
+def timeEndToEnd(seed, games, maxPieces):
+    pieces = 0
+    start = time.perf_counter()
+    for gameSeed in range(seed, seed + games):
+        pieces += tetris.playAIGame(gameSeed, maxPieces).piecesPlaced
+    seconds = time.perf_counter() - start
+    return {'pieces': pieces, 'seconds': seconds, 'piecesPerSecond': pieces / seconds if seconds else 0.0}
+
+'''
+Runs the whole suite.
+seed: seed of the corpus and of the end-to-end games
+size: number of positions of every kind in the corpus
+repeats: number of times every benchmark is timed
+games: number of end-to-end games
+maxPieces: cap on the length of each end-to-end game
+return: the results, ready to be written as JSON
+'''
+def runSuite(seed, size, repeats, games, maxPieces):
+    corpus = buildCorpus(seed, size)
+    results = {}
+    for name, setup, run in BENCHMARKS:
+        results[name] = timeBenchmark(corpus, setup, run, repeats)
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seed': seed,
+            'corpus': {kind: sum(1 for entry in corpus if entry[0] == kind) for kind in CORPUSKINDS},
+            'repeats': repeats,
+            'benchmarks': results,
+            'reachability': countReachability(corpus),
+            'endToEnd': timeEndToEnd(seed, games, maxPieces)}
+
+'''
+Compares a run against a baseline run.
+results: the results of runSuite
+baseline: the results of an earlier runSuite, read back from its JSON
+tolerance: how much slower than the baseline a benchmark may be, 0.1 for 10%
+return: list of (name, baseline, current, ratio, regressed) with ratio the
+        time of the current run over the time of the baseline, for the end to
+        end games the pieces per second of the baseline over the current run
+'''
+def compareResults(results, baseline, tolerance):
+    rows = []
+    for name, setup, run in BENCHMARKS:
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['usPerOp']
+        after = results['benchmarks'][name]['usPerOp']
+        ratio = after / before if before else 1.0
+        rows.append((name, before, after, ratio, ratio > 1.0 + tolerance))
+    before = baseline['endToEnd']['piecesPerSecond']
+    after = results['endToEnd']['piecesPerSecond']
+    ratio = before / after if after else 1.0
+    rows.append(('piecesPerSecond', before, after, ratio, ratio > 1.0 + tolerance))
+    return rows
+
+'''
+Prints the results of a run, and the comparison when there is a baseline.
+results: the results of runSuite
+comparison: the result of compareResults, None without a baseline
+'''
+def printResults(results, comparison=None):
+    print('Corpus: %s (seed %d, best of %d)' % (', '.join('%d %s' % (results['corpus'][kind], kind) for kind in CORPUSKINDS),
+                                             results['seed'], results['repeats']))
+    for name, setup, run in BENCHMARKS:
+        result = results['benchmarks'][name]
+        print('%-28s %9d ops %10.3f us/op' % (name, result['ops'], result['usPerOp']))
+    endToEnd = results['endToEnd']
+    print('%-28s %9d pieces %7.0f pieces/s' % ('end to end', endToEnd['pieces'], endToEnd['piecesPerSecond']))
+    reachability = results['reachability']
+    print('Per position: %.1f drops, %.1f reachable placements (%.1f slides and tucks, %.1f drops out of reach), '
+          '%.1f states searched' % (reachability['drops'], reachability['reachable'], reachability['tucks'],
+                                    reachability['unreachable'], reachability['states']))
+    if comparison is None:
+        return
+    print('')
+    print('%-28s %12s %12s %8s' % ('against baseline', 'baseline', 'current', 'ratio'))
+    for name, before, after, ratio, regressed in comparison:
+        print('%-28s %12.3f %12.3f %7.2fx%s' % (name, before, after, ratio, '  SLOWER' if regressed else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Tetris engine primitives and the AI.')
+    parser.add_argument('--seed', type=int, default=2016, help='seed of the board corpus and the end-to-end games')
+    parser.add_argument('--corpus', type=int, default=50, help='board positions of every kind in the corpus')
+    parser.add_argument('--repeats', type=int, default=5, help='times every benchmark is timed, the fastest counts')
+    parser.add_argument('--games', type=int, default=3, help='number of end-to-end AI games')
+    parser.add_argument('--max-pieces', type=int, default=2000, help='cap on the length of each end-to-end game')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a benchmark may be slower than the baseline before it counts as a regression')
+    args = parser.parse_args()
+
+    results = runSuite(args.seed, args.corpus, args.repeats, args.games, args.max_pieces)
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline['seed'] != results['seed'] or baseline['corpus'] != results['corpus']:
+            print('Warning: the baseline was timed on a different corpus')
+        comparison = compareResults(results, baseline, args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2, sort_keys=True)
+    printResults(results, comparison)
+    if comparison is not None and any(row[4] for row in comparison):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
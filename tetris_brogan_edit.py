@@ -26,8 +26,11 @@
 # - changed fall frequency to be fixed rate
 ################################################################################
 
-import random, time, pygame, sys, copy
-from pygame.locals import *
+import random, time, sys, collections, threading, queue, csv, operator
+# pygame is only imported by loadPygame when the game window opens, so the rules ###
+# and the AI can be imported by headless workers without it ###
+pygame = None ###
+numpy = None # only needed by the batched evaluation, imported by loadNumpy ###
 
 FPS = 60
 # The width and height were changed to allow for a bigger game and to allow
@@ -38,13 +41,56 @@ BOXSIZE = 20
 BOARDWIDTH = 10
 BOARDHEIGHT = 20
 BLANK = '.'
+# Bitmask of a row with every column filled, used by the bitboard ###
+FULLROW = (1 << BOARDWIDTH) - 1 ###
 
 MOVESIDEWAYSFREQ = 0.15
 MOVEDOWNFREQ = 0.1
 
+# How far the lookahead goes through the preview queue by default, how many ###
+# boards it keeps at each step and how many seconds the AI may spend on one ###
+# move while the game is drawn ###
+AIDEPTH = 2 ###
+AIBEAMWIDTH = 6 ###
+AITIMEBUDGET = 0.5 / FPS # half a frame, so the game never stalls on the AI ###
+AIBACKGROUNDBUDGET = 0.1 # the background worker has the fall of a piece ###
+# Boards whose penalty the AI remembers, each one takes about 400 bytes ###
+EVALCACHEENTRIES = 100000 ###
+
+# The actions a GameState understands, one per control of the game ###
+MOVELEFT = 'left' ###
+MOVERIGHT = 'right' ###
+ROTATE = 'rotate' ###
+ROTATEBACK = 'rotateback' ###
+SOFTDROP = 'down' ###
+HARDDROP = 'drop' ###
+HOLD = 'hold' ###
+FALL = 'fall' # one step of gravity, moves the piece down or locks it ###
+ACTIONS = (MOVELEFT, MOVERIGHT, ROTATE, ROTATEBACK, SOFTDROP, HARDDROP, HOLD, FALL) ###
+
 XMARGIN = int((WINDOWWIDTH - BOARDWIDTH * BOXSIZE) / 2)
 TOPMARGIN = WINDOWHEIGHT - (BOARDHEIGHT * BOXSIZE) - 5
 
+# Screen areas the Renderer redraws on their own when what they show changed. ###
+# The board area goes up two rows above the board, where new pieces come in. ###
+BOARDREGION = (XMARGIN - 3, TOPMARGIN - 7 - 2 * BOXSIZE, (BOARDWIDTH * BOXSIZE) + 8, (BOARDHEIGHT * BOXSIZE) + 8 + 2 * BOXSIZE) ###
+STATUSREGION = (WINDOWWIDTH - 150, 20, 150, 50) ###
+NEXTREGIONS = [(WINDOWWIDTH - 120, 80, 120, 120), (WINDOWWIDTH - 120, 230, 120, 120), (WINDOWWIDTH - 120, 380, 120, 120)] ###
+HELDREGION = (WINDOWWIDTH - 1000, 80, 120, 120) ###
+HEIGHTREGION = (WINDOWWIDTH - 1000, 250, 330, 25) ###
+HOLEREGION = (WINDOWWIDTH - 1000, 350, 330, 25) ###
+PENALTYREGION = (WINDOWWIDTH - 1000, 450, 330, 25) ###
+AISTATSREGION = (WINDOWWIDTH - 1000, 530, 330, 55) ###
+AIINSTRUCTREGION = (WINDOWWIDTH - 600, 50, 300, 25) ###
+TEXTCACHESIZE = 512 # rendered texts kept, the cache starts over when full ###
+PROFILEREGION = (WINDOWWIDTH - 400, 500, 400, 140) ###
+
+# Parts of a frame the FrameProfiler times, press f in the game to show it ###
+FRAMESTAGES = ('input', 'gravity', 'ai', 'board', 'pieces', 'hud', 'display') ###
+PROFILEFRAMES = 3600 # frames kept by the profiler, one minute at 60 FPS ###
+PROFILEREFRESH = 30 # frames between two updates of the profiler overlay ###
+PROFILECSV = 'frame_profile.csv' # where the profiler writes its frames ###
+
 #               R    G    B
 WHITE       = (255, 255, 255)
 GRAY        = (185, 185, 185)
@@ -74,8 +120,34 @@ COLORS      = (     BLUE,      GREEN,      RED,      YELLOW,      ORANGE,      P
 LIGHTCOLORS = (LIGHTBLUE, LIGHTGREEN, LIGHTRED, LIGHTYELLOW, LIGHTORANGE, LIGHTPURPLE, LIGHTGRAY) ###
 assert len(COLORS) == len(LIGHTCOLORS) # each color must have light color
 
+# The higher the block, the bigger its share of the height penalty. ###
+# ROWHEIGHTPENALTY holds the penalty of one box in each row (top row first). ###
+HEIGHTMULTIPLIERS = [100, 95, 90, 85, 80, 75, 70, 65, 60, 55, 50, 45, 40, 35, 30, 25, 20, 15, 10, 5, 0] ###
+ROWHEIGHTPENALTY = [(BOARDHEIGHT - y) * HEIGHTMULTIPLIERS[y] for y in range(BOARDHEIGHT)] ###
+HOLEPENALTY = 350 # penalty of every hole ###
+
+# The features extractFeatures measures on a board, in the order of its vector, ###
+# followed by the number of boxes in each row (top row first). The board keeps ###
+# the first ones up to date, the SCANNEDFEATURES take a pass over its columns. ###
+BOARDFEATURES = ('aggregateHeight', 'maxHeight', 'holes', 'completedLines', 'bumpiness', ###
+                 'coveredCells', 'rowTransitions', 'columnTransitions', 'wellDepths') ###
+HOLESFEATURE = BOARDFEATURES.index('holes') ###
+SCANNEDFEATURES = slice(BOARDFEATURES.index('bumpiness'), len(BOARDFEATURES)) ###
+FEATURECOUNT = len(BOARDFEATURES) + BOARDHEIGHT ###
+SKIPPEDFEATURES = [0] * (len(BOARDFEATURES) - SCANNEDFEATURES.start) # the SCANNEDFEATURES when they are skipped ###
+FULLCOLUMN = (1 << BOARDHEIGHT) - 1 # column mask with every box filled ###
+FLOORBIT = 1 << BOARDHEIGHT # the floor under a column mask ###
+WALLHEIGHT = BOARDHEIGHT # height of the walls, no column is higher ###
+# The penalties are weighted sums of the feature vector, setWeights keeps these ###
+# in step with HEIGHTMULTIPLIERS and HOLEPENALTY ###
+HEIGHTWEIGHTS = [0] * len(BOARDFEATURES) + ROWHEIGHTPENALTY ###
+HOLEWEIGHTS = [HOLEPENALTY if name == 'holes' else 0 for name in BOARDFEATURES] + [0] * BOARDHEIGHT ###
+PENALTYWEIGHTS = [height + hole for height, hole in zip(HEIGHTWEIGHTS, HOLEWEIGHTS)] ###
+
 TEMPLATEWIDTH = 5
 TEMPLATEHEIGHT = 5
+SPAWNX = int(BOARDWIDTH / 2) - int(TEMPLATEWIDTH / 2) # column new pieces start at ###
+SPAWNY = -2 # row new pieces start at, above the board ###
 
 S_SHAPE_TEMPLATE = [['.....',
                      '.....',
@@ -187,24 +259,109 @@ PIECES = {'S': S_SHAPE_TEMPLATE,
           'O': O_SHAPE_TEMPLATE,
           'T': T_SHAPE_TEMPLATE}
 
+# Pieces carry their shape as its index in PIECESLIST, which indexes straight ###
+# into the tables below; PIECEIDS goes from the letter back to the index ###
 PIECESLIST = list(PIECES.keys())
-RUNNINGLIST = PIECESLIST[:]
-random.shuffle(RUNNINGLIST)
+PIECEIDS = {shape: shapeId for shapeId, shape in enumerate(PIECESLIST)} ###
+PIECESHAPEIDS = list(range(len(PIECESLIST))) ###
+PIECEROTATIONS = [len(PIECES[shape]) for shape in PIECESLIST] ###
+# Position in COLORS of every shape, so different shapes never share a color: ###
+# S red, Z green, J yellow, L blue, I purple, O orange, T gray ###
+PIECECOLORS = [2, 1, 3, 0, 5, 4, 6] ###
+
+'''
+### This entire function was added
+Compiles one rotation of a shape template into the geometry table read by the
+hot paths, so nothing has to scan the 5x5 strings while the game is running.
+template: one rotation of a shape template
+return: dictionary with
+    cells: (x, y) template offsets of the boxes
+    rowMasks: (y, mask) for each template row with boxes, the mask is shifted
+              so bit 0 is the leftmost column of the piece (minX)
+    minX, maxX, minY, maxY: bounding box of the boxes in the template
+    width: number of columns the piece covers
+    bottom: (x, y) lowest box of each column the piece covers
+'''
+def compilePieceGeometry(template):
+    cells = [(x, y) for y in range(TEMPLATEHEIGHT) for x in range(TEMPLATEWIDTH) if template[y][x] != BLANK]
+    minX = min(x for x, y in cells)
+    maxX = max(x for x, y in cells)
+    rowMasks = []
+    for y in sorted(set(y for x, y in cells)):
+        mask = 0
+        for cellX, cellY in cells:
+            if cellY == y:
+                mask |= 1 << (cellX - minX)
+        rowMasks.append((y, mask))
+    bottom = []
+    for x in range(minX, maxX + 1):
+        bottom.append((x, max(cellY for cellX, cellY in cells if cellX == x)))
+    return {'cells': cells,
+            'rowMasks': rowMasks,
+            'minX': minX,
+            'maxX': maxX,
+            'minY': min(y for x, y in cells),
+            'maxY': max(y for x, y in cells),
+            'width': maxX - minX + 1,
+            'bottom': bottom}
+
+# Geometry of every shape and rotation, compiled once at import ###
+PIECEGEOMETRY = [[compilePieceGeometry(template) for template in PIECES[shape]] for shape in PIECESLIST] ###
+
+'''
+### This entire function was added
+Finds the rotations of a shape that cover a different set of boxes, so a
+symmetric rotation (S, Z, I and O look the same turned half way around) is
+only searched once.
+shape: id of the shape
+return: list of the rotation indexes worth searching
+'''
+def findUniqueRotations(shape):
+    rotations = []
+    seen = set()
+    for rotation, geometry in enumerate(PIECEGEOMETRY[shape]):
+        boxes = frozenset((x - geometry['minX'], y - geometry['minY']) for x, y in geometry['cells'])
+        if boxes not in seen:
+            seen.add(boxes)
+            rotations.append(rotation)
+    return rotations
+
+PIECEUNIQUEROTATIONS = [findUniqueRotations(shape) for shape in PIECESHAPEIDS] ###
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT, BIGFONT
+    setupDisplay() ###
+
+    showTextScreen('Tetromino')
+    while True: # game loop
+        runGame()
+        showTextScreen('Game Over')
+
+'''
+### This entire function was added
+Imports pygame, the first time it is called. Only the game window needs it.
+return: the pygame module
+'''
+def loadPygame():
+    global pygame
+    if pygame is None:
+        import pygame
+    return pygame
+
+'''
+### This entire function was added
+Opens the window and loads the fonts, the part of main the replay viewer needs too.
+'''
+def setupDisplay():
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, BIGFONT, SMALLFONT
+    loadPygame()
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
     DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
     BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
     BIGFONT = pygame.font.Font('freesansbold.ttf', 100)
+    SMALLFONT = pygame.font.Font('freesansbold.ttf', 14)
     pygame.display.set_caption('Tetromino')
 
-    showTextScreen('Tetromino')
-    while True: # game loop
-        runGame()
-        showTextScreen('Game Over')
-
 '''
 ORIGINAL
 Runs the game
@@ -212,185 +369,390 @@ return: when game over
 '''
 def runGame():
     # setup variables for the start of the game
-    board = getBlankBoard()
+    # The rules live in the GameState, this loop only turns key presses and
+    # the clock into its actions and draws it. ###
+    game = GameState() ###
     lastMoveDownTime = time.time()
     lastMoveSidewaysTime = time.time()
     lastFallTime = time.time()
     movingDown = False # note: there is no movingUp variable
     movingLeft = False
     movingRight = False
-    score = 0
-    level, fallFreq = calculateLevelAndFallFreq(score)
-
-    # Initialize pieces.
-    fallingPiece = getNewPiece()
-    nextPiece = getNewPiece()
-    nextPiece2 = getNewPiece()
-    nextPiece3 = getNewPiece()
-
-    # Sets heldPiece and tempPiece to False, used in holding a piece.
-    heldPiece = False ###
-    tempPiece = False ###
+    level, fallFreq = calculateLevelAndFallFreq(game.score)
+    piecesPlaced = -1 ###
     aiBoolean = False ###
+    searcher = AnytimeSearch() ###
+    renderer = Renderer() ###
+    worker = AIWorker() # searches the next move while the current piece falls ###
+    profiler = None # FrameProfiler while the profiler is on ###
 
     while True: # game loop
-        if fallingPiece == None:
-            # No falling piece in play, so start a new piece at the top
-            # When a piece is placed, it sets the fallingPiece equal to the
-            # nextPiece and nextPiece equal to the piece after until it reaches
-            # the 3rd piece after the fallingPiece, which it creates a new piece,
-            # this allows for the current piece and next three pieces to be known
-            # to the program and user.
-            fallingPiece = nextPiece  ###
-            nextPiece = nextPiece2 ###
-            nextPiece2 = nextPiece3 ###
-            # BROGAN EDIT 
-            nextPiece3 = getNewPiece()
+        if profiler is not None: ###
+            profiler.startFrame() ###
+        if game.gameOver:
+            worker.stop() ###
+            if profiler is not None: ###
+                profiler.writeCSV(PROFILECSV) ###
+            return # can't fit a new piece on the board, so game over
+
+        if game.piecesPlaced != piecesPlaced: ###
+            # A new piece came in at the top, the current piece and next three
+            # pieces are known to the program and user.
+            piecesPlaced = game.piecesPlaced ###
             lastFallTime = time.time() # reset lastFallTime
 
             if aiBoolean == True:
-                bestMove = findBestMove(board, fallingPiece)
-                findNewLocationForPiece(bestMove[0], fallingPiece, bestMove[1], board)
-
-            if not isValidPosition(board, fallingPiece):
-                return # can't fit a new piece on the board, so game over
+                moveWithAI(game, searcher, worker) ###
+                if game.gameOver: ###
+                    worker.stop() ###
+                    if profiler is not None: ###
+                        profiler.writeCSV(PROFILECSV) ###
+                    return # the AI held and brought in a piece that doesn't fit
+        if profiler is not None: ###
+            profiler.mark('ai') ###
 
         checkForQuit()
         for event in pygame.event.get(): # event handling loop
-            if event.type == KEYUP:
-                if (event.key == K_p):
+            if event.type == pygame.KEYUP:
+                if (event.key == pygame.K_p):
                     # Pausing the game
                     #DISPLAYSURF.fill(BGCOLOR)
                     pygame.mixer.music.stop()
                     showTextScreen('Paused') # pause until a key press
                     pygame.mixer.music.play(-1, 0.0)
+                    renderer.invalidate() # the pause text covered the game ###
+                    if profiler is not None: ###
+                        profiler.startFrame() # the pause isn't part of the frame ###
                     lastFallTime = time.time()
                     lastMoveDownTime = time.time()
                     lastMoveSidewaysTime = time.time()
-                elif (event.key == K_LEFT or event.key == K_a):
+                elif (event.key == pygame.K_LEFT or event.key == pygame.K_a):
                     movingLeft = False
-                elif (event.key == K_RIGHT or event.key == K_d):
+                elif (event.key == pygame.K_RIGHT or event.key == pygame.K_d):
                     movingRight = False
-                elif (event.key == K_DOWN or event.key == K_s):
+                elif (event.key == pygame.K_DOWN or event.key == pygame.K_s):
                     movingDown = False
                 # This allows for a block to be held if c or h is pressed
                 # it will store the held piece in the heldPiece variable and
                 # make the fallingPiece the nextPiece and so on if there is no
                 # current heldPiece. If there is a piece in heldPiece it will
                 # swap it with the fallingPiece.
-                elif (event.key == K_c or event.key == K_h): ###
-                    if (heldPiece == False): ###
-                        heldPiece = fallingPiece ###
-                        fallingPiece = nextPiece  ###
-                        nextPiece = nextPiece2 ###
-                        nextPiece2 = nextPiece3 ###
-                        # BROGAN EDIT
-                        nextPiece3 = getNewPiece() ###
-                        fallingPiece['y'] = -2 ###
-                    else:
-                        tempPiece = heldPiece ###
-                        heldPiece = fallingPiece ###
-                        fallingPiece = tempPiece ###
-                        fallingPiece['y'] = -2 ###
-
-            elif event.type == KEYDOWN:
+                elif (event.key == pygame.K_c or event.key == pygame.K_h): ###
+                    game.step(HOLD) ###
+
+            elif event.type == pygame.KEYDOWN:
                 # moving the piece sideways
-                if (event.key == K_LEFT or event.key == K_a) and isValidPosition(board, fallingPiece, adjX=-1):
-                    fallingPiece['x'] -= 1
+                if (event.key == pygame.K_LEFT or event.key == pygame.K_a) and isValidPosition(game.board, game.fallingPiece, adjX=-1):
+                    game.step(MOVELEFT)
                     movingLeft = True
                     movingRight = False
                     lastMoveSidewaysTime = time.time()
 
-                elif (event.key == K_RIGHT or event.key == K_d) and isValidPosition(board, fallingPiece, adjX=1):
-                    fallingPiece['x'] += 1
+                elif (event.key == pygame.K_RIGHT or event.key == pygame.K_d) and isValidPosition(game.board, game.fallingPiece, adjX=1):
+                    game.step(MOVERIGHT)
                     movingRight = True
                     movingLeft = False
                     lastMoveSidewaysTime = time.time()
 
                 # rotating the piece (if there is room to rotate)
-                elif (event.key == K_UP or event.key == K_w):
-                    fallingPiece['rotation'] = (fallingPiece['rotation'] + 1) % len(PIECES[fallingPiece['shape']])
-                    if not isValidPosition(board, fallingPiece):
-                        fallingPiece['rotation'] = (fallingPiece['rotation'] - 1) % len(PIECES[fallingPiece['shape']])
-                elif (event.key == K_q): # rotate the other direction
-                    fallingPiece['rotation'] = (fallingPiece['rotation'] - 1) % len(PIECES[fallingPiece['shape']])
-                    if not isValidPosition(board, fallingPiece):
-                        fallingPiece['rotation'] = (fallingPiece['rotation'] + 1) % len(PIECES[fallingPiece['shape']])
+                elif (event.key == pygame.K_UP or event.key == pygame.K_w):
+                    game.step(ROTATE)
+                elif (event.key == pygame.K_q): # rotate the other direction
+                    game.step(ROTATEBACK)
 
                 # making the piece fall faster with the down key
-                elif (event.key == K_DOWN or event.key == K_s):
+                elif (event.key == pygame.K_DOWN or event.key == pygame.K_s):
                     movingDown = True
-                    if isValidPosition(board, fallingPiece, adjY=1):
-                        fallingPiece['y'] += 1
+                    game.step(SOFTDROP)
                     lastMoveDownTime = time.time()
 
                 # Runs the AI code, can be toggled on and off
-                elif event.key == K_i: ###
+                elif event.key == pygame.K_i: ###
                     aiBoolean = not(aiBoolean) ###
-                    bestMove = findBestMove(board, fallingPiece) ###
-                    findNewLocationForPiece(bestMove[0], fallingPiece, bestMove[1], board) ###
+                    if profiler is not None: ###
+                        profiler.mark('input') ###
+                    moveWithAI(game, searcher, worker) ###
+                    if profiler is not None: ###
+                        profiler.mark('ai') ###
+
+                # Shows the frame profiler, pressing f again writes its ###
+                # frames to PROFILECSV and hides it ###
+                elif event.key == pygame.K_f: ###
+                    if profiler is None: ###
+                        profiler = FrameProfiler() ###
+                        profiler.startFrame() ###
+                    else: ###
+                        profiler.writeCSV(PROFILECSV) ###
+                        profiler = None ###
 
                 # move the current piece all the way down
-                elif event.key == K_SPACE:
+                elif event.key == pygame.K_SPACE:
                     movingDown = False
                     movingLeft = False
                     movingRight = False
-                    for i in range(1, BOARDHEIGHT):
-                        if not isValidPosition(board, fallingPiece, adjY=i):
-                            break
-                    fallingPiece['y'] += i - 1
+                    game.step(HARDDROP)
+
+            if game.gameOver: ###
+                worker.stop() ###
+                if profiler is not None: ###
+                    profiler.writeCSV(PROFILECSV) ###
+                return # holding brought in a piece that doesn't fit
+        if profiler is not None: ###
+            profiler.mark('input') ###
 
         # handle moving the piece because of user input
         if (movingLeft or movingRight) and time.time() - lastMoveSidewaysTime > MOVESIDEWAYSFREQ:
-            if movingLeft and isValidPosition(board, fallingPiece, adjX=-1):
-                fallingPiece['x'] -= 1
-            elif movingRight and isValidPosition(board, fallingPiece, adjX=1):
-                fallingPiece['x'] += 1
+            if movingLeft:
+                game.step(MOVELEFT)
+            elif movingRight:
+                game.step(MOVERIGHT)
             lastMoveSidewaysTime = time.time()
 
-        if movingDown and time.time() - lastMoveDownTime > MOVEDOWNFREQ and isValidPosition(board, fallingPiece, adjY=1):
-            fallingPiece['y'] += 1
+        if movingDown and time.time() - lastMoveDownTime > MOVEDOWNFREQ and isValidPosition(game.board, game.fallingPiece, adjY=1):
+            game.step(SOFTDROP)
             lastMoveDownTime = time.time()
 
         # let the piece fall if it is time to fall
         if time.time() - lastFallTime > fallFreq:
-            # see if the piece has landed
-            if not isValidPosition(board, fallingPiece, adjY=1):
-                # falling piece has landed, set it on the board
-                addToBoard(board, fallingPiece)
-                score += removeCompleteLines(board)
-                level, fallFreq = calculateLevelAndFallFreq(score)
-                fallingPiece = None
-            else:
-                # piece did not land, just move the piece down
-                fallingPiece['y'] += 1
-                lastFallTime = time.time()
-
-        # drawing everything on the screen
-        DISPLAYSURF.fill(BGCOLOR)
-        drawBoard(board)
-        drawStatus(score, level)
+            # the piece either moves down or lands and is set on the board
+            game.step(FALL) ###
+            level, fallFreq = calculateLevelAndFallFreq(game.score)
+            lastFallTime = time.time()
+        if profiler is not None: ###
+            profiler.mark('gravity') ###
+
+        # drawing only what changed on the screen, the rest of the screen ###
+        # is left as it was drawn on an earlier frame ###
+        boardKey = tuple(game.board.rows) ###
+        fallingKey = None if game.gameOver else pieceKey(game.fallingPiece) ###
+        if renderer.changed('board', (boardKey, fallingKey), BOARDREGION): ###
+            drawBoard(game.board)
+            # If the game is still going, then it draws the falling piece to the board
+            if not game.gameOver: ###
+                drawPiece(game.fallingPiece) ###
+        if profiler is not None: ###
+            profiler.mark('board') ###
+        if renderer.changed('status', (game.score, game.level), STATUSREGION): ###
+            drawStatus(game.score, game.level)
         # The draw nextPiece1-3 draw the next three piece to the board so the
         # user can see them
-        drawNextPiece(nextPiece) ###
-        drawNextPiece2(nextPiece2) ###
-        drawNextPiece3(nextPiece3) ###
+        if renderer.changed('next', pieceKey(game.queue[0]), NEXTREGIONS[0]): ###
+            drawNextPiece(game.queue[0]) ###
+        if renderer.changed('next2', pieceKey(game.queue[1]), NEXTREGIONS[1]): ###
+            drawNextPiece2(game.queue[1]) ###
+        if renderer.changed('next3', pieceKey(game.queue[2]), NEXTREGIONS[2]): ###
+            drawNextPiece3(game.queue[2]) ###
+        # If there is a piece held, then it draws it to the board
+        heldKey = None if game.heldPiece is None else pieceKey(game.heldPiece) ###
+        if renderer.changed('held', heldKey, HELDREGION) and heldKey is not None: ###
+            drawHeldPiece(game.heldPiece) ###
+        if profiler is not None: ###
+            profiler.mark('pieces') ###
         # The drawHeight, drawHole, and drawPenalty draw the number associated with
         # the current height, hole, and total penalty to the board for the user
-        # to see
-        drawHeight(board) ###
-        drawHole(board) ###
-        drawPenalty(board) ###
-        drawArtificialIntelligenceInstruct(board) ###
-        # If there is a piece held, then it draws it to the board
-        if heldPiece != False: ###
-            drawHeldPiece(heldPiece) ###
-        # If there is a fallingPiece, then it draws it to the board
-        if fallingPiece != None: ###
-            drawPiece(fallingPiece) ###
-
-        pygame.display.update()
+        # to see, they only change when the board does
+        if renderer.changed('height', boardKey, HEIGHTREGION): ###
+            drawHeight(game.board) ###
+        if renderer.changed('hole', boardKey, HOLEREGION): ###
+            drawHole(game.board) ###
+        if renderer.changed('penalty', boardKey, PENALTYREGION): ###
+            drawPenalty(game.board) ###
+        if renderer.changed('instruct', True, AIINSTRUCTREGION): ###
+            drawArtificialIntelligenceInstruct(game.board) ###
+        if renderer.changed('aistats', (searcher.exhausted, searcher.searches, worker.hits, worker.misses), AISTATSREGION): ###
+            drawAIStats(searcher, worker) ###
+        profilerKey = None if profiler is None else profiler.frameCount // PROFILEREFRESH ###
+        if renderer.changed('profiler', profilerKey, PROFILEREGION) and profiler is not None: ###
+            drawProfiler(profiler) ###
+        if profiler is not None: ###
+            profiler.mark('hud') ###
+
+        renderer.update() ###
         FPSCLOCK.tick(FPS)
+        if profiler is not None: ###
+            profiler.mark('display') ###
+            profiler.endFrame() ###
+
+'''
+### This entire class was added
+Frame time profiler of runGame. Every frame is split in the stages of
+FRAMESTAGES: handling the input, letting the piece fall and lock, the AI
+search, drawing the board, drawing the next and held pieces, drawing the HUD
+texts, and updating the display and waiting for the clock. Every stage is timed
+from the end of the stage before it, so the stages add up to the frame.
+maxFrames: how many of the last frames are kept
+'''
+class FrameProfiler(object):
+    def __init__(self, maxFrames=PROFILEFRAMES):
+        self.frames = collections.deque(maxlen=maxFrames)
+        # frames ended so far, it keeps counting when the oldest frames are
+        # dropped from frames
+        self.frameCount = 0
+        self.current = None
+        self.last = None
+
+    '''
+    Starts timing a new frame.
+    '''
+    def startFrame(self):
+        self.current = dict.fromkeys(FRAMESTAGES, 0.0)
+        self.last = time.perf_counter()
+
+    '''
+    Adds the time since the last mark to a stage of the frame.
+    stage: one of FRAMESTAGES
+    '''
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.current[stage] += now - self.last
+        self.last = now
+
+    '''
+    Ends the frame and keeps its times.
+    '''
+    def endFrame(self):
+        self.current['total'] = sum(self.current[stage] for stage in FRAMESTAGES)
+        self.frames.append(self.current)
+        self.frameCount += 1
+        self.current = None
+
+    '''
+    stage: one of FRAMESTAGES, or 'total' for the whole frame
+    return: the 50th, 95th and 99th percentile of the stage, in milliseconds
+    '''
+    def percentiles(self, stage='total'):
+        values = [frame[stage] * 1000.0 for frame in self.frames]
+        if not values:
+            return 0.0, 0.0, 0.0
+        return percentile(values, 0.50), percentile(values, 0.95), percentile(values, 0.99)
+
+    '''
+    Writes one line per frame with the seconds of every stage to a CSV file.
+    path: path of the CSV file
+    '''
+    def writeCSV(self, path):
+        columns = list(FRAMESTAGES) + ['total']
+        with open(path, 'w', newline='') as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(['frame'] + columns)
+            for i, frame in enumerate(self.frames):
+                writer.writerow([i] + ['%.6f' % frame[column] for column in columns])
+
+'''
+### This entire class was added
+Background AI worker. While the current piece is still falling, the worker
+thread already searches the move of the next piece on the board the current
+move is predicted to leave. When that piece comes in the answer is waiting in
+the results queue. If the piece locked somewhere else (the player moved it) the
+board doesn't match the prediction, the answer is thrown away and the move is
+searched again in the game loop.
+searcher: the AnytimeSearch the worker thread searches with
+'''
+class AIWorker(object):
+    def __init__(self, searcher=None):
+        if searcher is None:
+            searcher = AnytimeSearch(timeBudget=AIBACKGROUNDBUDGET)
+        self.searcher = searcher
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.pendingKey = None
+        self.hits = 0
+        self.misses = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    '''
+    Body of the worker thread: searches every predicted game it is sent until
+    it gets None.
+    '''
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            key, game = request
+            move = self.searcher.search(game.board, game.fallingPiece, game.queue, game.heldPiece)
+            self.results.put((key, move))
+
+    '''
+    Predicts the game after the move of the falling piece and sends it to the
+    worker thread, which searches the move of the piece after it.
+    game: the game being played
+    move: the column, rotation and hold flag chosen for the falling piece
+    '''
+    def prefetch(self, game, move):
+        column, rotation, useHold = move
+        predicted = game.copy()
+        predicted.place(rotation, column, useHold)
+        if predicted.gameOver:
+            self.pendingKey = None
+            return
+        self.pendingKey = predicted.searchKey()
+        self.requests.put((self.pendingKey, predicted))
+
+    '''
+    Takes the answer of the worker thread for the game as it really is.
+    game: the game being played
+    timeout: seconds to wait for the worker thread when it is still searching,
+             moveWithAI takes the wait out of the budget of its own search
+    return: the column, rotation and hold flag, None when the prediction was
+            wrong or the worker wasn't done in time and the move has to be
+            searched again
+    '''
+    def getMove(self, game, timeout=AITIMEBUDGET):
+        key = game.searchKey()
+        if key == self.pendingKey:
+            deadline = time.perf_counter() + timeout
+            while True:
+                try:
+                    resultKey, move = self.results.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if resultKey == key:
+                    self.pendingKey = None
+                    self.hits += 1
+                    return move
+        self.pendingKey = None
+        self.misses += 1
+        return None
+
+    '''
+    Stops the worker thread once it has finished its current search.
+    '''
+    def stop(self):
+        self.requests.put(None)
+
+'''
+### This entire function was added
+Lets the AI play the falling piece: it holds the piece when the lookahead finds
+that better, then drops the piece into the chosen column and rotation.
+game: the GameState being played
+searcher: the AnytimeSearch keeping the AI within its time budget
+worker: optional AIWorker, its answer is used when it predicted this piece
+        right, and it is sent the next piece to search while this one falls.
+        The time spent waiting for it comes out of the budget of searcher
+The game is over afterwards when holding brought in a piece that doesn't fit,
+callers have to check game.gameOver before stepping the game again.
+'''
+def moveWithAI(game, searcher, worker=None):
+    move = None
+    start = time.perf_counter()
+    if worker is not None:
+        # waiting for the worker and searching again share one budget, so a
+        # miss doesn't stall the frame for two
+        move = worker.getMove(game, AITIMEBUDGET if searcher.timeBudget is None else searcher.timeBudget)
+    if move is None:
+        move = searcher.search(game.board, game.fallingPiece, game.queue, game.heldPiece,
+                               spent=time.perf_counter() - start)
+    if worker is not None:
+        worker.prefetch(game, move)
+    column, rotation, useHold = move
+    if useHold:
+        game.step(HOLD)
+        if game.gameOver:
+            return
+    findNewLocationForPiece(column, game.fallingPiece, rotation, game.board)
 
 '''
 ORIGINAL
@@ -420,8 +782,8 @@ Grab KEYDOWN events to remove them from the event queue.
 def checkForKeyPress():
     checkForQuit()
 
-    for event in pygame.event.get([KEYDOWN, KEYUP]):
-        if event.type == KEYDOWN:
+    for event in pygame.event.get([pygame.KEYDOWN, pygame.KEYUP]):
+        if event.type == pygame.KEYDOWN:
             continue
         return event.key
     return None
@@ -456,10 +818,10 @@ ORIGINAL
 Ends game if a quit event is found
 '''
 def checkForQuit():
-    for event in pygame.event.get(QUIT): # get all the QUIT events
+    for event in pygame.event.get(pygame.QUIT): # get all the QUIT events
         terminate() # terminate if any QUIT events are present
-    for event in pygame.event.get(KEYUP): # get all the KEYUP events
-        if event.key == K_ESCAPE:
+    for event in pygame.event.get(pygame.KEYUP): # get all the KEYUP events
+        if event.key == pygame.K_ESCAPE:
             terminate() # terminate if the KEYUP event was for the Esc key
         pygame.event.post(event) # put the other KEYUP event objects back
 
@@ -477,79 +839,210 @@ def calculateLevelAndFallFreq(score):
     fallFreq = 0.005 # ORIGINAL = 0.25 - (LEVEL * 0.02) ### BROGAN EDIT
     return level, fallFreq
 '''
-ADDED BROGAN EDIT
-Checks if the current running list has less than 3 pieces in it, if so
-calls bagGenerator to add more pieces to the running list.
-Pops the next shape from the running list and returns it as the next
-piece.
+### This entire class was added
+A piece: its shape (the id of the shape, its index in PIECESLIST), rotation,
+position of its template on the board and color. The attributes are slots, so
+a piece is smaller than a dictionary and quicker to make and copy, and the AI
+and GameState.copy make a lot of them.
+shape: id of the shape
+rotation: the rotation
+x: column of the left side of the template
+y: row of the top of the template
+color: position of the color in COLORS
+'''
+class Piece(object):
+    __slots__ = ('shape', 'rotation', 'x', 'y', 'color')
+
+    def __init__(self, shape, rotation, x, y, color):
+        self.shape = shape
+        self.rotation = rotation
+        self.x = x
+        self.y = y
+        self.color = color
+
+    '''
+    return: an independent copy of the piece
+    '''
+    def copy(self):
+        # skips __init__, a copy is made for every piece of every GameState.copy
+        other = object.__new__(Piece)
+        other.shape = self.shape
+        other.rotation = self.rotation
+        other.x = self.x
+        other.y = self.y
+        other.color = self.color
+        return other
+
+    def __repr__(self):
+        return 'Piece(%s, rotation=%d, x=%d, y=%d)' % (PIECESLIST[self.shape], self.rotation, self.x, self.y)
+
+'''
+### This entire function was added
+Builds the piece of a shape at the top of the board.
+shape: id of the shape
+rotation: the rotation it comes in with
 return: new piece object
 '''
-def getNewPiece():
-
-    if (len(RUNNINGLIST) < 3):
-        bagGenerator(RUNNINGLIST)
-    shape = RUNNINGLIST.pop(0)
+def makePiece(shape, rotation):
+    return Piece(shape, rotation, SPAWNX, SPAWNY, PIECECOLORS[shape])
+
+'''
+### This entire class was added
+The 7-bag randomizer of the game, with its own seeded random generator. It
+makes the same random calls in the same order as the running list it replaced
+(a shuffled bag whenever less than 3 shapes are left, then the rotation of
+every piece), so a seed gives the same pieces it always did and old replays
+still play. The bag is a deque, taking a shape doesn't shift the others.
+seed: seed of the random generator, None for a random one
+'''
+class BagRandomizer(object):
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.bag = collections.deque()
+
+    '''
+    return: (shape, rotation) of the next piece
+    '''
+    def next(self):
+        if len(self.bag) < 3:
+            bagGenerator(self.bag, self.random)
+        shape = self.bag.popleft()
+        return shape, self.random.randint(0, PIECEROTATIONS[shape] - 1)
+
+    '''
+    return: an independent copy that draws the same pieces from here on
+    '''
+    def copy(self):
+        other = BagRandomizer.__new__(BagRandomizer)
+        other.random = random.Random()
+        other.random.setstate(self.random.getstate())
+        other.bag = collections.deque(self.bag)
+        return other
+
+'''
+### This entire class was added
+Memoryless randomizer: every shape is drawn on its own, so the same shape can
+come many times in a row or not at all for a long time, like the first Tetris
+games did. Much harder for the AI than the 7-bag.
+seed: seed of the random generator, None for a random one
+'''
+class UniformRandomizer(object):
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    '''
+    return: (shape, rotation) of the next piece
+    '''
+    def next(self):
+        shape = self.random.choice(PIECESHAPEIDS)
+        return shape, self.random.randint(0, PIECEROTATIONS[shape] - 1)
+
+    '''
+    return: an independent copy that draws the same pieces from here on
+    '''
+    def copy(self):
+        other = UniformRandomizer.__new__(UniformRandomizer)
+        other.random = random.Random()
+        other.random.setstate(self.random.getstate())
+        return other
+
+'''
+### This entire class was added
+Plays back a piece sequence made by generateSequence, one byte per piece. The
+bytes aren't copied, so one sequence can be shared by many games (and sent to
+a worker process once), and every game reads it from its own position.
+sequence: bytes of the sequence
+position: index of the first piece to play
+'''
+class SequenceRandomizer(object):
+    def __init__(self, sequence, position=0):
+        self.sequence = sequence
+        self.position = position
+
+    '''
+    return: (shape, rotation) of the next piece
+    '''
+    def next(self):
+        if self.position >= len(self.sequence):
+            raise ValueError('the piece sequence ran out after %d pieces' % len(self.sequence))
+        code = self.sequence[self.position]
+        self.position += 1
+        return code & 7, code >> 3
+
+    '''
+    return: a copy that reads the same sequence from the same position
+    '''
+    def copy(self):
+        return SequenceRandomizer(self.sequence, self.position)
+
+# The randomizers a game can be seeded with, by name ###
+RANDOMIZERS = {'bag': BagRandomizer, 'uniform': UniformRandomizer} ###
 
-    newPiece = {'shape': shape,
-                'rotation': random.randint(0, len(PIECES[shape]) -1),
-                'x': int(BOARDWIDTH / 2) - int(TEMPLATEWIDTH / 2),
-                'y': -2,
-                'color': getPieceColor(shape)}
-    return newPiece
+'''
+### This entire function was added
+Draws a piece sequence ahead of time, one byte per piece: the shape id in the
+low 3 bits and the rotation above them.
+randomizer: the randomizer to draw from, like BagRandomizer(seed)
+count: number of pieces
+return: the sequence as bytes, for SequenceRandomizer
+'''
+def generateSequence(randomizer, count):
+    sequence = bytearray(count)
+    for i in range(count):
+        shape, rotation = randomizer.next()
+        sequence[i] = shape | rotation << 3
+    return bytes(sequence)
 '''
 ADDED BROGAN EDIT
 Creates a "bag" of the 7 tetrominoes as defined here:
 http://tetris.wikia.com/wiki/Random_Generator
-lis: RUNNINGLIST passed
+lis: the bag of a BagRandomizer
+rng: the random generator to shuffle with ###
 '''
-def bagGenerator(lis):
-    temp = PIECESLIST[:]
-    random.shuffle(temp)
+def bagGenerator(lis, rng=random):
+    temp = PIECESHAPEIDS[:] ###
+    rng.shuffle(temp)
     for index in temp:
         lis.append(index)
     return
 '''
-### This entire function was added 
-Added this function to make sure that different shaped pieces don't generate 
-with the same color.
-shape: the shape
-return: the corresponding color value
-'''
-def getPieceColor(shape):
-    # The integer values 0..6 represent the position of each color in the COLOR list.
-    if shape == 'S':
-        # Red
-        return 2
-    elif shape == 'Z':
-        # Green
-        return 1
-    elif shape == 'L':
-        # Blue
-        return 0
-    elif shape == 'J':
-        # Yellow
-        return 3
-    elif shape == 'I':
-        # Purple
-        return 5
-    elif shape == 'O':
-        # Orange
-        return 4
-    elif shape == 'T':
-        # Gray
-        return 6
-'''
 ORIGINAL
 fill in the board based on piece's location, shape, and rotation
 board: the board
 piece: the piece to be added
 '''
 def addToBoard(board, piece):
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            if y + piece['y'] >= 0:
-                if PIECES[piece['shape']][piece['rotation']][y][x] != BLANK:
-                    board[x + piece['x']][y + piece['y']] = piece['color']
+    addShapeToBoard(board, piece.shape, piece.rotation, piece.x, piece.y, piece.color)
+
+'''
+### This entire function was added
+Locks a shape on the board without needing a Piece, used by the
+search so it doesn't have to build one for every candidate placement.
+board: the board
+shape: the shape
+rotation: the rotation of the shape
+x: x location of the template
+y: y location of the template
+color: the color of the boxes, not needed when the board has no color plane
+'''
+def addShapeToBoard(board, shape, rotation, x, y, color=None):
+    rows = board.rows
+    colors = board.colors
+    columnMasks = board.columnMasks
+    rowFill = board.rowFill
+    geometry = PIECEGEOMETRY[shape][rotation]
+    for cellX, cellY in geometry['cells']:
+        boardX = cellX + x
+        boardY = cellY + y
+        if boardY >= 0:
+            rows[boardY] |= 1 << boardX
+            rowFill[boardY] = countBits(rows[boardY])
+            columnMasks[boardX] |= 1 << boardY
+            if colors is not None:
+                colors[boardX][boardY] = color
+    # only the columns the piece covers can change height or holes
+    for boardX in range(geometry['minX'] + x, geometry['maxX'] + x + 1):
+        board.updateColumn(boardX)
 
 '''
 ORIGINAL
@@ -557,78 +1050,188 @@ create and return a new blank board data structure
 return: a blank board
 '''
 def getBlankBoard():
-    board = []
-    for i in range(BOARDWIDTH):
-        board.append([BLANK] * BOARDHEIGHT)
-    return board
+    return Board()
+
+'''
+### This entire class was added
+Bitboard version of the board. Every row is kept as an int mask with bit x set
+when column x is filled, so collision checks, locking a piece and clearing
+lines are a few bitwise operations per row instead of string compares per cell.
+The colors are kept in a separate plane, indexed [x][y] like the original list
+of columns, and are only read when drawing. Indexing the board itself
+(board[x][y]) reads the color plane, so the drawing code is unchanged.
+
+The board also keeps the statistics the penalties need up to date whenever a
+piece is locked or a line is cleared, so evaluating a board never has to
+rescan its cells.
+rows: list of BOARDHEIGHT row masks, top row first
+colors: list of BOARDWIDTH columns holding BLANK or a color index, None for
+        copies made by the search
+columnMasks: list of BOARDWIDTH column masks, bit y set when (x, y) is filled
+heights: height of each column, 0 for an empty column
+holes: number of empty boxes under the top of each column
+rowFill: number of filled boxes in each row
+'''
+class Board(object):
+    __slots__ = ('rows', 'colors', 'columnMasks', 'heights', 'holes', 'rowFill')
+
+    def __init__(self):
+        self.rows = [0] * BOARDHEIGHT
+        self.colors = [[BLANK] * BOARDHEIGHT for x in range(BOARDWIDTH)]
+        self.columnMasks = [0] * BOARDWIDTH
+        self.heights = [0] * BOARDWIDTH
+        self.holes = [0] * BOARDWIDTH
+        self.rowFill = [0] * BOARDHEIGHT
+
+    def __getitem__(self, x):
+        return self.colors[x]
+
+    def __len__(self):
+        return BOARDWIDTH
+
+    '''
+    Much cheaper than copy.deepcopy, only the lists need to be copied.
+    withColors: False to leave out the color plane, which the search never
+                reads and is the most expensive part to copy
+    return: an independent copy of the board
+    '''
+    def copy(self, withColors=True):
+        board = Board.__new__(Board)
+        board.rows = self.rows[:]
+        if withColors and self.colors is not None:
+            board.colors = [column[:] for column in self.colors]
+        else:
+            board.colors = None
+        board.columnMasks = self.columnMasks[:]
+        board.heights = self.heights[:]
+        board.holes = self.holes[:]
+        board.rowFill = self.rowFill[:]
+        return board
+
+    '''
+    Recomputes the height and hole count of a column from its mask. The top
+    box is the lowest set bit, every empty box under it is a hole.
+    x: the column that changed
+    '''
+    def updateColumn(self, x):
+        mask = self.columnMasks[x]
+        if mask:
+            height = BOARDHEIGHT - ((mask & -mask).bit_length() - 1)
+            self.heights[x] = height
+            self.holes[x] = height - countBits(mask)
+        else:
+            self.heights[x] = 0
+            self.holes[x] = 0
+
+'''
+### This entire function was added
+Counts the boxes in a row or column mask.
+mask: the mask
+return: the number of set bits
+'''
+def countBits(mask):
+    return bin(mask).count('1')
+
+if hasattr(int, 'bit_count'): ###
+    countBits = int.bit_count ###
+
+'''
+### This entire function was added
+Measures the features of a board, so a heuristic that uses several of them
+doesn't scan the board once per feature. The column masks, heights and hole
+counts the board keeps up to date give most of them, the SCANNEDFEATURES take
+one pass over the columns:
+    aggregateHeight    sum of the column heights
+    maxHeight          height of the highest column
+    holes              empty boxes under the top of their column
+    completedLines     full rows
+    bumpiness          sum of the height differences of neighboring columns
+    coveredCells       filled boxes above a hole, counted once per hole under them
+    rowTransitions     filled/empty changes along the rows, the walls are filled
+    columnTransitions  filled/empty changes down the columns, the floor is filled
+    wellDepths         how far each column is below both of its neighbors (its
+                       only neighbor at the walls), summed
+followed by the number of boxes in each row, top row first.
+board: the board
+weights: the weights the vector is for, the pass over the columns is skipped
+         (and the SCANNEDFEATURES left at 0) when none of them are weighted.
+         None measures everything
+return: list of the FEATURECOUNT features, in the order of BOARDFEATURES
+'''
+def extractFeatures(board, weights=None):
+    heights = board.heights
+    rowFill = board.rowFill
+    features = [sum(heights), max(heights), sum(board.holes), rowFill.count(BOARDWIDTH)]
+    if weights is not None and not any(weights[SCANNEDFEATURES]):
+        features.extend(SKIPPEDFEATURES)
+        features.extend(rowFill)
+        return features
+    full = FULLCOLUMN
+    covered = 0
+    rowTransitions = 0
+    columnTransitions = 0
+    previousMask = full # the left wall
+    for mask, columnHoles in zip(board.columnMasks, board.holes):
+        rowTransitions += countBits(previousMask ^ mask)
+        previousMask = mask
+        floored = mask | FLOORBIT
+        columnTransitions += countBits((floored ^ (floored >> 1)) & full)
+        if columnHoles:
+            # every hole is covered by the boxes of its column above it
+            top = mask & -mask
+            empty = full & ~mask & ~(top - 1)
+            while empty:
+                hole = empty & -empty
+                covered += countBits(mask & (hole - 1))
+                empty ^= hole
+    rowTransitions += countBits(previousMask ^ full) # the right wall
+    bumpiness = sum(map(abs, map(operator.sub, heights[1:], heights[:-1])))
+    # no column is higher than the walls, so the edge columns only count
+    # their one neighbor
+    walled = [WALLHEIGHT] + heights + [WALLHEIGHT]
+    wells = 0
+    for left, height, right in zip(walled, heights, walled[2:]):
+        lowest = left if left < right else right
+        if lowest > height:
+            wells += lowest - height
+    features.extend((bumpiness, covered, rowTransitions, columnTransitions, wells))
+    features.extend(rowFill)
+    return features
+
+'''
+### This entire function was added
+Weighted sum of a feature vector, every heuristic of the AI is one.
+features: the extractFeatures of a board
+weights: one weight per feature, like PENALTYWEIGHTS
+return: the sum
+'''
+def weightedSum(features, weights):
+    return sum(map(operator.mul, features, weights))
+
 '''
 ### This entire function was added
 This function calculates the height penalty. The height penalty is a number
 that is given for how high the blocks are on the board and for each space up
 to that given height.
+Not used by the AI since calcRealHeightPenalty replaced it. It gives what it
+always did (blank boxes times the row index, from the top of the stack or the
+second row from the bottom, whichever is higher), from the features instead
+of three scans of the board.
 board: the current board
 return: the height penalty
 '''
 def calcHeightPenalty(board):
-    # Declare variables and set equal to 0
-    blockCount = 0
-    block = 0
-    periodCount = 0
-    height = 0
-    heightCount = []
-    newPeriodCount = 0
+    features = extractFeatures(board)
+    # The stack starts at the highest box, or at the second row from the
+    # bottom when it is lower than that.
+    height = min(BOARDHEIGHT - features[BOARDFEATURES.index('maxHeight')], BOARDHEIGHT - 2)
+    rowFill = features[len(BOARDFEATURES):]
+    # Every blank box from there down counts its row index, so the rows
+    # lower on the board weigh the most.
     penalty = 0
-    curPenalty = 0
-    tempPenalty = 0
-    # Runs through the board and counts the number of blank spaces
-    for x in range (0,20):
-        for y in range (0,10):
-            if board[y][x] == '.':
-                periodCount = periodCount + 1
-            blockCount = 200 - periodCount
-        if blockCount != 0:
-            heightCount.insert(0,x)
-    # If the board is not blank then it runs through the board to find a block,
-    # if a block is found then it adds the height of that block to a list.
-    if periodCount != 200:
-        for x in range (0,20):
-            for y in range (0,10):
-                if board[y][x] != '.':
-                    block = block + 1
-            if block != 0:
-                heightCount.insert(0,x)
-                block = 0
-
-    # Removes the height input when the board is blank or has a height less than
-    # the two bottom rows, this allows for a basic height penalty to be established
-    # with the lowest height being the second row from the bottom.
-    for z in range (0,18):
-        heightCount.remove(z)
-
-    # The height is determined by the lowest number in the list because the highest,
-    # value is the bottom of the board. This occurs because the board is generated
-    # top down.
-    height = min(heightCount)
-    # Runs through the board starting at the heighest point from the bottom of the
-    # board and counts the number of blank spots in a row
-    for a in range(height,20):
-        for b in range (0,10):
-            if board[b][a] == '.':
-                newPeriodCount = newPeriodCount + 1
-        # The penalty is the number of blank spots in that row multiplied by
-        # the column value. This allows for the blanks spots at the bottom of
-        # to have the highest value (19) and a blank spot on the second from bottom
-        # ro to have 18 and so on up the board. This will allow for the search
-        # function to find the best place to place a block by selecting the
-        # placement that reduces the penalty the most (The spot lowest on the board).
-        penalty = newPeriodCount * a
-        # Each row penalty is added together to find the total height penalty.
-        curPenalty = curPenalty + penalty
-        newPeriodCount = 0
-        tempPenalty = curPenalty
-
-    # Returns the total height penalty
-    return tempPenalty
+    for a in range(height, BOARDHEIGHT):
+        penalty += (BOARDWIDTH - rowFill[a]) * a
+    return penalty
 '''
 ### 
 BROGAN EDIT 7/3/2018
@@ -639,13 +1242,26 @@ board: the current board
 return: the height penalty
 '''
 def calcRealHeightPenalty(board):
-    heightMultipliers = [100, 95, 90, 85, 80, 75, 70, 65, 60, 55, 50, 45, 40, 35, 30, 25, 20, 15, 10, 5, 0]
-    hPenalty = 0
-    for y in range (0,20):
-        for x in range (0,10):
-            if board[x][y] != ".":
-                hPenalty += (20 - y) * heightMultipliers[y]
-    return hPenalty
+    # Each box counts the penalty of its row, which is the weight of the
+    # box count of that row in HEIGHTWEIGHTS. ###
+    return weightedSum(extractFeatures(board, HEIGHTWEIGHTS), HEIGHTWEIGHTS)
+'''
+### This entire function was added
+Changes the weights of the penalties every evaluator uses, for the weight
+tuner. EvaluationCaches filled with the old weights have to be cleared.
+heightMultipliers: the HEIGHTMULTIPLIERS, one per row top row first
+holePenalty: the penalty of every hole
+'''
+def setWeights(heightMultipliers, holePenalty):
+    global HOLEPENALTY
+    HEIGHTMULTIPLIERS[:] = heightMultipliers
+    # changed in place, the evaluators and numpy path read the same list
+    ROWHEIGHTPENALTY[:] = [(BOARDHEIGHT - y) * HEIGHTMULTIPLIERS[y] for y in range(BOARDHEIGHT)]
+    HOLEPENALTY = holePenalty
+    HEIGHTWEIGHTS[len(BOARDFEATURES):] = ROWHEIGHTPENALTY
+    HOLEWEIGHTS[HOLESFEATURE] = holePenalty
+    PENALTYWEIGHTS[:] = [height + hole for height, hole in zip(HEIGHTWEIGHTS, HOLEWEIGHTS)]
+
 '''
 ### This entire function was added
 This function calculates the hole penalty. The hole penalty is a value that
@@ -655,32 +1271,9 @@ board: the current board
 return: the hole penalty
 '''
 def calcHolePenalty(board):
-    # Declare variables
-    holeCount = 0
-    holePenalty = 0
-    tempY = 0
-    # Runs through the board to find blank spaces
-    for y in range (0,20):
-        for x in range (0,10):
-            # If the space is blank it runs through a while loop checking to
-            # see if there is block somewhere in the current column above the
-            # blank space.
-            if board[x][y] == '.':
-                tempY = y
-                while (tempY != 0):
-                    tempY = tempY - 1
-                    # If there is a block in the column above the blank space,
-                    # then it adds 1 to the hole counter.
-                    if board[x][tempY] != '.':
-                        holeCount = holeCount + 1
-                        tempY = 0
-
-    # The total hole penalty is the number of holes multiplied by 150, this gives
-    # each hole a penalty value of 150.
-    holePenalty = holeCount * 350
-
-    # Returns the total hole penalty
-    return holePenalty
+    # The total hole penalty is the number of holes multiplied by HOLEPENALTY,
+    # this gives each hole a penalty value of HOLEPENALTY (350).
+    return weightedSum(extractFeatures(board, HOLEWEIGHTS), HOLEWEIGHTS)
     
 '''
 ### This entire function was added
@@ -689,14 +1282,67 @@ board: the current board
 return: the total penalty
 '''
 def calcPenalty(board):
-    # Sets height and hole equal to their respective penalties
-    height = calcRealHeightPenalty(board)
-    hole = calcHolePenalty(board)
-
-    # The total penalty is the height penalty plus the hole penalty
-    penalty = height + hole 
-
-    return penalty
+    # The total penalty is the height penalty plus the hole penalty, one
+    # weighted sum of the features with both of their weights ###
+    return weightedSum(extractFeatures(board, PENALTYWEIGHTS), PENALTYWEIGHTS)
+
+'''
+### This entire class was added
+Transposition table for board evaluations. The search reaches the same board
+over and over (different move orders in the lookahead, the same stack in
+another game), so the penalty of a board is remembered under its row masks,
+which identify the boxes exactly. When the table is full the least recently
+used board is forgotten.
+maxEntries: the most boards kept, each one takes about 400 bytes
+'''
+class EvaluationCache(object):
+    def __init__(self, maxEntries=EVALCACHEENTRIES):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    '''
+    calcPenalty, computed only the first time a board is seen.
+    board: the board to evaluate
+    return: the total penalty of the board
+    '''
+    def penalty(self, board):
+        key = tuple(board.rows)
+        entries = self.entries
+        penalty = entries.get(key)
+        if penalty is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return penalty
+        self.misses += 1
+        penalty = calcPenalty(board)
+        entries[key] = penalty
+        if len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return penalty
+
+    '''
+    Forgets every board, for example after the evaluation weights changed.
+    '''
+    def clear(self):
+        self.entries.clear()
+
+    '''
+    return: dictionary with the size, hits, misses, evictions and hit rate
+    '''
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': self.hits / float(lookups) if lookups else 0.0}
 
 '''
 ORIGINAL
@@ -718,15 +1364,17 @@ adjY: y offset
 return: status of piece on board
 '''
 def isValidPosition(board, piece, adjX=0, adjY=0):
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            isAboveBoard = y + piece['y'] + adjY < 0
-            if isAboveBoard or PIECES[piece['shape']][piece['rotation']][y][x] == BLANK:
-                continue
-            if not isOnBoard(x + piece['x'] + adjX, y + piece['y'] + adjY):
-                return False
-            if board[x + piece['x'] + adjX][y + piece['y'] + adjY] != BLANK:
-                return False
+    geometry = PIECEGEOMETRY[piece.shape][piece.rotation]
+    left = piece.x + adjX + geometry['minX']
+    top = piece.y + adjY
+    # the extents replace the isOnBoard check of every box
+    if left < 0 or left + geometry['width'] > BOARDWIDTH or top + geometry['maxY'] >= BOARDHEIGHT:
+        return False
+    rows = board.rows
+    for y, mask in geometry['rowMasks']:
+        # boxes above the board never collide
+        if y + top >= 0 and rows[y + top] & (mask << left):
+            return False
     return True
 
 '''
@@ -737,10 +1385,7 @@ y: the line in question
 return: status
 '''
 def isCompleteLine(board, y):
-    for x in range(BOARDWIDTH):
-        if board[x][y] == BLANK:
-            return False
-    return True
+    return board.rows[y] == FULLROW
 
 '''
 ORIGINAL
@@ -750,25 +1395,250 @@ board: the current board
 return: the number of lines removed
 '''
 def removeCompleteLines(board):
-    numLinesRemoved = 0
-    y = BOARDHEIGHT - 1 # start y at the bottom of the board
-    while y >= 0:
-        if isCompleteLine(board, y):
-            # Remove the line and pull boxes down by one line.
-            for pullDownY in range(y, 0, -1):
+    rows = board.rows
+    remaining = [row for row in rows if row != FULLROW]
+    numLinesRemoved = BOARDHEIGHT - len(remaining)
+    if numLinesRemoved:
+        # Drop the full rows and add blank rows at the very top, the colors
+        # of every column are pulled down the same way.
+        keep = [row != FULLROW for row in rows]
+        if board.colors is not None:
+            for column in board.colors:
+                column[:] = [BLANK] * numLinesRemoved + [column[y] for y in range(BOARDHEIGHT) if keep[y]]
+        board.rowFill[:] = [0] * numLinesRemoved + [board.rowFill[y] for y in range(BOARDHEIGHT) if keep[y]]
+        # Remove the bit of each full row from the column masks, going down
+        # so the indexes of the rows still to be removed don't move.
+        columnMasks = board.columnMasks
+        for y in range(BOARDHEIGHT):
+            if not keep[y]:
+                above = (1 << y) - 1
                 for x in range(BOARDWIDTH):
-                    board[x][pullDownY] = board[x][pullDownY-1]
-            # Set very top line to blank.
-            for x in range(BOARDWIDTH):
-                board[x][0] = BLANK
-            numLinesRemoved += 1
-            # Note on the next iteration of the loop, y is the same.
-            # This is so that if the line that was pulled down is also
-            # complete, it will be removed.
-        else:
-            y -= 1 # move on to check next row up
+                    mask = columnMasks[x]
+                    columnMasks[x] = (mask & ~(above | (1 << y))) | ((mask & above) << 1)
+        for x in range(BOARDWIDTH):
+            board.updateColumn(x)
+        rows[:] = [0] * numLinesRemoved + remaining
     return numLinesRemoved
 
+'''
+### This entire function was added
+Finds where a shape dropped straight down from the top of the board stops,
+using the column heights instead of moving it down one row at a time.
+board: the current board
+shape: the shape
+rotation: the rotation of the shape
+x: x location of the template
+return: y location of the template when it lands
+'''
+def getLandingY(board, shape, rotation, x):
+    heights = board.heights
+    y = BOARDHEIGHT
+    for cellX, cellY in PIECEGEOMETRY[shape][rotation]['bottom']:
+        landing = BOARDHEIGHT - heights[cellX + x] - 1 - cellY
+        if landing < y:
+            y = landing
+    return y
+
+'''
+### This entire class was added
+The rules of the game on their own: board, piece queue, held piece, score and
+level. Nothing here touches pygame or the clock, gravity is just another
+action, so the game can be played as fast as the computer allows (for the AI)
+or driven by runGame in real time.
+seed: seed of the random generator of this game, None for a random game
+randomizer: where the pieces come from, a BagRandomizer of the seed when None
+'''
+class GameState(object):
+    def __init__(self, seed=None, randomizer=None):
+        if randomizer is None:
+            randomizer = BagRandomizer(seed)
+        self.randomizer = randomizer
+        self.board = getBlankBoard()
+        self.score = 0
+        self.level = calculateLevelAndFallFreq(self.score)[0]
+        self.piecesPlaced = 0
+        self.gameOver = False
+        self.heldPiece = None
+        self.fallingPiece = self.newPiece()
+        # the next three pieces, shown to the player
+        self.queue = [self.newPiece() for i in range(3)]
+
+    '''
+    The randomizer is copied too, so the copy draws the same pieces.
+    return: an independent copy of the game
+    '''
+    def copy(self):
+        game = GameState.__new__(GameState)
+        game.randomizer = self.randomizer.copy()
+        game.board = self.board.copy()
+        game.score = self.score
+        game.level = self.level
+        game.piecesPlaced = self.piecesPlaced
+        game.gameOver = self.gameOver
+        game.heldPiece = None if self.heldPiece is None else self.heldPiece.copy()
+        game.fallingPiece = self.fallingPiece.copy()
+        game.queue = [piece.copy() for piece in self.queue]
+        return game
+
+    '''
+    What the AI needs to know about the game to choose a move: the board, the
+    falling piece, the queue and the held piece.
+    return: a hashable key, equal for games the AI would play the same way
+    '''
+    def searchKey(self):
+        return (tuple(self.board.rows),
+                self.fallingPiece.shape,
+                tuple(piece.shape for piece in self.queue),
+                None if self.heldPiece is None else self.heldPiece.shape)
+
+    '''
+    return: a new piece from the randomizer of this game
+    '''
+    def newPiece(self):
+        shape, rotation = self.randomizer.next()
+        return makePiece(shape, rotation)
+
+    '''
+    Makes the first piece of the queue the falling piece. The game is over
+    when it doesn't fit on the board.
+    '''
+    def spawnPiece(self):
+        self.fallingPiece = self.queue.pop(0)
+        self.queue.append(self.newPiece())
+        if not isValidPosition(self.board, self.fallingPiece):
+            self.gameOver = True
+
+    '''
+    Sets the falling piece on the board, clears the complete lines and brings
+    in the next piece. Locking a piece with boxes still above the board ends
+    the game.
+    return: the number of lines cleared
+    '''
+    def lockPiece(self):
+        piece = self.fallingPiece
+        addToBoard(self.board, piece)
+        lines = removeCompleteLines(self.board)
+        self.score += lines
+        self.level = calculateLevelAndFallFreq(self.score)[0]
+        self.piecesPlaced += 1
+        if piece.y + PIECEGEOMETRY[piece.shape][piece.rotation]['minY'] < 0:
+            # the boxes above the board would be lost, so the stack topped out
+            self.gameOver = True
+        else:
+            self.spawnPiece()
+        return lines
+
+    '''
+    Applies one of the ACTIONS to the falling piece, the same way the keys of
+    the game do.
+    action: one of ACTIONS
+    return: the number of lines cleared, only a FALL onto the stack can clear lines
+    '''
+    def step(self, action):
+        if self.gameOver:
+            raise ValueError('the game is over')
+        board = self.board
+        piece = self.fallingPiece
+        rotations = PIECEROTATIONS[piece.shape]
+        if action == MOVELEFT:
+            if isValidPosition(board, piece, adjX=-1):
+                piece.x -= 1
+        elif action == MOVERIGHT:
+            if isValidPosition(board, piece, adjX=1):
+                piece.x += 1
+        elif action == ROTATE or action == ROTATEBACK:
+            turn = 1 if action == ROTATE else -1
+            piece.rotation = (piece.rotation + turn) % rotations
+            if not isValidPosition(board, piece):
+                piece.rotation = (piece.rotation - turn) % rotations
+        elif action == SOFTDROP:
+            if isValidPosition(board, piece, adjY=1):
+                piece.y += 1
+        elif action == HARDDROP:
+            # moves the piece all the way down, it locks on the next FALL
+            while isValidPosition(board, piece, adjY=1):
+                piece.y += 1
+        elif action == HOLD:
+            # Stores the falling piece, the held piece (or the next piece when
+            # nothing is held yet) takes its place at the top of the board.
+            if self.heldPiece is None:
+                self.heldPiece = piece
+                self.spawnPiece()
+            else:
+                # the held piece still has the position it was held at, it
+                # comes back at the spawn position before it is checked
+                self.heldPiece, self.fallingPiece = piece, self.heldPiece
+                self.fallingPiece.x = SPAWNX
+                self.fallingPiece.y = SPAWNY
+                if not isValidPosition(board, self.fallingPiece):
+                    self.gameOver = True
+        elif action == FALL:
+            if not isValidPosition(board, piece, adjY=1):
+                return self.lockPiece()
+            piece.y += 1
+        else:
+            raise ValueError('unknown action %r' % (action,))
+        return 0
+
+    '''
+    The shape place() puts on the board: the falling piece, or with hold the
+    held piece (the next piece when nothing is held yet).
+    hold: True when the piece is held first
+    return: id of the shape
+    '''
+    def placedShape(self, hold=False):
+        if not hold:
+            return self.fallingPiece.shape
+        if self.heldPiece is not None:
+            return self.heldPiece.shape
+        return self.queue[0].shape
+
+    '''
+    Drops the falling piece straight down in the given rotation and column and
+    locks it, the way the AI plays.
+    rotation: rotation of the piece
+    column: leftmost column of the piece, as in findNewLocationForPiece
+    hold: True to swap the piece with the held piece first, the rotation and
+          column are then those of the piece coming out of hold
+    return: the number of lines cleared
+    '''
+    def place(self, rotation, column, hold=False):
+        if self.gameOver:
+            raise ValueError('the game is over')
+        if hold:
+            self.step(HOLD)
+            if self.gameOver:
+                return 0
+        piece = self.fallingPiece
+        geometry = PIECEGEOMETRY[piece.shape][rotation]
+        if column < 0 or column + geometry['width'] > BOARDWIDTH:
+            raise ValueError('column %d is off the board for this rotation' % column)
+        piece.rotation = rotation
+        piece.x = column - geometry['minX']
+        piece.y = getLandingY(self.board, piece.shape, rotation, piece.x)
+        return self.lockPiece()
+
+    '''
+    Plays the inputs of a placement made by generateReachablePlacements and
+    locks the piece where they leave it, the way a player would.
+    inputs: the actions, they have to leave the piece resting on the stack
+    hold: True to swap the piece with the held piece first, the inputs are
+          then those of the piece coming out of hold
+    return: the number of lines cleared
+    '''
+    def playInputs(self, inputs, hold=False):
+        if self.gameOver:
+            raise ValueError('the game is over')
+        if hold:
+            self.step(HOLD)
+            if self.gameOver:
+                return 0
+        for action in inputs:
+            self.step(action)
+        if isValidPosition(self.board, self.fallingPiece, adjY=1):
+            raise ValueError('the inputs leave the piece in the air')
+        return self.step(FALL)
+
 '''
 ORIGINAL
 Convert the given xy coordinates of the board to xy coordinates 
@@ -792,8 +1662,8 @@ def drawBox(boxx, boxy, color, pixelx=None, pixely=None):
         return
     if pixelx == None and pixely == None:
         pixelx, pixely = convertToPixelCoords(boxx, boxy)
-    pygame.draw.rect(DISPLAYSURF, COLORS[color], (pixelx + 1, pixely + 1, BOXSIZE - 1, BOXSIZE - 1))
-    pygame.draw.rect(DISPLAYSURF, LIGHTCOLORS[color], (pixelx + 1, pixely + 1, BOXSIZE - 4, BOXSIZE - 4))
+    # the two rectangles of a box are drawn once per color, then blitted ###
+    DISPLAYSURF.blit(getBoxSprite(color), (pixelx + 1, pixely + 1))
 
 '''
 ORIGINAL
@@ -801,14 +1671,126 @@ draw the border around the board
 board: the board
 '''
 def drawBoard(board):
-    pygame.draw.rect(DISPLAYSURF, BORDERCOLOR, (XMARGIN - 3, TOPMARGIN - 7, (BOARDWIDTH * BOXSIZE) + 8, (BOARDHEIGHT * BOXSIZE) + 8), 5)
+    # the border and the background of the board come from one cached surface ###
+    DISPLAYSURF.blit(getBoardBackground(), (XMARGIN - 3, TOPMARGIN - 7))
+    # draw the individual boxes on the board, only the filled ones ###
+    colors = board.colors
+    for y in range(BOARDHEIGHT):
+        row = board.rows[y]
+        if row:
+            for x in range(BOARDWIDTH):
+                if row >> x & 1:
+                    drawBox(x, y, colors[x][y])
 
-    # fill the background of the board
-    pygame.draw.rect(DISPLAYSURF, BGCOLOR, (XMARGIN, TOPMARGIN, BOXSIZE * BOARDWIDTH, BOXSIZE * BOARDHEIGHT))
-    # draw the individual boxes on the board
-    for x in range(BOARDWIDTH):
-        for y in range(BOARDHEIGHT):
-            drawBox(x, y, board[x][y])
+'''
+### This entire function was added
+Pre-renders the box of one color the way drawBox used to draw it with two
+rectangles, the first time that color is drawn.
+color: index of the color in COLORS
+return: the box surface
+'''
+def getBoxSprite(color):
+    sprite = BOXSPRITES.get(color)
+    if sprite is None:
+        sprite = pygame.Surface((BOXSIZE - 1, BOXSIZE - 1))
+        sprite.fill(COLORS[color])
+        pygame.draw.rect(sprite, LIGHTCOLORS[color], (0, 0, BOXSIZE - 4, BOXSIZE - 4))
+        BOXSPRITES[color] = sprite
+    return sprite
+
+BOXSPRITES = {} ###
+
+'''
+### This entire function was added
+Pre-renders the border and the empty background of the board, once.
+return: the board surface, to be drawn at (XMARGIN - 3, TOPMARGIN - 7)
+'''
+def getBoardBackground():
+    global BOARDBACKGROUND
+    if BOARDBACKGROUND is None:
+        BOARDBACKGROUND = pygame.Surface(((BOARDWIDTH * BOXSIZE) + 8, (BOARDHEIGHT * BOXSIZE) + 8))
+        BOARDBACKGROUND.fill(BGCOLOR)
+        pygame.draw.rect(BOARDBACKGROUND, BORDERCOLOR, (0, 0, (BOARDWIDTH * BOXSIZE) + 8, (BOARDHEIGHT * BOXSIZE) + 8), 5)
+        pygame.draw.rect(BOARDBACKGROUND, BGCOLOR, (3, 7, BOXSIZE * BOARDWIDTH, BOXSIZE * BOARDHEIGHT))
+    return BOARDBACKGROUND
+
+BOARDBACKGROUND = None ###
+
+'''
+### This entire function was added
+Renders a line of text, or reuses the surface from the last time the same text
+was drawn, so the HUD only renders the texts whose value changed.
+text: text to render
+font: font to render with, BASICFONT when not given
+color: color of the text
+return: the text surface
+'''
+def getTextSurface(text, font=None, color=TEXTCOLOR):
+    if font is None:
+        font = BASICFONT
+    key = (text, font, color)
+    surf = TEXTCACHE.get(key)
+    if surf is None:
+        if len(TEXTCACHE) >= TEXTCACHESIZE:
+            TEXTCACHE.clear()
+        surf = font.render(text, True, color)
+        TEXTCACHE[key] = surf
+    return surf
+
+TEXTCACHE = {} ###
+
+'''
+### This entire function was added
+What a piece looks like when it is drawn.
+piece: the piece
+return: hashable key, equal for pieces that are drawn the same
+'''
+def pieceKey(piece):
+    return (piece.shape, piece.rotation, piece.x, piece.y, piece.color)
+
+'''
+### This entire class was added
+Dirty rectangle renderer. Each part of the screen (board, score, next pieces,
+HUD texts) is only erased and drawn again when what it shows changed since the
+last frame, and only the rectangles that were drawn get sent to the display.
+'''
+class Renderer(object):
+    def __init__(self):
+        self.drawn = {}
+        self.dirty = []
+        self.invalidate()
+
+    '''
+    Forgets everything drawn, so the next frame draws the whole screen again.
+    '''
+    def invalidate(self):
+        self.drawn.clear()
+        DISPLAYSURF.fill(BGCOLOR)
+        self.dirty = [DISPLAYSURF.get_rect()]
+
+    '''
+    Checks whether a part of the screen has to be drawn again, and if so erases
+    it and marks it to be sent to the display.
+    name: name of the part of the screen
+    key: hashable value of what the part shows
+    rect: the area of the screen of the part
+    return: True when the caller has to draw the part
+    '''
+    def changed(self, name, key, rect):
+        if name in self.drawn and self.drawn[name] == key:
+            return False
+        self.drawn[name] = key
+        DISPLAYSURF.fill(BGCOLOR, rect)
+        self.dirty.append(rect)
+        return True
+
+    '''
+    Sends the parts drawn this frame to the display.
+    '''
+    def update(self):
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []
 
 '''
 ORIGINAL
@@ -818,13 +1800,13 @@ level: current level
 '''
 def drawStatus(score, level):
     # draw the score text
-    scoreSurf = BASICFONT.render('Score: %s' % score, True, TEXTCOLOR)
+    scoreSurf = getTextSurface('Score: %s' % score)
     scoreRect = scoreSurf.get_rect()
     scoreRect.topleft = (WINDOWWIDTH - 150, 20)
     DISPLAYSURF.blit(scoreSurf, scoreRect)
 
     # draw the level text
-    levelSurf = BASICFONT.render('Level: %s' % level, True, TEXTCOLOR)
+    levelSurf = getTextSurface('Level: %s' % level)
     levelRect = levelSurf.get_rect()
     levelRect.topleft = (WINDOWWIDTH - 150, 50)
     DISPLAYSURF.blit(levelSurf, levelRect)
@@ -837,23 +1819,20 @@ pixelx: x location on the screen
 pixely: y location on the screen 
 '''
 def drawPiece(piece, pixelx=None, pixely=None):
-    shapeToDraw = PIECES[piece['shape']][piece['rotation']]
     if pixelx == None and pixely == None:
         # if pixelx & pixely hasn't been specified, use the location stored in the piece data structure
-        pixelx, pixely = convertToPixelCoords(piece['x'], piece['y'])
+        pixelx, pixely = convertToPixelCoords(piece.x, piece.y)
 
     # draw each of the boxes that make up the piece
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            if shapeToDraw[y][x] != BLANK:
-                drawBox(None, None, piece['color'], pixelx + (x * BOXSIZE), pixely + (y * BOXSIZE))
+    for x, y in PIECEGEOMETRY[piece.shape][piece.rotation]['cells']:
+        drawBox(None, None, piece.color, pixelx + (x * BOXSIZE), pixely + (y * BOXSIZE))
 '''
 ### This entire function was added
 This draws the next piece onto the screen, to the right of the board
 piece: piece to draw
 '''
 def drawNextPiece(piece): 
-    nextSurf = BASICFONT.render('Next:', True, TEXTCOLOR)
+    nextSurf = getTextSurface('Next:')
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 120, 80)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -865,7 +1844,7 @@ and under the next piece
 piece: piece to draw
 '''
 def drawNextPiece2(piece): 
-    nextSurf = BASICFONT.render('Next 2:', True, TEXTCOLOR)
+    nextSurf = getTextSurface('Next 2:')
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 120, 230)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -877,7 +1856,7 @@ and under the next piece number 2
 piece: piece to draw
 '''
 def drawNextPiece3(piece):
-    nextSurf = BASICFONT.render('Next 3:', True, TEXTCOLOR)
+    nextSurf = getTextSurface('Next 3:')
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 120, 380)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -888,7 +1867,7 @@ This draws the held piece onto the screen, to the left of the board
 piece: piece to draw
 '''
 def drawHeldPiece(piece):
-    nextSurf = BASICFONT.render('Held:', True, TEXTCOLOR)
+    nextSurf = getTextSurface('Held:')
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 1000, 80)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -900,7 +1879,7 @@ board: the current board
 '''
 def drawHeight(board): 
     height = calcRealHeightPenalty(board)
-    nextSurf = BASICFONT.render("Height Penalty: " + str(height), True, TEXTCOLOR)
+    nextSurf = getTextSurface("Height Penalty: " + str(height))
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 1000, 250)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -912,7 +1891,7 @@ board: the current board
 '''
 def drawHole(board): 
     hole = calcHolePenalty(board)
-    nextSurf = BASICFONT.render("Hole Penalty: " + str(hole), True, TEXTCOLOR)
+    nextSurf = getTextSurface("Hole Penalty: " + str(hole))
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 1000, 350)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -924,18 +1903,53 @@ board: the current board
 '''
 def drawPenalty(board): 
     penalty = calcPenalty(board)
-    nextSurf = BASICFONT.render("Total Penalty: " + str(penalty), True, TEXTCOLOR)
+    nextSurf = getTextSurface("Total Penalty: " + str(penalty))
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 1000, 450)
     DISPLAYSURF.blit(nextSurf, nextRect)
 
+'''
+### This entire function was added
+This prints how deep the AI searched its last move, how often it ran out of
+time and how many moves came ready from the background worker, to the left of
+the board, under the total penalty
+searcher: the AnytimeSearch of the AI
+worker: the AIWorker of the AI
+'''
+def drawAIStats(searcher, worker):
+    if worker.hits + worker.misses == 0:
+        return
+    nextSurf = getTextSurface("AI Out of time: %s/%s" % (searcher.exhausted, searcher.searches))
+    nextRect = nextSurf.get_rect()
+    nextRect.topleft = (WINDOWWIDTH - 1000, 530)
+    DISPLAYSURF.blit(nextSurf, nextRect)
+    nextSurf = getTextSurface("AI Moves ready: %s/%s" % (worker.hits, worker.hits + worker.misses))
+    nextRect = nextSurf.get_rect()
+    nextRect.topleft = (WINDOWWIDTH - 1000, 560)
+    DISPLAYSURF.blit(nextSurf, nextRect)
+
+'''
+### This entire function was added
+This prints the frame times of the profiler under the next pieces, the 50th,
+95th and 99th percentile of the whole frame and of every part of it
+profiler: the FrameProfiler of the game
+'''
+def drawProfiler(profiler):
+    lines = [('frame', 'total')] + [(stage, stage) for stage in FRAMESTAGES]
+    for i, (label, stage) in enumerate(lines):
+        p50, p95, p99 = profiler.percentiles(stage)
+        nextSurf = getTextSurface("%-8s p50 %6.2f  p95 %6.2f  p99 %6.2f ms" % (label, p50, p95, p99), SMALLFONT)
+        nextRect = nextSurf.get_rect()
+        nextRect.topleft = (WINDOWWIDTH - 400, 500 + i * 17)
+        DISPLAYSURF.blit(nextSurf, nextRect)
+
 '''
 ### This entire function was added
 This prints the total penalty to the left of the board, under the hole penalty
 board: the current board
 '''
 def drawArtificialIntelligenceInstruct(board): 
-    nextSurf = BASICFONT.render("Press i to toggle AI function. ", True, TEXTCOLOR)
+    nextSurf = getTextSurface("Press i to toggle AI function. ")
     nextRect = nextSurf.get_rect()
     nextRect.topleft = (WINDOWWIDTH - 600, 50)
     DISPLAYSURF.blit(nextSurf, nextRect)
@@ -958,41 +1972,17 @@ Example: findNewLocationForPiece(4, fallingPiece, 1, board)
     ^
 """
 def findNewLocationForPiece(column, piece, rotation, board):
-    tempr = piece['rotation']
-    tempx = piece['x']
+    tempr = piece.rotation
+    tempx = piece.x
     
     # Rotate the piece to given input rotation
-    piece['rotation'] = rotation
-
-    # if/elif statements to displace the given column so the pieces
-    # fall to the correct column, based off the furthest left block
-    # of the shape. This is done because the shape templates have
-    # different amounts of space for each rotation and shape.
-    if piece['shape'] == 'S':
-        if piece['rotation'] == 0:
-            piece['x'] = column - 1
-        elif piece['rotation'] == 1:
-            piece['x'] = column - 2
-
-    elif piece['shape'] == 'Z':
-        piece['x'] = column - 1
-
-    elif piece['shape'] == 'I':
-        if piece['rotation'] == 0:
-            piece['x'] = column - 2
-        elif piece['rotation'] == 1:
-            piece['x'] = column
-
-    elif piece['shape'] == 'O':
-        piece['x'] = column - 1
-
-    # Shapes J, L, and T behave the same way,
-    # so they are contained in the same elif
-    elif piece['shape'] == 'J' or piece['shape'] == 'L' or piece['shape'] == 'T':
-        if piece['rotation'] == 0 or piece['rotation'] == 2 or piece['rotation'] == 3:
-            piece['x'] = column - 1
-        elif piece['rotation'] == 1:
-            piece['x'] = column - 2
+    piece.rotation = rotation
+
+    # Displace the given column so the piece falls to the correct column,
+    # based off the furthest left block of the shape. The shape templates have
+    # different amounts of space for each rotation and shape, which is what
+    # the minX of the compiled geometry holds.
+    piece.x = column - PIECEGEOMETRY[piece.shape][rotation]['minX']
 
     # Checks if it is a valid placement, repairs changes
     # if it is invalid. Action is unresponsive if invalid
@@ -1000,38 +1990,593 @@ def findNewLocationForPiece(column, piece, rotation, board):
         for i in range(1, BOARDHEIGHT):
             if not isValidPosition(board, piece, adjY=i):
                 break
-        piece['y'] += i - 1
+        piece.y += i - 1
     else:
-        piece['rotation'] = tempr
-        piece['x'] = tempx
+        piece.rotation = tempr
+        piece.x = tempx
         for i in range(1, BOARDHEIGHT):
             if not isValidPosition(board, piece, adjY=i):
                 break
-        piece['y'] += i - 1
+        piece.y += i - 1
+'''
+### This entire function was added
+Generates every distinct placement of a shape that can be reached by dropping
+it straight down from the top of the board. Nothing is modified, each
+placement is yielded exactly once (symmetric rotations and columns the piece
+doesn't fit in are skipped) and the landing height comes from the surface of
+the board instead of moving the piece down one row at a time: the piece stops
+as soon as the lowest box of one of its columns sits on top of that column.
+Placements that leave boxes above the board are skipped, they end the game.
+board: the current board
+shape: the shape to place
+return: generator of (shape, rotation, x, y) with x and y the template location
+'''
+def generatePlacements(board, shape):
+    heights = board.heights
+    for rotation in PIECEUNIQUEROTATIONS[shape]:
+        geometry = PIECEGEOMETRY[shape][rotation]
+        bottom = geometry['bottom']
+        for column in range(BOARDWIDTH - geometry['width'] + 1):
+            x = column - geometry['minX']
+            y = BOARDHEIGHT
+            for cellX, cellY in bottom:
+                landing = BOARDHEIGHT - heights[cellX + x] - 1 - cellY
+                if landing < y:
+                    y = landing
+            if y + geometry['minY'] >= 0:
+                yield shape, rotation, x, y
+
+# The reachability search keeps, for every rotation and template column, the ###
+# rows the piece fits in as the bits of one int. Both are offset so the ###
+# template can stick out of the board (left, right and above) and the bits ###
+# past the bottom of the board are the floor. ###
+REACHXOFFSET = TEMPLATEWIDTH + 1 ###
+REACHXSPAN = BOARDWIDTH + 2 * REACHXOFFSET ###
+REACHYOFFSET = TEMPLATEHEIGHT ###
+REACHYSPAN = BOARDHEIGHT + REACHYOFFSET ###
+REACHALL = (1 << REACHYSPAN) - 1 ###
+REACHFLOOR = ((1 << TEMPLATEHEIGHT) - 1) << REACHYSPAN ###
+# a search state is its rotation and column index shifted over its row ###
+REACHYSHIFT = REACHYSPAN.bit_length() ###
+REACHYMASK = (1 << REACHYSHIFT) - 1 ###
+# the moves of the search, REACHMOVES[i] is the action of move i ###
+REACHMOVES = (MOVELEFT, MOVERIGHT, ROTATE, ROTATEBACK, SOFTDROP, HARDDROP) ###
+
+'''
+### This entire function was added
+Collision masks of a shape on a board: for every rotation and column, an int
+with bit y + REACHYOFFSET set when the template fits with its top at row y.
+Every box of the template shifts the mask of its board column, so a whole
+column of positions is checked with four shifts instead of one isValidPosition
+per row.
+board: the current board
+shape: the shape
+return: list of the masks, indexed rotation * REACHXSPAN + x + REACHXOFFSET,
+        0 for the columns the template doesn't fit in
+'''
+def getFreeMasks(board, shape):
+    columns = [mask << REACHYOFFSET | REACHFLOOR for mask in board.columnMasks]
+    free = [0] * (PIECEROTATIONS[shape] * REACHXSPAN)
+    for rotation, geometry in enumerate(PIECEGEOMETRY[shape]):
+        cells = geometry['cells']
+        for x in range(-geometry['minX'], BOARDWIDTH - geometry['width'] - geometry['minX'] + 1):
+            blocked = 0
+            for cellX, cellY in cells:
+                blocked |= columns[x + cellX] >> cellY
+            free[rotation * REACHXSPAN + x + REACHXOFFSET] = ~blocked & REACHALL
+    return free
+
+'''
+### This entire function was added
+Generates every placement the falling piece can reach with the controls of
+the game (left, right, both rotations, soft and hard drop, no gravity in
+between), so slides under overhangs and tucks are found as well as straight
+drops. It is a breadth-first search over (rotation, x, y) states: the states
+already seen are a bitset per rotation and column, and the collisions come from
+getFreeMasks. A placement is a state the piece can't move down from, with
+every box on the board.
+board: the current board
+piece: the falling piece, where the search starts
+stats: optional dictionary, filled with the states visited and placements found
+return: generator of (shape, rotation, x, y, inputs) with x and y the template
+        location and inputs the shortest list of actions that gets the piece
+        there from where it is, for GameState.playInputs
+'''
+def generateReachablePlacements(board, piece, stats=None):
+    shape = piece.shape
+    rotations = PIECEROTATIONS[shape]
+    geometries = PIECEGEOMETRY[shape]
+    free = getFreeMasks(board, shape)
+    # the rows of every column the search hasn't been to yet
+    unvisited = free[:]
+    # column index change and move code of the sideways moves and turns
+    turns = [((-1, 0), (1, 1),
+              (((rotation + 1) % rotations - rotation) * REACHXSPAN, 2),
+              (((rotation - 1) % rotations - rotation) * REACHXSPAN, 3)) for rotation in range(rotations)]
+    startColumn = piece.rotation * REACHXSPAN + piece.x + REACHXOFFSET
+    startRow = piece.y + REACHYOFFSET
+    queue = []
+    if 0 <= startRow < REACHYSPAN and free[startColumn] >> startRow & 1:
+        queue.append(startColumn << REACHYSHIFT | startRow)
+        unvisited[startColumn] ^= 1 << startRow
+    # how every state was reached: the state before it shifted over the move
+    parents = {}
+    placements = 0
+    # the queue grows while it is walked, every state is put in it once
+    for state in queue:
+        column = state >> REACHYSHIFT
+        row = state & REACHYMASK
+        bit = 1 << row
+        rotation = column // REACHXSPAN
+        for change, move in turns[rotation]:
+            target = column + change
+            if unvisited[target] & bit:
+                unvisited[target] ^= bit
+                reached = target << REACHYSHIFT | row
+                parents[reached] = state << 3 | move
+                queue.append(reached)
+        columnFree = free[column]
+        below = bit << 1
+        if columnFree & below:
+            if unvisited[column] & below:
+                unvisited[column] ^= below
+                parents[state + 1] = state << 3 | 4
+                queue.append(state + 1)
+            # a hard drop stops on the row above the first one the piece doesn't fit in
+            blocked = ~columnFree >> row
+            landing = row + (blocked & -blocked).bit_length() - 2
+            if unvisited[column] >> landing & 1:
+                unvisited[column] ^= 1 << landing
+                reached = column << REACHYSHIFT | landing
+                parents[reached] = state << 3 | 5
+                queue.append(reached)
+            continue
+        y = row - REACHYOFFSET
+        if y + geometries[rotation]['minY'] < 0:
+            continue
+        inputs = []
+        at = state
+        while at in parents:
+            parent = parents[at]
+            inputs.append(REACHMOVES[parent & 7])
+            at = parent >> 3
+        inputs.reverse()
+        placements += 1
+        yield shape, rotation, column - rotation * REACHXSPAN - REACHXOFFSET, y, inputs
+    if stats is not None:
+        stats['states'] = len(queue)
+        stats['placements'] = placements
+
+'''
+### This entire function was added
+Chooses the best placement the falling piece can reach with the controls,
+slides and tucks included. Straight drops are scored with evaluatePlacement
+like findBestMove does, the placements under an overhang get a board of their
+own since they can fill a hole instead of covering it.
+board: the current board
+piece: the falling piece
+stats: optional dictionary, filled with the number of placements evaluated and
+       the states searched
+return: (rotation, x, y, inputs) of the best placement, None when the piece
+        can't move at all
+'''
+def findBestMoveReachable(board, piece, stats=None):
+    analysis = analyzeBoard(board)
+    search = {}
+    best = None
+    minPenalty = None
+    for shape, rotation, x, y, inputs in generateReachablePlacements(board, piece, search):
+        if y == getLandingY(board, shape, rotation, x):
+            penalty = evaluatePlacement(analysis, shape, rotation, x, y)
+        else:
+            copyBoard = board.copy(withColors=False)
+            addShapeToBoard(copyBoard, shape, rotation, x, y)
+            penalty = calcPenalty(copyBoard)
+        if minPenalty is None or penalty < minPenalty:
+            minPenalty = penalty
+            best = (rotation, x, y, inputs)
+    if stats is not None:
+        stats['nodes'] = search.get('placements', 0)
+        stats['states'] = search.get('states', 0)
+    return best
+
 '''
 ### This entire function was added
 Evalutes every possible location a piece could be placed on the board and chooses
 the best move
 board: the current board
 piece: the piece to be placed
+cache: optional EvaluationCache to look the penalties up in ###
+stats: optional dictionary, filled with the number of placements evaluated ###
 return: the column and rotation that piece should be in to make the best move.
 '''
-def findBestMove(board, piece):
+def findBestMove(board, piece, cache=None, stats=None):
     minRotation = None
     minColumn = None
-    minPenalty = sys.maxint
-
-    for cRot in range(0, len(PIECES[piece['shape']])):
-        for cCol in range(0, BOARDWIDTH):
-            copyBoard = copy.deepcopy(board)
-            findNewLocationForPiece(cCol, piece, cRot, copyBoard)
-            addToBoard(copyBoard, piece)
-            currentPenalty = calcPenalty(copyBoard)
-            if currentPenalty < minPenalty:
-                minPenalty = currentPenalty
-                minColumn = cCol
-                minRotation = cRot
+    minPenalty = None
+    nodes = 0
+    # Without a cache the penalties come from one analysis of the board, no
+    # board has to be built for the candidates. ###
+    analysis = analyzeBoard(board) if cache is None else None
+
+    for shape, rotation, x, y in generatePlacements(board, piece.shape):
+        if analysis is not None:
+            currentPenalty = evaluatePlacement(analysis, shape, rotation, x, y)
+        else:
+            copyBoard = board.copy(withColors=False)
+            addShapeToBoard(copyBoard, shape, rotation, x, y)
+            currentPenalty = cache.penalty(copyBoard)
+        nodes += 1
+        if minPenalty is None or currentPenalty < minPenalty:
+            minPenalty = currentPenalty
+            minColumn = x + PIECEGEOMETRY[shape][rotation]['minX']
+            minRotation = rotation
+    if stats is not None:
+        stats['nodes'] = nodes
+    if minPenalty is None:
+        # nowhere left to go, the game is lost wherever the piece lands
+        return [piece.x + PIECEGEOMETRY[piece.shape][piece.rotation]['minX'], piece.rotation]
     return [minColumn, minRotation]
 
+'''
+### This entire function was added
+Imports numpy the first time the batched evaluation needs it, numpy is
+optional and most runs never use it.
+return: the numpy module, None when numpy isn't installed
+'''
+def loadNumpy():
+    global numpy, NUMPYMISSING
+    if numpy is None and not NUMPYMISSING:
+        try:
+            import numpy
+        except ImportError:
+            NUMPYMISSING = True
+    return numpy
+
+NUMPYMISSING = False ###
+
+'''
+### This entire function was added
+Stacks the boards that result from a list of placements into one array, so all
+the candidates of a move can be evaluated at once with numpy.
+board: the current board
+placements: (shape, rotation, x, y) placements, as made by generatePlacements
+return: uint8 array shaped [N, BOARDWIDTH, BOARDHEIGHT], 1 where a box is
+'''
+def placementsToArray(board, placements):
+    loadNumpy()
+    count = len(placements)
+    # unpack the column masks of the current board once, then copy it N times
+    bits = numpy.arange(BOARDHEIGHT, dtype=numpy.int64)
+    columns = numpy.array(board.columnMasks, dtype=numpy.int64)
+    cells = numpy.empty((count, BOARDWIDTH, BOARDHEIGHT), dtype=numpy.uint8)
+    cells[:] = (columns[:, None] >> bits) & 1
+    # every piece has 4 boxes, set them all with one fancy index
+    boxes = numpy.array([PIECEGEOMETRY[shape][rotation]['cells'] for shape, rotation, x, y in placements], dtype=numpy.intp)
+    boxes += numpy.array([(x, y) for shape, rotation, x, y in placements], dtype=numpy.intp)[:, None, :]
+    cells[numpy.arange(count)[:, None], boxes[:, :, 0], boxes[:, :, 1]] = 1
+    return cells
+
+'''
+### This entire function was added
+calcPenalty for a whole stack of boards at once: the height penalty is a dot
+product with the penalty of each row and the holes are the empty boxes under
+the running maximum of every column.
+cells: uint8 array shaped [N, BOARDWIDTH, BOARDHEIGHT], as made by placementsToArray
+return: int64 array of the N penalties
+'''
+def calcPenaltyBatched(cells):
+    loadNumpy()
+    height = cells.reshape(-1, BOARDHEIGHT).dot(numpy.array(ROWHEIGHTPENALTY, dtype=numpy.int64))
+    height = height.reshape(cells.shape[0], BOARDWIDTH).sum(axis=1)
+    # a box covers every box under it, top row first so accumulate downwards
+    covered = numpy.maximum.accumulate(cells, axis=2)
+    holes = (covered - cells).sum(axis=(1, 2), dtype=numpy.int64)
+    return height + holes * HOLEPENALTY
+
+'''
+### This entire function was added
+findBestMove with every candidate evaluated in one numpy pass instead of one
+board copy and calcPenalty call at a time. It picks the same move.
+board: the current board
+piece: the piece to be placed
+stats: optional dictionary, filled with the number of placements evaluated
+return: the column and rotation that piece should be in to make the best move.
+'''
+def findBestMoveBatched(board, piece, stats=None):
+    if loadNumpy() is None:
+        raise ImportError('findBestMoveBatched needs numpy')
+    placements = list(generatePlacements(board, piece.shape))
+    if stats is not None:
+        stats['nodes'] = len(placements)
+    if not placements:
+        return findBestMove(board, piece)
+    best = int(numpy.argmin(calcPenaltyBatched(placementsToArray(board, placements))))
+    shape, rotation, x, y = placements[best]
+    return [x + PIECEGEOMETRY[shape][rotation]['minX'], rotation]
+
+'''
+### This entire function was added
+Analysis of a board shared by every placement evaluated on it: the surface
+(column heights) and the penalties of the board as it is.
+board: the current board
+return: dictionary with the heights, the height penalty and the hole count
+'''
+def analyzeBoard(board):
+    features = extractFeatures(board, PENALTYWEIGHTS)
+    return {'heights': board.heights,
+            'heightPenalty': weightedSum(features, HEIGHTWEIGHTS),
+            'holes': features[HOLESFEATURE]}
+
+'''
+### This entire function was added
+calcPenalty of the board after a straight-drop placement, without building
+that board. Every box adds the height penalty of its row, and every column the
+piece covers gets a hole for each empty box between the lowest box of the
+piece and the top of the column it landed on.
+analysis: the analyzeBoard of the board the piece is dropped on
+shape, rotation, x, y: a placement made by generatePlacements
+return: the total penalty of the board with the piece locked
+'''
+def evaluatePlacement(analysis, shape, rotation, x, y):
+    geometry = PIECEGEOMETRY[shape][rotation]
+    heights = analysis['heights']
+    penalty = analysis['heightPenalty']
+    for cellX, cellY in geometry['cells']:
+        penalty += ROWHEIGHTPENALTY[cellY + y]
+    holes = analysis['holes']
+    for cellX, cellY in geometry['bottom']:
+        holes += BOARDHEIGHT - heights[cellX + x] - 1 - (cellY + y)
+    return penalty + holes * HOLEPENALTY
+
+'''
+### This entire function was added
+Chooses between playing the falling piece and holding it. The other branch is
+the held piece, or the next piece when nothing is held yet. The board is only
+analyzed once for both branches and no board is built for any candidate, and
+a branch with the same shape as the falling piece isn't searched twice.
+board: the current board
+piece: the falling piece
+heldPiece: the held piece, None when nothing is held
+nextPiece: the first piece of the queue
+stats: optional dictionary, filled with the number of placements evaluated
+return: the column and rotation to place the piece in, and whether to hold first
+'''
+def findBestMoveWithHold(board, piece, heldPiece, nextPiece, stats=None):
+    analysis = analyzeBoard(board)
+    nodes = 0
+    other = heldPiece if heldPiece is not None else nextPiece
+    branches = [(piece.shape, False)]
+    if other is not None and other.shape != piece.shape:
+        branches.append((other.shape, True))
+    best = None
+    for branchShape, useHold in branches:
+        for shape, rotation, x, y in generatePlacements(board, branchShape):
+            penalty = evaluatePlacement(analysis, shape, rotation, x, y)
+            nodes += 1
+            if best is None or penalty < best[0]:
+                best = (penalty, x + PIECEGEOMETRY[shape][rotation]['minX'], rotation, useHold)
+    if stats is not None:
+        stats['nodes'] = nodes
+    if best is None:
+        return findBestMove(board, piece) + [False]
+    return [best[1], best[2], best[3]]
+
+'''
+### This entire function was added
+Looks ahead through the preview queue with a beam search. Every placement of
+the current piece is scored like findBestMove does, the best beamWidth boards
+(after their complete lines are cleared) are expanded with every placement of
+the next piece, and so on for depth pieces. The move returned is the first
+move on the way to the best board of the deepest step that was finished.
+The search stops early when timeBudget or nodeBudget runs out, so it can run
+inside a frame, and the answer is always ready from the last finished step.
+The first step (every placement of the piece, and of the held piece with
+hold) is always finished, so a budget smaller than that step is overrun by
+the time the step takes, about one findBestMove (two with hold).
+With hold, the first step also places the held piece (or the next piece when
+nothing is held) and the rest of the queue follows on from that branch.
+board: the current board
+piece: the piece to be placed
+previews: the pieces coming after it, nextPiece first
+depth: number of pieces to look at, 1 is the same as findBestMove
+beamWidth: number of boards kept at each step
+timeBudget: seconds the search may take, the first step finishes anyway, None
+            for no limit
+stats: optional dictionary, filled with the nodes expanded, the seconds spent,
+       the depth finished and whether a budget ran out
+cache: optional EvaluationCache to look the penalties up in
+hold: True to also search holding the piece
+heldPiece: the held piece, None when nothing is held
+nodeBudget: number of placements the search may evaluate, the first step
+            finishes anyway, None for no limit
+return: the column and rotation that piece should be in to make the best move,
+        followed by whether to hold first when hold is True
+'''
+def findBestMoveLookahead(board, piece, previews, depth=AIDEPTH, beamWidth=AIBEAMWIDTH, timeBudget=None, stats=None, cache=None, hold=False, heldPiece=None, nodeBudget=None):
+    start = time.perf_counter()
+    deadline = None if timeBudget is None else start + timeBudget
+    queue = [preview.shape for preview in previews]
+    # each node of the beam is (penalty, board after clearing, first move,
+    # shapes still to place), the first moves of the roots only hold the branch
+    beam = [(0, board, [False], [piece.shape] + queue)]
+    if hold:
+        if heldPiece is not None:
+            branch = [heldPiece.shape] + queue
+        else:
+            branch = queue
+        if branch and branch[0] != piece.shape:
+            beam.append((0, board, [True], branch))
+    depth = min([depth] + [len(shapes) for penalty, parent, firstMove, shapes in beam])
+    best = None
+    nodes = 0
+    finished = 0
+    exhausted = False
+    for step in range(depth):
+        children = []
+        for penalty, parent, firstMove, shapes in beam:
+            # the first step always finishes, it is the least the search
+            # answers with, the budgets only cut the deeper steps short
+            if step and ((deadline is not None and time.perf_counter() > deadline) or (nodeBudget is not None and nodes >= nodeBudget)):
+                exhausted = True
+                break
+            shape = shapes[0]
+            # without a cache only the boards that make the beam get built
+            analysis = analyzeBoard(parent) if cache is None else None
+            for placedShape, rotation, x, y in generatePlacements(parent, shape):
+                child = None
+                if analysis is not None:
+                    childPenalty = evaluatePlacement(analysis, shape, rotation, x, y)
+                else:
+                    child = parent.copy(withColors=False)
+                    addShapeToBoard(child, shape, rotation, x, y)
+                    childPenalty = cache.penalty(child)
+                move = firstMove
+                if step == 0:
+                    move = [x + PIECEGEOMETRY[shape][rotation]['minX'], rotation] + firstMove
+                children.append((childPenalty, parent, child, (shape, rotation, x, y), move, shapes[1:]))
+                nodes += 1
+        if exhausted or not children:
+            break
+        # sort on the penalty only, ties keep the order of the placements
+        children.sort(key=lambda node: node[0])
+        beam = []
+        for childPenalty, parent, child, placement, move, shapes in children[:beamWidth]:
+            if child is None:
+                child = parent.copy(withColors=False)
+                addShapeToBoard(child, *placement)
+            removeCompleteLines(child)
+            beam.append((childPenalty, child, move, shapes))
+        best = beam[0][2]
+        finished += 1
+    if stats is not None:
+        stats['nodes'] = nodes
+        stats['seconds'] = time.perf_counter() - start
+        stats['depth'] = finished
+        stats['exhausted'] = exhausted
+    if best is None:
+        # nowhere to go
+        best = findBestMove(board, piece, cache) + [False]
+    return best if hold else best[:2]
+
+'''
+### This entire class was added
+Anytime AI search with a hard budget per move. The lookahead is deepened one
+piece of the preview queue at a time, and each finished step replaces the best
+answer so far, so when the time (or node) budget runs out the search stops
+where it is and the move from the deepest finished step is played. Every
+search is counted, with how often the budget ran out and at which depth.
+maxDepth: deepest lookahead, None to go as deep as the preview queue allows
+beamWidth: number of boards kept at each step
+timeBudget: seconds one move may take, None for no limit. The first step is
+            always finished, so a move takes at least about one findBestMove
+nodeBudget: placements one move may evaluate, None for no limit
+hold: True to also search holding the piece
+'''
+class AnytimeSearch(object):
+    def __init__(self, maxDepth=None, beamWidth=AIBEAMWIDTH, timeBudget=AITIMEBUDGET, nodeBudget=None, hold=True):
+        self.maxDepth = maxDepth
+        self.beamWidth = beamWidth
+        self.timeBudget = timeBudget
+        self.nodeBudget = nodeBudget
+        self.hold = hold
+        self.searches = 0
+        self.exhausted = 0
+        # depth finished by the searches that ran out of budget
+        self.exhaustedDepths = collections.Counter()
+        self.lastStats = {}
+
+    '''
+    Finds the move for the falling piece within the budget.
+    board: the current board
+    piece: the falling piece
+    previews: the pieces coming after it, nextPiece first
+    heldPiece: the held piece, None when nothing is held
+    spent: seconds of the time budget of this move already used up (waiting
+           for the AIWorker), the search only gets what is left
+    return: the column and rotation of the move and whether to hold first
+    '''
+    def search(self, board, piece, previews, heldPiece=None, spent=0.0):
+        depth = len(previews) + 1
+        if self.maxDepth is not None:
+            depth = min(depth, self.maxDepth)
+        timeBudget = None if self.timeBudget is None else max(0.0, self.timeBudget - spent)
+        stats = {}
+        move = findBestMoveLookahead(board, piece, previews, depth, self.beamWidth, timeBudget, stats,
+                                     hold=self.hold, heldPiece=heldPiece, nodeBudget=self.nodeBudget)
+        self.searches += 1
+        if stats['exhausted']:
+            self.exhausted += 1
+            self.exhaustedDepths[stats['depth']] += 1
+        self.lastStats = stats
+        if not self.hold:
+            move = move + [False]
+        return move
+
+    '''
+    return: dictionary with the number of searches, how many ran out of budget
+            and the depth those finished
+    '''
+    def stats(self):
+        return {'searches': self.searches,
+                'exhausted': self.exhausted,
+                'exhaustedDepths': dict(self.exhaustedDepths)}
+
+'''
+### This entire function was added
+Plays a whole game with the AI as fast as possible, without drawing anything.
+seed: seed of the game, the same seed always plays the same game
+maxPieces: stop after this many pieces, None to play until the game is lost
+moveFinder: the function choosing the moves, findBestMove or findBestMoveBatched
+depth: more than 1 to look ahead through the queue with findBestMoveLookahead
+beamWidth: number of boards kept at each step of the lookahead
+cache: optional EvaluationCache used by the lookahead, can be shared between games
+hold: True to let the AI hold pieces
+replay: optional Replay of tetris_replay the moves are recorded in, its seed
+        has to be the seed of the game
+telemetry: optional TelemetrySink of tetris_telemetry every locked piece is
+           written to
+randomizer: where the pieces come from, a BagRandomizer of the seed when None
+return: the GameState at the end of the game
+'''
+def playAIGame(seed=None, maxPieces=None, moveFinder=findBestMove, depth=1, beamWidth=AIBEAMWIDTH, cache=None, hold=False, replay=None, telemetry=None, randomizer=None):
+    game = GameState(seed, randomizer)
+    while not game.gameOver and (maxPieces is None or game.piecesPlaced < maxPieces):
+        useHold = False
+        stats = {}
+        start = time.perf_counter()
+        if depth > 1:
+            move = findBestMoveLookahead(game.board, game.fallingPiece, game.queue, depth, beamWidth,
+                                         stats=stats, cache=cache, hold=hold, heldPiece=game.heldPiece)
+            column, rotation = move[0], move[1]
+            if hold:
+                useHold = move[2]
+        elif hold:
+            column, rotation, useHold = findBestMoveWithHold(game.board, game.fallingPiece, game.heldPiece, game.queue[0], stats)
+        else:
+            column, rotation = moveFinder(game.board, game.fallingPiece, stats=stats)
+        seconds = time.perf_counter() - start
+        if replay is not None:
+            replay.record(game, rotation, column, useHold)
+        shape = game.placedShape(useHold)
+        lines = game.place(rotation, column, useHold)
+        if telemetry is not None:
+            telemetry.record(game, shape, rotation, column, useHold, stats.get('nodes', 0), seconds, lines)
+    return game
+
+'''
+### This entire function was added
+Nearest-rank percentile, used for the game length and timing reports.
+values: the values, in any order
+fraction: the percentile as a fraction, 0.5 for the median
+return: the percentile, None when there are no values
+'''
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,305 @@
+################################################################################
+# Replays of Tetris AI games
+# A game is recorded as its seed and two bytes per placed piece: the shape,
+# rotation and hold flag in the first byte and the column in the second. The
+# seed gives back the same pieces, so playing the placements again gives back
+# the same game, as fast as the engine goes or drawn at a chosen speed. A replay
+# can also be checked against the current AI, to find the moves it now plays
+# differently and the moves that were slow to find.
+#
+# Example: python tetris_replay.py --record game.trp --seed 7 --max-pieces 500
+#          python tetris_replay.py game.trp --compare
+#          python tetris_replay.py game.trp --show --speed 20
+################################################################################
+
+import argparse, random, struct, time
+
+import tetris_brogan_edit as tetris
+
+# Start of every replay file, the last byte is the version of the format
+REPLAYMAGIC = b'TRP\x01'
+# magic, seed, number of placements
+REPLAYHEADER = struct.Struct('<4sQI')
+# The seed is stored unsigned, seeds go from 0 to REPLAYSEEDS - 1
+REPLAYSEEDS = 2 ** 64
+# Shapes by their code in the stream, never reorder, old replays depend on it
+REPLAYSHAPES = ('S', 'Z', 'J', 'L', 'I', 'O', 'T')
+REPLAYSHAPECODES = {shape: code for code, shape in enumerate(REPLAYSHAPES)}
+# Placements drawn per second by showReplay
+REPLAYSPEED = 10
+
+'''
+The seed of a game and the placements of its pieces.
+seed: seed of the game from 0 to REPLAYSEEDS - 1, a random one when None
+data: the placements, two bytes each, as written by record
+'''
+class Replay(object):
+    def __init__(self, seed=None, data=b''):
+        if seed is None:
+            seed = random.randrange(REPLAYSEEDS)
+        if not 0 <= seed < REPLAYSEEDS:
+            raise ValueError('a replay can only record seeds from 0 to %d, not %d' % (REPLAYSEEDS - 1, seed))
+        self.seed = seed
+        self.data = bytearray(data)
+
+    def __len__(self):
+        return len(self.data) // 2
+
+    '''
+    return: iterator of (shape, rotation, column, hold) of every placement
+    '''
+    def __iter__(self):
+        data = self.data
+        for i in range(0, len(data), 2):
+            yield unpackPlacement(data[i], data[i + 1])
+
+    '''
+    Records the placement the AI chose, before it is played.
+    game: the GameState the placement is played on
+    rotation: rotation of the piece
+    column: leftmost column of the piece
+    hold: True when the piece is swapped with the held piece first
+    '''
+    def record(self, game, rotation, column, hold=False):
+        shape = tetris.PIECESLIST[game.placedShape(hold)]
+        self.data.append(REPLAYSHAPECODES[shape] | rotation << 3 | (1 << 5 if hold else 0))
+        self.data.append(column)
+
+    '''
+    return: the replay as the bytes of a replay file
+    '''
+    def toBytes(self):
+        return REPLAYHEADER.pack(REPLAYMAGIC, self.seed, len(self)) + bytes(self.data)
+
+    '''
+    data: the bytes of a replay file
+    return: the Replay
+    '''
+    @classmethod
+    def fromBytes(cls, data):
+        magic, seed, count = REPLAYHEADER.unpack_from(data)
+        if magic != REPLAYMAGIC:
+            raise ValueError('not a replay file, or a replay of another version')
+        placements = data[REPLAYHEADER.size:]
+        if len(placements) != 2 * count:
+            raise ValueError('the replay should have %d placements but has %d bytes of them' % (count, len(placements)))
+        return cls(seed, placements)
+
+'''
+Decodes one placement of the stream.
+first: the byte with the shape, rotation and hold flag
+column: the byte with the column
+return: (shape, rotation, column, hold)
+'''
+def unpackPlacement(first, column):
+    return REPLAYSHAPES[first & 7], first >> 3 & 3, column, bool(first & 32)
+
+'''
+replay: the Replay
+path: path of the file
+'''
+def saveReplay(replay, path):
+    with open(path, 'wb') as replayFile:
+        replayFile.write(replay.toBytes())
+
+'''
+path: path of a replay file
+return: the Replay
+'''
+def loadReplay(path):
+    with open(path, 'rb') as replayFile:
+        return Replay.fromBytes(replayFile.read())
+
+'''
+Plays an AI game with playAIGame and records it.
+seed: seed of the game, a random one when None
+other arguments: passed on to playAIGame
+return: (Replay, GameState at the end of the game)
+'''
+def recordAIGame(seed=None, maxPieces=None, moveFinder=tetris.findBestMove, depth=1, beamWidth=tetris.AIBEAMWIDTH, hold=False):
+    replay = Replay(seed)
+    game = tetris.playAIGame(replay.seed, maxPieces, moveFinder, depth, beamWidth, hold=hold, replay=replay)
+    return replay, game
+
+'''
+Plays one placement of a replay, after checking that the game is where the
+replay was recorded.
+game: the GameState
+index: index of the placement, for the error
+placement: (shape, rotation, column, hold)
+'''
+def playPlacement(game, index, placement):
+    shape, rotation, column, hold = placement
+    if game.gameOver:
+        raise ValueError('placement %d comes after the end of the game' % index)
+    placedShape = tetris.PIECESLIST[game.placedShape(hold)]
+    if placedShape != shape:
+        raise ValueError('placement %d was recorded for a %s piece but the game has a %s piece, '
+                         'the game changed since it was recorded' % (index, shape, placedShape))
+    game.place(rotation, column, hold)
+
+'''
+Plays a replay again as fast as the engine goes, without drawing anything.
+replay: the Replay
+stop: number of placements to play, all of them when None
+return: the GameState after the placements
+'''
+def playReplay(replay, stop=None):
+    game = tetris.GameState(replay.seed)
+    for index, placement in enumerate(replay):
+        if stop is not None and index >= stop:
+            break
+        playPlacement(game, index, placement)
+    return game
+
+'''
+Plays a replay again in the game window, one placement at a time. Every piece
+is shown where it lands before it is locked there.
+replay: the Replay
+speed: placements per second
+start: placements played without drawing them first, to skip to a part of the game
+'''
+def showReplay(replay, speed=REPLAYSPEED, start=0):
+    tetris.setupDisplay()
+    game = tetris.GameState(replay.seed)
+    for index, placement in enumerate(replay):
+        if index >= start:
+            drawPlacement(game, placement)
+            tetris.FPSCLOCK.tick(speed)
+            tetris.checkForQuit()
+        playPlacement(game, index, placement)
+    drawPlacement(game, None)
+    tetris.showTextScreen('Replay Over')
+
+'''
+Draws the game with the piece of a placement where it lands.
+game: the GameState before the placement
+placement: (shape, rotation, column, hold), None to only draw the game
+'''
+def drawPlacement(game, placement):
+    tetris.DISPLAYSURF.fill(tetris.BGCOLOR)
+    tetris.drawBoard(game.board)
+    tetris.drawStatus(game.score, game.level)
+    tetris.drawNextPiece(game.queue[0])
+    tetris.drawNextPiece2(game.queue[1])
+    tetris.drawNextPiece3(game.queue[2])
+    if game.heldPiece is not None:
+        tetris.drawHeldPiece(game.heldPiece)
+    if placement is not None and not game.gameOver:
+        shape, rotation, column, hold = placement
+        shape = tetris.PIECEIDS[shape]
+        if not hold:
+            piece = game.fallingPiece.copy()
+        elif game.heldPiece is not None:
+            piece = game.heldPiece.copy()
+        else:
+            piece = game.queue[0].copy()
+        piece.rotation = rotation
+        piece.x = column - tetris.PIECEGEOMETRY[shape][rotation]['minX']
+        piece.y = tetris.getLandingY(game.board, shape, rotation, piece.x)
+        tetris.drawPiece(piece)
+    tetris.pygame.display.update()
+
+'''
+The move the greedy AI chooses now, to compare replays against.
+game: the GameState
+return: (column, rotation, hold)
+'''
+def greedyMove(game):
+    column, rotation = tetris.findBestMove(game.board, game.fallingPiece)
+    return column, rotation, False
+
+'''
+The move the greedy AI with hold chooses now, to compare replays against.
+game: the GameState
+return: (column, rotation, hold)
+'''
+def greedyHoldMove(game):
+    return tuple(tetris.findBestMoveWithHold(game.board, game.fallingPiece, game.heldPiece, game.queue[0]))
+
+'''
+Goes through a replay asking the AI what it would play at every placement. The
+game keeps following the replay, so every decision is made on exactly the
+position it was recorded on.
+replay: the Replay
+chooseMove: function of the GameState returning (column, rotation, hold)
+return: list of (index, recorded (column, rotation, hold), chosen move, seconds)
+'''
+def compareReplay(replay, chooseMove=greedyMove):
+    decisions = []
+    game = tetris.GameState(replay.seed)
+    for index, placement in enumerate(replay):
+        shape, rotation, column, hold = placement
+        start = time.perf_counter()
+        chosen = tuple(chooseMove(game))
+        decisions.append((index, (column, rotation, hold), chosen, time.perf_counter() - start))
+        playPlacement(game, index, placement)
+    return decisions
+
+'''
+Prints a board with # for the filled boxes.
+board: the board
+'''
+def printBoard(board):
+    for y in range(tetris.BOARDHEIGHT):
+        print(''.join('#' if board.rows[y] >> x & 1 else '.' for x in range(tetris.BOARDWIDTH)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Tetris AI games and play them again.')
+    parser.add_argument('replay', nargs='?', help='replay file to play, compare or show')
+    parser.add_argument('--record', metavar='PATH', help='play an AI game and record it to this file')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the recorded game (0 to 2**64 - 1), random when not given')
+    parser.add_argument('--max-pieces', type=int, default=None, help='stop the recorded game after this many pieces')
+    parser.add_argument('--hold', action='store_true', help='let the AI hold pieces, when recording and comparing')
+    parser.add_argument('--compare', action='store_true', help='show the moves the current AI plays differently')
+    parser.add_argument('--slowest', type=int, default=5, help='number of slowest decisions shown by --compare')
+    parser.add_argument('--position', type=int, default=None, help='print the game before this placement')
+    parser.add_argument('--show', action='store_true', help='draw the replay in the game window')
+    parser.add_argument('--speed', type=int, default=REPLAYSPEED, help='placements drawn per second')
+    parser.add_argument('--start', type=int, default=0, help='placements skipped before drawing')
+    args = parser.parse_args()
+    if args.seed is not None and not 0 <= args.seed < REPLAYSEEDS:
+        parser.error('--seed has to be from 0 to %d' % (REPLAYSEEDS - 1))
+
+    if args.record:
+        replay, game = recordAIGame(args.seed, args.max_pieces, hold=args.hold)
+        saveReplay(replay, args.record)
+        print('Recorded seed %d: %d pieces, %d lines, %d bytes' % (replay.seed, game.piecesPlaced, game.score,
+                                                                  len(replay.toBytes())))
+        return
+    if not args.replay:
+        parser.error('give a replay file, or --record to make one')
+    replay = loadReplay(args.replay)
+
+    if args.position is not None:
+        game = playReplay(replay, args.position)
+        print('Before placement %d: %d lines, falling %s, queue %s, held %s' % (
+            args.position, game.score, tetris.PIECESLIST[game.fallingPiece.shape],
+            ' '.join(tetris.PIECESLIST[piece.shape] for piece in game.queue),
+            tetris.PIECESLIST[game.heldPiece.shape] if game.heldPiece is not None else '-'))
+        printBoard(game.board)
+    elif args.compare:
+        decisions = compareReplay(replay, greedyHoldMove if args.hold else greedyMove)
+        different = [decision for decision in decisions if decision[1] != decision[2]]
+        print('%d of %d moves played differently' % (len(different), len(decisions)))
+        for index, recorded, chosen, seconds in different:
+            print('  placement %5d: recorded column %d rotation %d hold %d, now column %d rotation %d hold %d' %
+                  ((index,) + tuple(recorded) + tuple(chosen)))
+        print('Slowest decisions:')
+        for index, recorded, chosen, seconds in sorted(decisions, key=lambda decision: -decision[3])[:args.slowest]:
+            print('  placement %5d: %.3f ms' % (index, seconds * 1000.0))
+        game = tetris.playAIGame(replay.seed, len(replay), hold=args.hold)
+        print('Same seed and length played by the current AI: %d lines (replay: %d lines)' %
+              (game.score, playReplay(replay).score))
+    elif args.show:
+        showReplay(replay, args.speed, args.start)
+    else:
+        start = time.perf_counter()
+        game = playReplay(replay)
+        seconds = time.perf_counter() - start
+        print('Seed %d: %d pieces, %d lines, %s in %.3fs (%.0f pieces/s)' % (
+            replay.seed, game.piecesPlaced, game.score, 'lost' if game.gameOver else 'not lost',
+            seconds, game.piecesPlaced / seconds if seconds else 0.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+################################################################################
+# Move suggestion service for the Tetris AI
+# Keeps one warm AI process that front-ends and bots share over a local socket.
+# A client keeps its connection open and sends one JSON request per line (the
+# board, the falling piece, the preview and the held piece), and gets one JSON
+# line back per request with the placement the AI chose. Requests that arrive
+# together, from one client or many, are evaluated as one batch: with the numpy
+# evaluator every candidate placement of the whole batch is scored in a single
+# calcPenaltyBatched pass. {"stats": true} returns the latency percentiles and
+# the queue depth.
+#
+# Example: python tetris_service.py --port 7474 --evaluator numpy
+#          python tetris_service.py --port 7474 --query-stats
+################################################################################
+
+import argparse, asyncio, collections, concurrent.futures, json, socket, time
+
+import tetris_brogan_edit as tetris
+
+SERVICEHOST = '127.0.0.1'
+SERVICEPORT = 7474
+# Most requests evaluated in one batch
+BATCHSIZE = 64
+# Seconds a batch waits for more requests after the first one, when nothing
+# else is queued yet
+BATCHWAIT = 0.001
+# Latencies kept for the percentiles, the most recent ones
+LATENCYWINDOW = 10000
+
+'''
+Builds a board from the rows of a request.
+rows: BOARDHEIGHT strings of BOARDWIDTH characters, top row first, '.' for an
+      empty box and anything else for a filled one
+return: the board, without colors
+'''
+def parseBoard(rows):
+    if not isinstance(rows, list) or len(rows) != tetris.BOARDHEIGHT:
+        raise ValueError('the board needs %d rows' % tetris.BOARDHEIGHT)
+    board = tetris.getBlankBoard()
+    board.colors = None
+    for y, row in enumerate(rows):
+        if not isinstance(row, str) or len(row) != tetris.BOARDWIDTH:
+            raise ValueError('row %d of the board needs %d boxes' % (y, tetris.BOARDWIDTH))
+        for x, box in enumerate(row):
+            if box != tetris.BLANK:
+                board.rows[y] |= 1 << x
+                board.columnMasks[x] |= 1 << y
+                board.rowFill[y] += 1
+    for x in range(tetris.BOARDWIDTH):
+        board.updateColumn(x)
+    return board
+
+'''
+Makes a piece at the top of the board from its letter.
+shape: the letter of the shape, like 'T'
+return: the piece
+'''
+def parsePiece(shape):
+    if shape not in tetris.PIECEIDS:
+        raise ValueError('unknown piece %r' % (shape,))
+    return tetris.makePiece(tetris.PIECEIDS[shape], 0)
+
+'''
+Reads a request.
+message: the request, as decoded from its JSON line
+return: (board, piece, previews, heldPiece, hold, depth)
+'''
+def parseRequest(message):
+    if not isinstance(message, dict):
+        raise ValueError('a request is a JSON object')
+    board = parseBoard(message.get('board'))
+    piece = parsePiece(message.get('piece'))
+    previews = [parsePiece(shape) for shape in message.get('preview') or []]
+    held = message.get('held')
+    heldPiece = parsePiece(held) if held is not None else None
+    depth = int(message.get('depth', 1))
+    if depth < 1 or depth > len(previews) + 1:
+        raise ValueError('depth %d needs %d preview pieces' % (depth, depth - 1))
+    return board, piece, previews, heldPiece, bool(message.get('hold', False)), depth
+
+'''
+Chooses the move of one request with the move finders of the game.
+request: a parsed request
+return: (column, rotation, hold, placements evaluated)
+'''
+def chooseMove(request):
+    board, piece, previews, heldPiece, hold, depth = request
+    stats = {}
+    if depth > 1:
+        move = tetris.findBestMoveLookahead(board, piece, previews, depth, stats=stats, hold=hold, heldPiece=heldPiece)
+        return move[0], move[1], bool(hold and move[2]), stats.get('nodes', 0)
+    if hold:
+        column, rotation, useHold = tetris.findBestMoveWithHold(board, piece, heldPiece,
+                                                                previews[0] if previews else None, stats)
+        return column, rotation, useHold, stats.get('nodes', 0)
+    column, rotation = tetris.findBestMove(board, piece, stats=stats)
+    return column, rotation, False, stats.get('nodes', 0)
+
+'''
+Chooses the moves of the single piece requests of a batch with one numpy pass:
+the candidate boards of every request (both branches when it may hold) are
+stacked into one array and calcPenaltyBatched scores them all at once. Each
+request gets the first of its best candidates, the move findBestMove and
+findBestMoveWithHold choose.
+requests: the parsed requests, all with a depth of 1
+return: (column, rotation, hold, placements evaluated) of every request
+'''
+def chooseMovesBatched(requests):
+    numpy = tetris.loadNumpy()
+    candidates = []
+    arrays = []
+    ranges = []
+    for board, piece, previews, heldPiece, hold, depth in requests:
+        start = len(candidates)
+        shapes = [(piece.shape, False)]
+        other = heldPiece if heldPiece is not None else (previews[0] if previews else None)
+        if hold and other is not None and other.shape != piece.shape:
+            shapes.append((other.shape, True))
+        for shape, useHold in shapes:
+            placements = list(tetris.generatePlacements(board, shape))
+            if placements:
+                arrays.append(tetris.placementsToArray(board, placements))
+                candidates.extend((placement, useHold) for placement in placements)
+        ranges.append((start, len(candidates)))
+    penalties = tetris.calcPenaltyBatched(numpy.concatenate(arrays)) if arrays else None
+    moves = []
+    for request, (start, end) in zip(requests, ranges):
+        if start == end:
+            # nowhere to go, findBestMove gives its fallback move
+            column, rotation = tetris.findBestMove(request[0], request[1])
+            moves.append((column, rotation, False, 0))
+            continue
+        best = start + int(numpy.argmin(penalties[start:end]))
+        (shape, rotation, x, y), useHold = candidates[best]
+        moves.append((x + tetris.PIECEGEOMETRY[shape][rotation]['minX'], rotation, useHold, end - start))
+    return moves
+
+'''
+Evaluates a batch of requests. It runs on the evaluation thread, one batch at
+a time, while the event loop goes on reading the next requests.
+messages: the requests, as decoded from their JSON lines
+evaluator: 'python' for the move finders, 'numpy' to score the single piece
+           requests of the batch in one pass
+return: the reply of every request, without its id
+'''
+def evaluateBatch(messages, evaluator):
+    replies = [None] * len(messages)
+    requests = {}
+    for index, message in enumerate(messages):
+        try:
+            requests[index] = parseRequest(message)
+        except (ValueError, TypeError) as error:
+            replies[index] = {'error': str(error)}
+    batched = []
+    if evaluator == 'numpy' and tetris.loadNumpy() is not None:
+        batched = [index for index, request in sorted(requests.items()) if request[5] == 1]
+        for index, move in zip(batched, chooseMovesBatched([requests[index] for index in batched])):
+            replies[index] = move
+    for index, request in requests.items():
+        if replies[index] is None:
+            replies[index] = chooseMove(request)
+    for index in requests:
+        column, rotation, hold, placements = replies[index]
+        replies[index] = {'column': column, 'rotation': rotation, 'hold': hold, 'placements': placements}
+    return replies
+
+'''
+The service: reads requests from any number of persistent connections, queues
+them and answers them a batch at a time.
+evaluator: 'python' or 'numpy', see evaluateBatch
+batchSize: most requests evaluated in one batch
+batchWait: seconds a batch waits for more requests when only one is queued
+'''
+class MoveService(object):
+    def __init__(self, evaluator='python', batchSize=BATCHSIZE, batchWait=BATCHWAIT):
+        self.evaluator = evaluator
+        self.batchSize = batchSize
+        self.batchWait = batchWait
+        self.queue = None
+        self.batcher = None
+        # one thread, so the batches are evaluated one after the other
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.latencies = collections.deque(maxlen=LATENCYWINDOW)
+        self.requests = 0
+        self.batches = 0
+        self.connections = 0
+        self.maxQueueDepth = 0
+        self.started = time.perf_counter()
+
+    '''
+    Starts listening and evaluating.
+    host: address to listen on
+    port: port to listen on
+    return: the asyncio server
+    '''
+    async def start(self, host=SERVICEHOST, port=SERVICEPORT):
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.runBatches())
+        return await asyncio.start_server(self.handleConnection, host, port)
+
+    '''
+    Reads the requests of one connection until the client closes it. Every
+    reply is written as soon as its batch is done, with the id of its request,
+    so a client can send many requests without waiting for the replies.
+    '''
+    async def handleConnection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                arrival = time.perf_counter()
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    self.reply(writer, {'error': 'a request is one line of JSON'})
+                    continue
+                if isinstance(message, dict) and message.get('stats'):
+                    self.reply(writer, self.stats())
+                    continue
+                self.queue.put_nowait((message, writer, arrival))
+                self.maxQueueDepth = max(self.maxQueueDepth, self.queue.qsize())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    '''
+    Writes one reply line, unless the client is gone.
+    '''
+    def reply(self, writer, reply):
+        if not writer.is_closing():
+            writer.write(json.dumps(reply).encode('ascii') + b'\n')
+
+    '''
+    Takes the queued requests a batch at a time and evaluates them on the
+    evaluation thread. Requests that come in while a batch is evaluated make
+    up the next one.
+    '''
+    async def runBatches(self):
+        loop = asyncio.get_running_loop()
+        queue = self.queue
+        while True:
+            batch = [await queue.get()]
+            if self.batchWait and queue.empty():
+                await asyncio.sleep(self.batchWait)
+            while len(batch) < self.batchSize and not queue.empty():
+                batch.append(queue.get_nowait())
+            messages = [message for message, writer, arrival in batch]
+            try:
+                replies = await loop.run_in_executor(self.executor, evaluateBatch, messages, self.evaluator)
+            except Exception as error:
+                # a bug shouldn't take the service down, every request of the batch gets the error
+                replies = [{'error': 'the batch failed: %r' % (error,)} for message in messages]
+            done = time.perf_counter()
+            self.batches += 1
+            self.requests += len(batch)
+            for (message, writer, arrival), reply in zip(batch, replies):
+                if isinstance(message, dict) and 'id' in message:
+                    reply['id'] = message['id']
+                self.latencies.append(done - arrival)
+                self.reply(writer, reply)
+
+    '''
+    return: dictionary with the requests and batches answered, the mean batch
+            size, the open connections, the requests queued now and the most
+            ever queued, and the 50th, 95th and 99th percentile of the latency
+            of the recent requests in milliseconds, from reading a request to
+            its reply
+    '''
+    def stats(self):
+        latencies = [latency * 1000.0 for latency in self.latencies]
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'meanBatch': self.requests / float(self.batches) if self.batches else 0.0,
+                'connections': self.connections,
+                'queueDepth': self.queue.qsize() if self.queue is not None else 0,
+                'maxQueueDepth': self.maxQueueDepth,
+                'latencyMs': {'p50': tetris.percentile(latencies, 0.50),
+                              'p95': tetris.percentile(latencies, 0.95),
+                              'p99': tetris.percentile(latencies, 0.99)},
+                'uptime': time.perf_counter() - self.started}
+
+'''
+Blocking client of the service for bots and front-ends, over one persistent
+connection.
+host: address of the service
+port: port of the service
+'''
+class MoveClient(object):
+    def __init__(self, host=SERVICEHOST, port=SERVICEPORT):
+        self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile('rwb')
+        self.nextId = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    '''
+    Sends one request and waits for its reply.
+    message: the request
+    return: the reply
+    '''
+    def send(self, message):
+        self.file.write(json.dumps(message).encode('ascii') + b'\n')
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    '''
+    Asks the service for a move.
+    board: the rows of the board, top first, as parseBoard reads them
+    piece: letter of the falling piece
+    preview: letters of the next pieces
+    held: letter of the held piece, None when nothing is held
+    hold: True to let the AI hold the piece
+    depth: number of pieces to look at, as in findBestMoveLookahead
+    return: the reply, with the column and rotation to drop the piece in and
+            whether to hold first, or the error
+    '''
+    def suggest(self, board, piece, preview=(), held=None, hold=False, depth=1):
+        self.nextId += 1
+        return self.send({'id': self.nextId, 'board': list(board), 'piece': piece, 'preview': list(preview),
+                          'held': held, 'hold': hold, 'depth': depth})
+
+    '''
+    return: the stats of the service
+    '''
+    def stats(self):
+        return self.send({'stats': True})
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+'''
+The rows of a board as the service reads them.
+board: the board
+return: list of BOARDHEIGHT strings, '#' for a filled box
+'''
+def boardToRows(board):
+    return [''.join('#' if row >> x & 1 else tetris.BLANK for x in range(tetris.BOARDWIDTH)) for row in board.rows]
+
+'''
+Starts the service and serves until interrupted.
+'''
+async def serve(host, port, evaluator, batchSize, batchWait):
+    service = MoveService(evaluator, batchSize, batchWait)
+    server = await service.start(host, port)
+    print('Serving moves on %s:%d with the %s evaluator' % (host, port, evaluator))
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the moves of the Tetris AI over a local socket.')
+    parser.add_argument('--host', default=SERVICEHOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=SERVICEPORT, help='port to listen on')
+    parser.add_argument('--evaluator', choices=('python', 'numpy'), default='python',
+                        help='numpy scores all the single piece requests of a batch in one pass')
+    parser.add_argument('--batch-size', type=int, default=BATCHSIZE, help='most requests evaluated in one batch')
+    parser.add_argument('--batch-wait', type=float, default=BATCHWAIT * 1000.0,
+                        help='milliseconds a lone request waits for others to batch with')
+    parser.add_argument('--query-stats', action='store_true', help='print the stats of a running service and exit')
+    args = parser.parse_args()
+
+    if args.query_stats:
+        with MoveClient(args.host, args.port) as client:
+            print(json.dumps(client.stats(), indent=2, sort_keys=True))
+        return
+    if args.evaluator == 'numpy' and tetris.loadNumpy() is None:
+        parser.error('--evaluator numpy needs numpy')
+    try:
+        asyncio.run(serve(args.host, args.port, args.evaluator, args.batch_size, args.batch_wait / 1000.0))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+################################################################################
+# Per-piece telemetry of Tetris AI games
+# Every piece the AI locks is written as one row: its index, shape, placement,
+# the candidates the AI evaluated and the time it took, the lines cleared, and
+# the height and hole penalties and highest column of the board it left. Rows
+# are buffered column by column in typed arrays and written as blocks, so a game
+# of a million pieces only ever keeps one block in memory. The file can then be
+# summarized window by window to see where the AI slows down or gets worse.
+#
+# Example: python tetris_batch.py --games 1 --workers 1 --telemetry runs
+#          python tetris_telemetry.py runs/game0.ttl --window 10000
+################################################################################
+
+import argparse, array, csv, json, struct
+
+import tetris_brogan_edit as tetris
+from tetris_replay import REPLAYSHAPES, REPLAYSHAPECODES
+
+# Start of every telemetry file, the last byte is the version of the format
+TELEMETRYMAGIC = b'TTL\x01'
+# (name, array typecode) of every column, in the order they are written
+TELEMETRYCOLUMNS = (('index', 'q'),
+                    ('shape', 'B'),
+                    ('rotation', 'B'),
+                    ('column', 'B'),
+                    ('hold', 'B'),
+                    ('candidates', 'I'),
+                    ('searchSeconds', 'd'),
+                    ('lines', 'B'),
+                    ('heightPenalty', 'q'),
+                    ('holePenalty', 'q'),
+                    ('maxHeight', 'B'))
+# Rows kept in memory before a block is written
+TELEMETRYBUFFER = 4096
+# Size of the JSON header, then the number of rows of every block
+BLOCKHEADER = struct.Struct('<I')
+
+'''
+Writes the telemetry of a game to a file as it is played. The file starts with
+the magic and the names, typecodes and sizes of the columns as JSON, then every
+block is its number of rows followed by the raw bytes of every column.
+path: path of the file
+bufferRows: rows kept in memory before a block is written
+'''
+class TelemetrySink(object):
+    def __init__(self, path, bufferRows=TELEMETRYBUFFER):
+        self.file = open(path, 'wb')
+        self.bufferRows = bufferRows
+        self.columns = [array.array(typecode) for name, typecode in TELEMETRYCOLUMNS]
+        self.rows = 0
+        header = json.dumps([[name, typecode, array.array(typecode).itemsize] for name, typecode in TELEMETRYCOLUMNS])
+        header = header.encode('ascii')
+        self.file.write(TELEMETRYMAGIC + BLOCKHEADER.pack(len(header)) + header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    '''
+    Adds the row of a piece that was just locked.
+    game: the GameState after the piece locked
+    shape: id of the shape of the piece
+    rotation: rotation of the piece
+    column: leftmost column of the piece
+    hold: True when the piece came out of hold
+    candidates: placements the AI evaluated to choose it
+    seconds: seconds the AI took to choose it
+    lines: lines the piece cleared
+    '''
+    def record(self, game, shape, rotation, column, hold, candidates, seconds, lines):
+        board = game.board
+        row = (game.piecesPlaced - 1, REPLAYSHAPECODES[tetris.PIECESLIST[shape]], rotation, column, 1 if hold else 0, candidates,
+               seconds, lines, tetris.calcRealHeightPenalty(board), tetris.calcHolePenalty(board), max(board.heights))
+        for values, value in zip(self.columns, row):
+            values.append(value)
+        self.rows += 1
+        if self.rows >= self.bufferRows:
+            self.flush()
+
+    '''
+    Writes the rows in memory as one block.
+    '''
+    def flush(self):
+        if not self.rows:
+            return
+        self.file.write(BLOCKHEADER.pack(self.rows))
+        for values in self.columns:
+            values.tofile(self.file)
+            del values[:]
+        self.rows = 0
+
+    '''
+    Writes the last rows and closes the file.
+    '''
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+'''
+Reads a telemetry file one block at a time, so it can be bigger than memory.
+path: path of the file
+return: generator of dictionaries, column name to array of the rows of a block
+'''
+def readTelemetry(path):
+    with open(path, 'rb') as telemetryFile:
+        if telemetryFile.read(len(TELEMETRYMAGIC)) != TELEMETRYMAGIC:
+            raise ValueError('not a telemetry file, or one of another version')
+        size, = BLOCKHEADER.unpack(telemetryFile.read(BLOCKHEADER.size))
+        columns = json.loads(telemetryFile.read(size).decode('ascii'))
+        for name, typecode, itemsize in columns:
+            if array.array(typecode).itemsize != itemsize:
+                raise ValueError('the %s column was written with %d byte values, here they have %d bytes' %
+                                 (name, itemsize, array.array(typecode).itemsize))
+        while True:
+            data = telemetryFile.read(BLOCKHEADER.size)
+            if not data:
+                return
+            rows, = BLOCKHEADER.unpack(data)
+            block = {}
+            for name, typecode, itemsize in columns:
+                values = array.array(typecode)
+                values.fromfile(telemetryFile, rows)
+                block[name] = values
+            yield block
+
+'''
+Reads a telemetry file one row at a time.
+path: path of the file
+return: generator of dictionaries, column name to value, with the shape as a letter
+'''
+def readRows(path):
+    for block in readTelemetry(path):
+        names = list(block)
+        for values in zip(*(block[name] for name in names)):
+            row = dict(zip(names, values))
+            row['shape'] = REPLAYSHAPES[row['shape']]
+            yield row
+
+'''
+Sums up a telemetry file in windows of pieces, without keeping more than one
+window of search times in memory.
+path: path of the file
+window: pieces per window
+return: list with one dictionary per window: first piece, pieces, lines, mean
+        and 99th percentile search milliseconds, mean candidates, mean height
+        and hole penalties and the highest column
+'''
+def summarizeTelemetry(path, window):
+    windows = []
+    current = None
+    for row in readRows(path):
+        if current is None or row['index'] >= current['first'] + window:
+            if current is not None:
+                windows.append(finishWindow(current))
+            current = {'first': row['index'] - row['index'] % window, 'pieces': 0, 'lines': 0, 'times': [],
+                       'candidates': 0, 'heightPenalty': 0, 'holePenalty': 0, 'maxHeight': 0}
+        current['pieces'] += 1
+        current['lines'] += row['lines']
+        current['times'].append(row['searchSeconds'] * 1000.0)
+        current['candidates'] += row['candidates']
+        current['heightPenalty'] += row['heightPenalty']
+        current['holePenalty'] += row['holePenalty']
+        current['maxHeight'] = max(current['maxHeight'], row['maxHeight'])
+    if current is not None:
+        windows.append(finishWindow(current))
+    return windows
+
+'''
+Turns the sums of a window into its means.
+current: the sums of the window, as built by summarizeTelemetry
+return: the summary of the window
+'''
+def finishWindow(current):
+    pieces = float(current['pieces'])
+    times = current['times']
+    return {'first': current['first'],
+            'pieces': current['pieces'],
+            'lines': current['lines'],
+            'meanMs': sum(times) / pieces,
+            'p99Ms': tetris.percentile(times, 0.99),
+            'candidates': current['candidates'] / pieces,
+            'heightPenalty': current['heightPenalty'] / pieces,
+            'holePenalty': current['holePenalty'] / pieces,
+            'maxHeight': current['maxHeight']}
+
+'''
+Writes a telemetry file as CSV, one line per piece.
+path: path of the telemetry file
+csvPath: path of the CSV file
+'''
+def exportCSV(path, csvPath):
+    names = [name for name, typecode in TELEMETRYCOLUMNS]
+    with open(csvPath, 'w', newline='') as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(names)
+        for row in readRows(path):
+            writer.writerow([row[name] for name in names])
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the per-piece telemetry of a Tetris AI game.')
+    parser.add_argument('telemetry', help='telemetry file, as written by tetris_batch.py --telemetry')
+    parser.add_argument('--window', type=int, default=1000, help='pieces per line of the summary')
+    parser.add_argument('--csv', metavar='PATH', help='also write every piece to this CSV file')
+    args = parser.parse_args()
+
+    print('%10s %7s %6s %9s %9s %6s %9s %9s %4s' % ('pieces', 'count', 'lines', 'mean ms', 'p99 ms', 'cands',
+                                                   'height', 'holes', 'top'))
+    for window in summarizeTelemetry(args.telemetry, args.window):
+        print('%10d %7d %6d %9.3f %9.3f %6.1f %9.1f %9.1f %4d' % (
+            window['first'], window['pieces'], window['lines'], window['meanMs'], window['p99Ms'],
+            window['candidates'], window['heightPenalty'], window['holePenalty'], window['maxHeight']))
+    if args.csv:
+        exportCSV(args.telemetry, args.csv)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+################################################################################
+# Weight tuner for the Tetris AI
+# Tunes the HEIGHTMULTIPLIERS and the HOLEPENALTY with the cross-entropy method:
+# every generation draws candidate weights from a normal distribution around
+# the mean, plays them on seeded headless games in a process pool and moves the
+# mean to the best of them. Candidates race the incumbent (the best weights so
+# far) on the same seeds a few games at a time, and are dropped as soon as they
+# are clearly worse, so most of the games go to the candidates worth playing.
+#
+# Example: python tetris_tuner.py --generations 30 --workers 32 --output weights.json
+################################################################################
+
+import argparse, json, math, multiprocessing, os, random, time
+
+import tetris_brogan_edit as tetris
+
+# Rows whose multiplier is tuned, the multiplier past the bottom row is never used
+TUNEDROWS = tetris.BOARDHEIGHT
+
+'''
+The weights the evaluators use now, as a vector: one height multiplier per row
+and the hole penalty last.
+return: the vector
+'''
+def currentVector():
+    return [float(multiplier) for multiplier in tetris.HEIGHTMULTIPLIERS[:TUNEDROWS]] + [float(tetris.HOLEPENALTY)]
+
+'''
+Turns a vector back into weights. They are rounded, so the penalties stay
+whole numbers like they are with the hand-made weights.
+vector: the vector, as made by currentVector
+return: (heightMultipliers, holePenalty) for setWeights
+'''
+def vectorToWeights(vector):
+    heightMultipliers = [int(round(value)) for value in vector[:TUNEDROWS]] + tetris.HEIGHTMULTIPLIERS[TUNEDROWS:]
+    return heightMultipliers, int(round(vector[TUNEDROWS]))
+
+'''
+Plays one seeded game with a set of weights, in a worker process.
+task: (vector, seed, maxPieces)
+return: the lines cleared
+'''
+def playWeighted(task):
+    vector, seed, maxPieces = task
+    tetris.setWeights(*vectorToWeights(vector))
+    return tetris.playAIGame(seed, maxPieces).score
+
+'''
+Plays games in the pool, or in this process when there is no pool.
+pool: multiprocessing.Pool, None to play here
+tasks: playWeighted tasks
+return: the lines cleared of every task, in order
+'''
+def playTasks(pool, tasks):
+    if pool is None:
+        return [playWeighted(task) for task in tasks]
+    return pool.map(playWeighted, tasks, chunksize=1)
+
+'''
+Whether a candidate is clearly worse than the incumbent: the mean of the paired
+differences of their games on the same seeds is more than confidence standard
+errors below zero.
+scores: lines of the candidate, one per seed
+incumbentScores: lines of the incumbent on the same seeds
+confidence: number of standard errors
+return: True to drop the candidate
+'''
+def isWorse(scores, incumbentScores, confidence):
+    differences = [score - base for score, base in zip(scores, incumbentScores)]
+    count = len(differences)
+    if count < 2:
+        return False
+    mean = sum(differences) / float(count)
+    variance = sum((difference - mean) ** 2 for difference in differences) / (count - 1)
+    return mean + confidence * math.sqrt(variance / count) < 0
+
+'''
+Races candidates against the incumbent on the same seeds, a round of games at a
+time, dropping the candidates that are clearly worse after every round.
+pool: multiprocessing.Pool, None to play in this process
+candidates: the candidate vectors
+incumbent: the vector of the incumbent
+seeds: the seeds of the race, the most games a candidate plays
+roundGames: games every candidate plays in a round
+minGames: games a candidate plays before it can be dropped
+confidence: number of standard errors for isWorse
+maxPieces: cap on the length of each game
+return: (scores of every candidate, None for the dropped ones, scores of the
+        incumbent, number of games played)
+'''
+def race(pool, candidates, incumbent, seeds, roundGames, minGames, confidence, maxPieces):
+    scores = [[] for candidate in candidates]
+    alive = list(range(len(candidates)))
+    incumbentScores = []
+    played = 0
+    for start in range(0, len(seeds), roundGames):
+        roundSeeds = seeds[start:start + roundGames]
+        tasks = [(incumbent, seed, maxPieces) for seed in roundSeeds]
+        for index in alive:
+            tasks.extend((candidates[index], seed, maxPieces) for seed in roundSeeds)
+        results = playTasks(pool, tasks)
+        played += len(tasks)
+        incumbentScores.extend(results[:len(roundSeeds)])
+        for position, index in enumerate(alive):
+            first = len(roundSeeds) * (position + 1)
+            scores[index].extend(results[first:first + len(roundSeeds)])
+        alive = [index for index in alive
+                 if len(scores[index]) < minGames or not isWorse(scores[index], incumbentScores, confidence)]
+        if not alive:
+            break
+    aliveSet = set(alive)
+    return [scores[index] if index in aliveSet else None for index in range(len(candidates))], incumbentScores, played
+
+'''
+Tunes the weights with the cross-entropy method.
+generations: number of generations
+population: candidates drawn every generation
+elites: best candidates the next mean and spread are made from
+games: the most games a candidate plays in a generation
+roundGames: games every candidate plays before the weak ones are dropped
+minGames: games a candidate plays before it can be dropped
+confidence: number of standard errors a candidate has to be behind to be dropped
+maxPieces: cap on the length of each game, the score is the lines cleared in it
+workers: number of processes
+seed: seed of the tuner, the game seeds and the candidates follow from it
+spread: starting standard deviation, as a fraction of each weight
+report: function called with the summary of every generation, None for none
+return: the incumbent vector at the end. The weights the evaluators use are
+        the same as before tune, setWeights(*vectorToWeights(incumbent))
+        plays with the tuned ones
+'''
+def tune(generations=30, population=24, elites=6, games=32, roundGames=4, minGames=8, confidence=2.0,
+         maxPieces=1000, workers=1, seed=0, spread=0.25, report=None):
+    rng = random.Random(seed)
+    mean = currentVector()
+    # the spread never gets smaller than this, so the search keeps moving
+    floor = [0.01 * max(abs(value), 10.0) for value in mean]
+    sigma = [spread * max(abs(value), 10.0) for value in mean]
+    incumbent = list(mean)
+    # without a pool the candidates are played in this process, each one sets
+    # its weights, so the weights from before are put back at the end
+    savedWeights = (list(tetris.HEIGHTMULTIPLIERS), tetris.HOLEPENALTY)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for generation in range(generations):
+            start = time.perf_counter()
+            seeds = [rng.randrange(2 ** 32) for i in range(games)]
+            candidates = [[rng.gauss(m, s) for m, s in zip(mean, sigma)] for i in range(population)]
+            scores, incumbentScores, played = race(pool, candidates, incumbent, seeds, roundGames, minGames,
+                                                   confidence, maxPieces)
+            # the candidates that weren't dropped played every seed, rank them
+            # on their mean advantage over the incumbent
+            ranked = []
+            for candidate, candidateScores in zip(candidates, scores):
+                if candidateScores is None:
+                    continue
+                advantage = sum(score - base for score, base in zip(candidateScores, incumbentScores))
+                ranked.append((advantage / float(len(candidateScores)), candidateScores, candidate))
+            ranked.sort(key=lambda entry: -entry[0])
+            elite = [candidate for advantage, candidateScores, candidate in ranked[:elites]]
+            if elite:
+                mean = [sum(values) / len(elite) for values in zip(*elite)]
+                if len(elite) > 1:
+                    sigma = [max(f, math.sqrt(sum((value - m) ** 2 for value in values) / len(elite)))
+                             for values, m, f in zip(zip(*elite), mean, floor)]
+            promoted = False
+            # the best candidate only replaces the incumbent when the incumbent
+            # is clearly worse than it, not just behind by luck
+            if ranked and isWorse(incumbentScores, ranked[0][1], confidence):
+                incumbent = ranked[0][2]
+                promoted = True
+            if report is not None:
+                report({'generation': generation,
+                        'incumbentLines': sum(incumbentScores) / float(len(incumbentScores)),
+                        'bestAdvantage': ranked[0][0] if ranked else None,
+                        'finished': len(ranked),
+                        'dropped': population - len(ranked),
+                        'games': played,
+                        'promoted': promoted,
+                        'seconds': time.perf_counter() - start,
+                        'incumbent': incumbent})
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        tetris.setWeights(*savedWeights)
+    return incumbent
+
+'''
+Writes weights as JSON, the keyword arguments of setWeights.
+vector: the vector of the weights
+path: path of the file
+'''
+def saveWeights(vector, path):
+    heightMultipliers, holePenalty = vectorToWeights(vector)
+    with open(path, 'w') as weightsFile:
+        json.dump({'heightMultipliers': heightMultipliers, 'holePenalty': holePenalty}, weightsFile, indent=2)
+
+'''
+Reads weights written by saveWeights and makes the evaluators use them.
+path: path of the file
+'''
+def loadWeights(path):
+    with open(path) as weightsFile:
+        tetris.setWeights(**json.load(weightsFile))
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the penalty weights of the Tetris AI.')
+    parser.add_argument('--generations', type=int, default=30, help='number of generations')
+    parser.add_argument('--population', type=int, default=24, help='candidates drawn every generation')
+    parser.add_argument('--elites', type=int, default=6, help='best candidates the next generation is drawn around')
+    parser.add_argument('--games', type=int, default=32, help='most games a candidate plays in a generation')
+    parser.add_argument('--round', type=int, default=4, help='games played before the weak candidates are dropped')
+    parser.add_argument('--min-games', type=int, default=8, help='games a candidate plays before it can be dropped')
+    parser.add_argument('--confidence', type=float, default=2.0,
+                        help='standard errors a candidate has to be behind the incumbent to be dropped')
+    parser.add_argument('--max-pieces', type=int, default=1000, help='cap on the length of each game')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the tuner')
+    parser.add_argument('--spread', type=float, default=0.25, help='starting spread, as a fraction of each weight')
+    parser.add_argument('--start', metavar='PATH', help='start from the weights in this JSON file')
+    parser.add_argument('--output', metavar='PATH', default='weights.json',
+                        help='JSON file the incumbent is written to after every generation')
+    args = parser.parse_args()
+
+    if args.start:
+        loadWeights(args.start)
+
+    def report(summary):
+        print('Generation %3d: incumbent %7.1f lines, best candidate %+7.1f, %2d finished %2d dropped, '
+              '%5d games in %6.1fs%s' % (
+                  summary['generation'], summary['incumbentLines'],
+                  summary['bestAdvantage'] if summary['bestAdvantage'] is not None else 0.0,
+                  summary['finished'], summary['dropped'], summary['games'], summary['seconds'],
+                  '  new incumbent' if summary['promoted'] else ''))
+        saveWeights(summary['incumbent'], args.output)
+
+    incumbent = tune(args.generations, args.population, args.elites, args.games, args.round, args.min_games,
+                     args.confidence, args.max_pieces, args.workers, args.seed, args.spread, report)
+    heightMultipliers, holePenalty = vectorToWeights(incumbent)
+    print('Height multipliers: %s' % heightMultipliers)
+    print('Hole penalty:       %d' % holePenalty)
+
+if __name__ == '__main__':
+    main()
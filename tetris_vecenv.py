@@ -0,0 +1,290 @@
+################################################################################
+# Vectorized Tetris environments for training and tuning agents
+# Holds N independent games as stacked numpy arrays (the boards, the falling
+# pieces, the preview queues and the 7-bags) and steps all of them with one
+# call. An action is a placement, the rotation and leftmost column the piece is
+# dropped in, the same moves findBestMove chooses. Every step returns the
+# observations, the lines every game cleared and whether it ended, and the games
+# that ended start over on their own.
+#
+# Example: python tetris_vecenv.py --envs 256 --steps 2000
+################################################################################
+
+import argparse, time
+
+import numpy
+
+import tetris_brogan_edit as tetris
+
+# Most rotations of a shape, the action space has this many times BOARDWIDTH actions
+MAXROTATIONS = max(tetris.PIECEROTATIONS)
+ACTIONS = MAXROTATIONS * tetris.BOARDWIDTH
+# Pieces in the preview queue, like GameState.queue
+PREVIEWS = 3
+
+'''
+Builds the geometry tables the environments index with the shape and rotation
+of every game at once.
+return: (cells, minX, rotations, valid) with cells the (x, y)
+        template offsets of the 4 boxes shaped [shapes, MAXROTATIONS, 4, 2],
+        and valid shaped [shapes, ACTIONS], True for the actions that fit
+'''
+def buildTables():
+    shapes = len(tetris.PIECESLIST)
+    cells = numpy.zeros((shapes, MAXROTATIONS, 4, 2), dtype=numpy.intp)
+    minX = numpy.zeros((shapes, MAXROTATIONS), dtype=numpy.intp)
+    valid = numpy.zeros((shapes, ACTIONS), dtype=bool)
+    for shape in tetris.PIECESHAPEIDS:
+        for rotation, geometry in enumerate(tetris.PIECEGEOMETRY[shape]):
+            cells[shape, rotation] = geometry['cells']
+            minX[shape, rotation] = geometry['minX']
+            for column in range(tetris.BOARDWIDTH - geometry['width'] + 1):
+                valid[shape, rotation * tetris.BOARDWIDTH + column] = True
+    return cells, minX, numpy.array(tetris.PIECEROTATIONS, dtype=numpy.intp), valid
+
+PIECECELLS, PIECEMINX, PIECEROTATIONS, VALIDACTIONS = buildTables()
+
+'''
+N games stepped together. The boards are one uint8 array shaped [N,
+BOARDWIDTH, BOARDHEIGHT] indexed like the color plane of a Board and like
+placementsToArray, 1 where a box is. The pieces come from a 7-bag per game,
+drawn with one numpy random generator, so the same seed always gives the same
+games.
+numEnvs: number of games
+seed: seed of the random generator, None for a random one
+'''
+class VecEnv(object):
+    def __init__(self, numEnvs, seed=None):
+        self.numEnvs = numEnvs
+        self.random = numpy.random.default_rng(seed)
+        self.boards = numpy.zeros((numEnvs, tetris.BOARDWIDTH, tetris.BOARDHEIGHT), dtype=numpy.uint8)
+        self.heights = numpy.zeros((numEnvs, tetris.BOARDWIDTH), dtype=numpy.intp)
+        # the falling piece and the preview queue, shape ids and rotations
+        self.shapes = numpy.zeros((numEnvs, PREVIEWS + 1), dtype=numpy.intp)
+        self.rotations = numpy.zeros((numEnvs, PREVIEWS + 1), dtype=numpy.intp)
+        # the shapes left in the bag of every game, first to come out first
+        self.bags = numpy.zeros((numEnvs, 2 * len(tetris.PIECESLIST)), dtype=numpy.intp)
+        self.bagSizes = numpy.zeros(numEnvs, dtype=numpy.intp)
+        self.episodeLines = numpy.zeros(numEnvs, dtype=numpy.int64)
+        self.episodePieces = numpy.zeros(numEnvs, dtype=numpy.int64)
+        # lines and pieces of the last game every environment finished
+        self.finishedLines = numpy.zeros(numEnvs, dtype=numpy.int64)
+        self.finishedPieces = numpy.zeros(numEnvs, dtype=numpy.int64)
+        self.episodes = 0
+        self.everything = numpy.arange(numEnvs)
+        self.reset()
+
+    '''
+    Starts every game over.
+    return: the observations
+    '''
+    def reset(self):
+        self.resetGames(self.everything)
+        return self.observe()
+
+    '''
+    Starts some of the games over: empty board, new bag and pieces.
+    games: indexes of the games
+    '''
+    def resetGames(self, games):
+        self.boards[games] = 0
+        self.heights[games] = 0
+        self.bagSizes[games] = 0
+        self.episodeLines[games] = 0
+        self.episodePieces[games] = 0
+        for slot in range(PREVIEWS + 1):
+            self.shapes[games, slot], self.rotations[games, slot] = self.drawPieces(games)
+
+    '''
+    Takes the next piece out of the bag of some games, like BagRandomizer: a
+    bag with less than 3 shapes left gets a new shuffled set of the 7 added
+    to its end, then the first shape comes out with a random rotation.
+    games: indexes of the games
+    return: (shapes, rotations) of the pieces
+    '''
+    def drawPieces(self, games):
+        refill = games[self.bagSizes[games] < 3]
+        if len(refill):
+            shuffled = numpy.argsort(self.random.random((len(refill), len(tetris.PIECESLIST))), axis=1)
+            positions = self.bagSizes[refill, None] + numpy.arange(len(tetris.PIECESLIST))
+            self.bags[refill[:, None], positions] = shuffled
+            self.bagSizes[refill] += len(tetris.PIECESLIST)
+        shapes = self.bags[games, 0]
+        self.bags[games, :-1] = self.bags[games, 1:]
+        self.bagSizes[games] -= 1
+        rotations = (self.random.random(len(games)) * PIECEROTATIONS[shapes]).astype(numpy.intp)
+        return shapes, rotations
+
+    '''
+    The state of every game. The arrays belong to the environments and change
+    with the next step, copy them to keep them.
+    return: dictionary with
+        board: uint8 [N, BOARDWIDTH, BOARDHEIGHT], 1 where a box is
+        heights: [N, BOARDWIDTH] height of every column
+        piece: [N] shape id of the falling piece
+        preview: [N, PREVIEWS] shape ids of the next pieces
+        mask: bool [N, ACTIONS], the actions that fit on the board
+    '''
+    def observe(self):
+        return {'board': self.boards,
+                'heights': self.heights,
+                'piece': self.shapes[:, 0],
+                'preview': self.shapes[:, 1:],
+                'mask': self.actionMask()}
+
+    '''
+    return: bool [N, ACTIONS], True for the actions whose column range fits
+            the falling piece of every game
+    '''
+    def actionMask(self):
+        return VALIDACTIONS[self.shapes[:, 0]]
+
+    '''
+    Drops the falling piece of every game in the rotation and column of its
+    action, locks it, clears the complete lines and brings in the next piece.
+    A game ends when the piece locks with boxes above the board, or when the
+    next piece doesn't fit where it comes in (the isValidPosition check of
+    GameState.spawnPiece). The games that ended start over, their observation
+    is already the one of the new game.
+    actions: [N] ints, rotation * BOARDWIDTH + leftmost column
+    return: (observations, lines cleared [N], done [N])
+    '''
+    def step(self, actions):
+        actions = numpy.asarray(actions, dtype=numpy.intp)
+        games = self.everything
+        shapes = self.shapes[:, 0]
+        if not VALIDACTIONS[shapes, actions].all():
+            raise ValueError('the actions of games %s are off the board for their pieces' %
+                             numpy.flatnonzero(~VALIDACTIONS[shapes, actions]).tolist())
+        rotations = actions // tetris.BOARDWIDTH
+        x = actions % tetris.BOARDWIDTH - PIECEMINX[shapes, rotations]
+        cells = PIECECELLS[shapes, rotations]
+        boxX = x[:, None] + cells[:, :, 0]
+        # the piece stops when one of its boxes sits on top of its column
+        landing = (tetris.BOARDHEIGHT - 1 - self.heights[games[:, None], boxX] - cells[:, :, 1]).min(axis=1)
+        boxY = landing[:, None] + cells[:, :, 1]
+        inside = boxY >= 0
+        done = ~inside.all(axis=1)
+        # the boxes above the board of a piece that tops out are lost, like
+        # addShapeToBoard drops them, only the ones on the board can clear lines
+        game, box = numpy.nonzero(inside)
+        self.boards[game, boxX[game, box], boxY[game, box]] = 1
+
+        full = self.boards.all(axis=1)
+        lines = full.sum(axis=1)
+        cleared = numpy.flatnonzero(lines)
+        if len(cleared):
+            # a stable sort puts the full rows on top and keeps the others in order
+            order = numpy.argsort(~full[cleared], axis=1, kind='stable')
+            boards = numpy.take_along_axis(self.boards[cleared], order[:, None, :], axis=2)
+            boards *= (numpy.arange(tetris.BOARDHEIGHT) >= lines[cleared, None])[:, None, :]
+            self.boards[cleared] = boards
+        filled = self.boards.any(axis=2)
+        self.heights = numpy.where(filled, tetris.BOARDHEIGHT - self.boards.argmax(axis=2), 0)
+
+        self.episodeLines += lines
+        self.episodePieces += 1
+        self.shapes[:, :-1] = self.shapes[:, 1:]
+        self.rotations[:, :-1] = self.rotations[:, 1:]
+        self.shapes[:, -1], self.rotations[:, -1] = self.drawPieces(games)
+        done |= self.collides(self.shapes[:, 0], self.rotations[:, 0])
+
+        ended = numpy.flatnonzero(done)
+        if len(ended):
+            self.finishedLines[ended] = self.episodeLines[ended]
+            self.finishedPieces[ended] = self.episodePieces[ended]
+            self.episodes += len(ended)
+            self.resetGames(ended)
+        return self.observe(), lines, done
+
+    '''
+    Whether pieces coming in at the top of the board collide with the stack,
+    isValidPosition for every game at once. Boxes above the board never collide.
+    shapes: [N] shape ids
+    rotations: [N] rotations
+    return: bool [N]
+    '''
+    def collides(self, shapes, rotations):
+        cells = PIECECELLS[shapes, rotations]
+        boxX = tetris.SPAWNX + cells[:, :, 0]
+        boxY = tetris.SPAWNY + cells[:, :, 1]
+        boxes = self.boards[self.everything[:, None], boxX, numpy.maximum(boxY, 0)]
+        return ((boxY >= 0) & (boxes == 1)).any(axis=1)
+
+'''
+The actions findBestMove would choose in every game, scored with one
+calcPenaltyBatched pass over every candidate board of every game. Placements
+that leave boxes above the board are only chosen when nothing else fits, like
+generatePlacements skips them.
+env: the VecEnv
+return: [N] actions
+'''
+def greedyActions(env):
+    numEnvs = env.numEnvs
+    shapes = env.shapes[:, 0]
+    actions = numpy.arange(ACTIONS)
+    rotations = numpy.minimum(actions // tetris.BOARDWIDTH, PIECEROTATIONS[shapes, None] - 1)
+    valid = VALIDACTIONS[shapes]
+    x = actions % tetris.BOARDWIDTH - PIECEMINX[shapes[:, None], rotations]
+    cells = PIECECELLS[shapes[:, None], rotations]
+    boxX = numpy.clip(x[:, :, None] + cells[:, :, :, 0], 0, tetris.BOARDWIDTH - 1)
+    games = numpy.arange(numEnvs)[:, None, None]
+    landing = (tetris.BOARDHEIGHT - 1 - env.heights[games, boxX] - cells[:, :, :, 1]).min(axis=2)
+    boxY = landing[:, :, None] + cells[:, :, :, 1]
+    candidates = numpy.repeat(env.boards[:, None], ACTIONS, axis=1)
+    candidates[games, numpy.arange(ACTIONS)[None, :, None], boxX, numpy.maximum(boxY, 0)] = 1
+    penalties = tetris.calcPenaltyBatched(candidates.reshape(-1, tetris.BOARDWIDTH, tetris.BOARDHEIGHT))
+    penalties = penalties.reshape(numEnvs, ACTIONS).astype(numpy.float64)
+    penalties[~valid] = numpy.inf
+    toppedOut = (boxY < 0).any(axis=2)
+    # the placements that top out only count in the games where nothing else fits
+    penalties[toppedOut & (valid & ~toppedOut).any(axis=1)[:, None]] = numpy.inf
+    return penalties.argmin(axis=1)
+
+'''
+Steps the environments with random placements and with the greedy AI, to
+measure their throughput.
+numEnvs: number of games
+steps: number of steps
+seed: seed of the environments
+policy: 'random' or 'greedy'
+return: dictionary with the steps of all the games per second, the games
+        finished and their mean lines
+'''
+def measure(numEnvs, steps, seed, policy):
+    env = VecEnv(numEnvs, seed)
+    rng = numpy.random.default_rng(seed)
+    lines = 0
+    start = time.perf_counter()
+    observation = env.observe()
+    for i in range(steps):
+        if policy == 'greedy':
+            actions = greedyActions(env)
+        else:
+            # a random action out of the ones that fit, per game
+            mask = observation['mask']
+            choice = (rng.random(numEnvs) * mask.sum(axis=1)).astype(numpy.intp)
+            actions = (mask.cumsum(axis=1) <= choice[:, None]).sum(axis=1)
+        observation, cleared, done = env.step(actions)
+        lines += int(cleared.sum())
+    seconds = time.perf_counter() - start
+    return {'stepsPerSecond': numEnvs * steps / seconds,
+            'episodes': env.episodes,
+            'lines': lines}
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the vectorized Tetris environments.')
+    parser.add_argument('--envs', type=int, default=256, help='number of games stepped together')
+    parser.add_argument('--steps', type=int, default=1000, help='number of steps')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the games')
+    parser.add_argument('--policy', choices=('random', 'greedy', 'both'), default='both',
+                        help='random placements, the greedy AI scored in numpy, or both')
+    args = parser.parse_args()
+
+    for policy in ('random', 'greedy') if args.policy == 'both' else (args.policy,):
+        result = measure(args.envs, args.steps, args.seed, policy)
+        print('%-7s %5d envs: %9.0f steps/s, %5d games finished, %7d lines' % (
+            policy, args.envs, result['stepsPerSecond'], result['episodes'], result['lines']))
+
+if __name__ == '__main__':
+    main()